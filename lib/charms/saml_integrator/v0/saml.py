@@ -31,6 +31,9 @@ class SamlRequirerCharm(ops.CharmBase):
 As shown above, the library provides a custom event to handle the scenario in
 which new SAML data has been added or updated.
 
+When the provider metadata describes several identity providers, the requirer can
+ask for a specific one by calling `request_entity_id` from the leader unit.
+
 ### Provider Charm
 
 Following the previous example, this is an example of the provider charm.
@@ -55,7 +58,9 @@ class SamlRequirerCharm(ops.CharmBase):
 ```
 The SamlProvides object wraps the list of relations into a `relations` property
 and provides an `update_relation_data` method to update the relation data by passing
-a `SamlRelationData` data object.
+a `SamlRelationData` data object. Only the changed keys are written, and the keys no longer
+part of the data, such as the ones of a removed endpoint, are deleted. The entity ID
+requested by the requirer, if any, is available through the `get_requested_entity_id` method.
 Additionally, SamlRelationData can be used to directly parse the relation data with the
 class method `from_relation_data`.
 """
@@ -68,7 +73,7 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 9
+LIBPATCH = 11
 
 # pylint: disable=wrong-import-position
 import re
@@ -79,6 +84,7 @@ from pydantic import AnyHttpUrl, BaseModel, Field
 from pydantic.tools import parse_obj_as
 
 DEFAULT_RELATION_NAME = "saml"
+REQUESTED_ENTITY_ID_KEY = "entity_id"
 
 
 class SamlEndpoint(BaseModel):
@@ -301,6 +307,19 @@ class SamlRequires(ops.Object):
             return None
         return SamlRelationData.from_relation_data(relation.data[relation.app])
 
+    def request_entity_id(self, entity_id: str) -> None:
+        """Request the SAML data of a specific entity from the provider metadata.
+
+        Only the leader unit can request an entity.
+
+        Args:
+            entity_id: the SAML entity ID.
+        """
+        relation = self.model.get_relation(self.relation_name)
+        if not relation or not self.charm.unit.is_leader():
+            return
+        relation.data[self.charm.app][REQUESTED_ENTITY_ID_KEY] = entity_id
+
 
 class SamlProvides(ops.Object):
     """Provider side of the SAML relation.
@@ -329,11 +348,34 @@ class SamlProvides(ops.Object):
         """
         return list(self.model.relations[self.relation_name])
 
-    def update_relation_data(self, relation: ops.Relation, saml_data: SamlRelationData) -> None:
-        """Update the relation data.
+    def update_relation_data(self, relation: ops.Relation, saml_data: SamlRelationData) -> int:
+        """Update the relation data, writing the changed keys and deleting the stale ones.
 
         Args:
             relation: the relation for which to update the data.
             saml_data: a SamlRelationData instance wrapping the data to be updated.
+
+        Returns:
+            The number of keys written or deleted.
         """
-        relation.data[self.charm.model.app].update(saml_data.to_relation_data())
+        databag = relation.data[self.charm.model.app]
+        relation_data = saml_data.to_relation_data()
+        stale_keys = sorted(set(databag.keys()) - set(relation_data))
+        for key in stale_keys:
+            del databag[key]
+        changed = {key: value for key, value in relation_data.items() if databag.get(key) != value}
+        databag.update(changed)
+        return len(stale_keys) + len(changed)
+
+    def get_requested_entity_id(self, relation: ops.Relation) -> typing.Optional[str]:
+        """Retrieve the entity ID requested by the requirer.
+
+        Args:
+            relation: the relation to retrieve the requested entity ID for.
+
+        Returns:
+            The requested entity ID or None if the requirer didn't request any.
+        """
+        if not relation.app:
+            return None
+        return relation.data[relation.app].get(REQUESTED_ENTITY_ID_KEY) or None
@@ -4,23 +4,65 @@
 # See LICENSE file for licensing details.
 
 """SAML Integrator Charm service."""
+import hashlib
+import json
 import logging
+import os
+import typing
+from pathlib import Path
 
 import ops
-from charms.operator_libs_linux.v0 import apt
 from charms.saml_integrator.v0 import saml
 from ops.main import main
+from pydantic import ValidationError
 
 from charm_state import CharmConfigInvalidError, CharmState
+from metadata_cache import ExtractedSamlData, MetadataCache, SharedSnapshot
+from metadata_fetcher import FetchedMetadata
+from metrics import RECORDER, RELATION_UPDATES
+from packages import install_packages
+from refresher import REFRESH_STATUS_ENV, MetadataRefresher
 from saml import SamlIntegrator
+from tracing import TRACER, TRACES_FILENAME
 
 logger = logging.getLogger(__name__)
 
 RELATION_NAME = "saml"
+PEER_RELATION_NAME = "saml-integrator-peers"
+SHARED_SNAPSHOT_KEY = "snapshot"
+# Spans timed for the refresh-metadata action, by phase
+REFRESH_PHASES = {
+    "fetch": "MetadataFetcher.fetch",
+    "parse": "SamlIntegrator.parse",
+    "verify": "MetadataDocument.verify_signature",
+    "extract": "SamlIntegrator.extract",
+}
+STATE_DIR = Path("/var/lib/saml-integrator")
+
+
+class MetadataReadyEvent(ops.EventBase):
+    """Event emitted once the metadata fetched in background has been persisted."""
+
+
+class SamlIntegratorCharmEvents(ops.CharmEvents):
+    """Events of the SAML Integrator charm.
+
+    Attrs:
+        metadata_ready: the metadata fetched in background has been persisted.
+    """
+
+    metadata_ready = ops.EventSource(MetadataReadyEvent)
 
 
 class SamlIntegratorOperatorCharm(ops.CharmBase):
-    """Charm for SAML Integrator."""
+    """Charm for SAML Integrator.
+
+    Attrs:
+        on: the charm events.
+    """
+
+    on = SamlIntegratorCharmEvents()
+    _stored = ops.StoredState()
 
     def __init__(self, *args):
         """Construct.
@@ -29,62 +71,307 @@ class SamlIntegratorOperatorCharm(ops.CharmBase):
             args: Arguments passed to the CharmBase parent constructor.
         """
         super().__init__(*args)
+        TRACER.path = STATE_DIR / TRACES_FILENAME
+        # Digests of the SAML data last published, by relation ID, and the last valid configuration
+        self._stored.set_default(published_digests={}, skipped_writes=0, validated_config={})
+        self._cache = MetadataCache(STATE_DIR)
+        self._refresher = MetadataRefresher(STATE_DIR, self.charm_dir)
         self.framework.observe(self.on.install, self._on_install)
+        self.framework.observe(self.on.remove, self._on_remove)
         try:
-            self._charm_state = CharmState.from_charm(charm=self)
-            self._saml_integrator = SamlIntegrator(charm_state=self._charm_state)
+            self._charm_state = CharmState.from_charm(
+                charm=self, memo=typing.cast(dict[str, str], self._stored.validated_config)
+            )
+            self._saml_integrator = SamlIntegrator(
+                charm_state=self._charm_state, cache=self._cache
+            )
         except CharmConfigInvalidError as exc:
             self.model.unit.status = ops.BlockedStatus(exc.msg)
             return
         self.saml = saml.SamlProvides(self)
         self.framework.observe(self.on[RELATION_NAME].relation_created, self._on_relation_created)
+        self.framework.observe(self.on[RELATION_NAME].relation_changed, self._on_relation_changed)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.leader_elected, self._on_leader_elected)
+        self.framework.observe(self.on.start, self._on_start)
+        self.framework.observe(self.on.metadata_ready, self._on_metadata_ready)
         self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.refresh_metadata_action, self._on_refresh_metadata_action)
 
+    @TRACER.traced
     def _on_install(self, _) -> None:
         """Install needed apt packages."""
         self.unit.status = ops.MaintenanceStatus("Installing packages")
-        apt.add_package(["libssl-dev", "libxml2", "libxslt1-dev"], update_cache=True)
+        install_packages()
         self.unit.status = ops.ActiveStatus()
 
+    @TRACER.traced
+    def _on_remove(self, _) -> None:
+        """Remove the metadata refresher."""
+        self._refresher.remove()
+
+    @TRACER.traced
     def _on_relation_created(self, _) -> None:
         """Handle a change to the saml relation."""
-        # A new charm will be instantiated hence, the information will be fetched again.
+        # A new charm will be instantiated hence, the information will be fetched again when
+        # due, unless the refresher keeps it up to date.
         # The relation databags are rewritten in case there are changes.
-        self._update_relations()
+        self._update_relations(refresh=self._is_refresh_due())
+
+    @TRACER.traced
+    def _on_relation_changed(self, _) -> None:
+        """Handle a change to the saml relation data, such as a new requested entity."""
+        self._update_relations(refresh=self._is_refresh_due())
 
+    @TRACER.traced
     def _on_update_status(self, _) -> None:
         """Handle the update status event."""
-        # A new charm will be instantiated hence, the information will be fetched again.
+        # A new charm will be instantiated hence, the information will be fetched again when
+        # due, unless the refresher keeps it up to date.
         # The relation databags are rewritten in case there are changes.
-        self._update_relations()
+        self._update_relations(refresh=self._is_refresh_due())
+
+    @TRACER.traced
+    def _on_leader_elected(self, _) -> None:
+        """Republish the SAML data shared by the previous leader, revalidating it when due."""
+        # Other leaders may have written the databags since this unit last published them
+        self._stored.published_digests = {}
+        self._restore_shared_snapshot()
+        self._update_relations(refresh=self._is_refresh_due())
+        self._warm_snapshot()
+
+    @TRACER.traced
+    def _on_start(self, _) -> None:
+        """Warm the persisted snapshot, for the first relations to publish it right away."""
+        self._warm_snapshot()
 
+    @TRACER.traced
     def _on_config_changed(self, _) -> None:
-        """Handle changes in configuration."""
+        """Handle changes in configuration, fetching the metadata in background."""
         self.unit.status = ops.MaintenanceStatus("Configuring charm")
-        self._update_relations()
-        self.unit.status = ops.ActiveStatus()
+        self._refresher.configure(dict(self.config.items()), self._requested_entity_ids().values())
+        if self._charm_state.metadata_refresher:
+            self._refresher.install()
+        else:
+            self._refresher.remove()
+        if not self.model.unit.is_leader():
+            self.unit.status = ops.ActiveStatus()
+            return
+        # Published on metadata_ready, without holding up the hook while the IdP answers
+        self._refresher.start_fetch(self.unit.name)
+        self.unit.status = ops.MaintenanceStatus("Fetching metadata")
 
-    def _update_relations(self) -> None:
-        """Update all SAML data for the existing relations."""
+    @TRACER.traced
+    def _on_metadata_ready(self, _) -> None:
+        """Publish the metadata fetched in background."""
+        # Fetched again in the hook if the background fetch failed, to report the error instead
+        # of publishing the persisted snapshot. Dispatched through juju-exec, so an uncaught
+        # error wouldn't be visible.
+        failed = os.environ.get(REFRESH_STATUS_ENV, "0") != "0"
+        try:
+            self._update_relations(refresh=failed)
+        except CharmConfigInvalidError as exc:
+            logger.error("Publishing the metadata failed: %s", exc.msg)
+            self.unit.status = ops.BlockedStatus(exc.msg)
+
+    @TRACER.traced
+    def _on_refresh_metadata_action(self, event: ops.ActionEvent) -> None:
+        """Refresh the metadata bypassing the cache and republish it, reporting the timings.
+
+        Args:
+            event: the action event.
+        """
         if not self.model.unit.is_leader():
+            event.fail("The SAML data is only published by the leader unit")
+            return
+        self._saml_integrator = SamlIntegrator(
+            charm_state=self._charm_state, cache=self._cache, force=True
+        )
+        try:
+            with TRACER.span("refresh_metadata") as span:
+                # Fetched even without relations, persisting the snapshot
+                self._saml_integrator.entities([self._charm_state.entity_id])
+                changed = self._update_relations(force=True)
+                durations = span.durations()
+        except CharmConfigInvalidError as exc:
+            event.fail(exc.msg)
+            return
+        metadata = typing.cast(FetchedMetadata, self._saml_integrator.metadata)
+        event.set_results(
+            {
+                "bytes": len(metadata.content),
+                "changed-relations": ",".join(str(relation_id) for relation_id in changed),
+                "digest": metadata.digest,
+                "status": metadata.status,
+                "timings": {
+                    phase: round(durations.get(name, 0), 3)
+                    for phase, name in REFRESH_PHASES.items()
+                },
+            }
+        )
+
+    def _warm_snapshot(self) -> None:
+        """Fetch the metadata in background, unless the persisted snapshot is fresh."""
+        entity_ids = self._requested_entity_ids().values()
+        if not self._is_refresh_due() and self._saml_integrator.cached_entities(
+            [self._charm_state.entity_id, *entity_ids]
+        ):
+            return
+        self._refresher.configure(dict(self.config.items()), entity_ids)
+        # Skipped if a fetch started meanwhile, such as on a configuration change, was enough
+        self._refresher.start_fetch(self.unit.name, force=False)
+
+    def _is_refresh_due(self) -> bool:
+        """Check if the metadata has to be refreshed instead of publishing the persisted snapshot.
+
+        Returns:
+            True if the refresher is disabled and the metadata cache hints say it's time to.
+        """
+        return not self._charm_state.metadata_refresher and self._saml_integrator.is_refresh_due()
+
+    def _requested_entity_ids(self) -> dict[int, str]:
+        """Get the entity requested by each relation.
+
+        Returns:
+            The entity IDs, by relation ID.
+        """
+        return {
+            relation.id: self.saml.get_requested_entity_id(relation) or self._charm_state.entity_id
+            for relation in self.saml.relations
+        }
+
+    def _restore_shared_snapshot(self) -> None:
+        """Persist the SAML data shared through the peer relation if more recent than the local."""
+        relation = self.model.get_relation(PEER_RELATION_NAME)
+        content = relation.data[self.app].get(SHARED_SNAPSHOT_KEY) if relation else None
+        if not content:
+            return
+        try:
+            shared = SharedSnapshot.parse_raw(content)
+        except ValidationError:
+            logger.warning("Ignoring invalid SAML data shared through the peer relation")
+            return
+        if self._cache.restore_shared(shared):
+            logger.info("Restored the SAML data fetched at %s", shared.snapshot.fetched_at)
+
+    def _share_snapshot(self, extracted: dict[str, ExtractedSamlData]) -> None:
+        """Share the persisted snapshot through the peer relation, for the next leader.
+
+        Args:
+            extracted: the SAML data published, by entity ID.
+        """
+        relation = self.model.get_relation(PEER_RELATION_NAME)
+        snapshot = self._cache.load_snapshot()
+        if not relation or not snapshot:
             return
+        content = SharedSnapshot(
+            snapshot=snapshot,
+            extracted=[
+                data
+                for entity_id, data in sorted(extracted.items())
+                if entity_id != snapshot.entity_id
+            ],
+        ).json()
+        if relation.data[self.app].get(SHARED_SNAPSHOT_KEY) != content:
+            relation.data[self.app][SHARED_SNAPSHOT_KEY] = content
+
+    def _update_relations(self, refresh: bool = True, force: bool = False) -> list[int]:
+        """Update all SAML data for the existing relations.
+
+        Args:
+            refresh: whether to refresh the metadata, instead of publishing the persisted snapshot
+                if it holds the data of all the requested entities.
+            force: whether to write the data of the relations whose published data is unchanged.
+
+        Returns:
+            The IDs of the relations whose data changed.
+        """
+        if not self.model.unit.is_leader():
+            # The databags may be written by another leader meanwhile
+            self._stored.published_digests = {}
+            # Clears the status left if the leadership was lost while fetching the metadata
+            self.unit.status = ops.ActiveStatus()
+            return []
+        try:
+            return self._publish_relations(refresh, force)
+        finally:
+            # Flushed even if the fetch failed, to expose the time spent on it
+            RECORDER.flush(STATE_DIR)
+
+    def _publish_relations(self, refresh: bool, force: bool) -> list[int]:
+        """Publish the SAML data requested by each relation, skipping the unchanged ones.
+
+        Args:
+            refresh: whether to refresh the metadata, instead of publishing the persisted snapshot
+                if it holds the data of all the requested entities.
+            force: whether to write the data of the relations whose published data is unchanged.
+
+        Returns:
+            The IDs of the relations whose data changed.
+        """
+        entity_ids = self._requested_entity_ids()
+        if self._charm_state.metadata_refresher:
+            self._refresher.configure(dict(self.config.items()), entity_ids.values())
+        # All the requested entities are extracted from a single metadata fetch
+        extracted = (
+            None if refresh else self._saml_integrator.cached_entities(entity_ids.values())
+        ) or self._saml_integrator.entities(entity_ids.values())
+        previous_digests = typing.cast(dict[str, str], self._stored.published_digests)
+        published_digests = {}
+        changed = []
+        skipped_writes = 0
         for relation in self.saml.relations:
-            self.saml.update_relation_data(relation, self.get_saml_data())
+            saml_data = self.get_saml_data(entity_ids[relation.id])
+            digest = hashlib.sha256(
+                json.dumps(saml_data.to_relation_data(), sort_keys=True).encode("utf-8")
+            ).hexdigest()
+            if not force and previous_digests.get(str(relation.id)) == digest:
+                skipped_writes += 1
+                RECORDER.inc(RELATION_UPDATES, result="skipped")
+            else:
+                with TRACER.span("SamlProvides.update_relation_data", relation_id=relation.id):
+                    if self.saml.update_relation_data(relation, saml_data):
+                        changed.append(relation.id)
+                RECORDER.inc(RELATION_UPDATES, result="written")
+            published_digests[str(relation.id)] = digest
+        self._stored.published_digests = published_digests
+        if skipped_writes:
+            total_skipped_writes = typing.cast(int, self._stored.skipped_writes) + skipped_writes
+            self._stored.skipped_writes = total_skipped_writes
+            logger.info(
+                "Skipped %d unchanged relation data writes, %d in total",
+                skipped_writes,
+                total_skipped_writes,
+            )
+        self._share_snapshot(extracted)
+        expired = sorted(entity_id for entity_id, data in extracted.items() if data.is_expired())
+        self.unit.status = (
+            ops.BlockedStatus(f"Expired metadata for {', '.join(expired)}")
+            if expired
+            else ops.ActiveStatus()
+        )
+        return changed
 
-    def get_saml_data(self) -> saml.SamlRelationData:
+    def get_saml_data(self, entity_id: typing.Optional[str] = None) -> saml.SamlRelationData:
         """Get relation data.
 
+        Args:
+            entity_id: the entity to get the data for, the configured one by default.
+
         Returns:
             SamlRelationData containing the IdP details.
         """
+        entity_id = entity_id or self._charm_state.entity_id
+        extracted = self._saml_integrator.entities([entity_id])[entity_id]
         return saml.SamlRelationData(
-            entity_id=self._charm_state.entity_id,
+            entity_id=entity_id,
             metadata_url=self._charm_state.metadata_url,
-            certificates=self._saml_integrator.certificates,
-            endpoints=self._saml_integrator.endpoints,
+            certificates=extracted.certificates,
+            endpoints=extracted.endpoints,
         )
 
 
 if __name__ == "__main__":  # pragma: nocover
-    main(SamlIntegratorOperatorCharm)
+    # A single trace for the whole hook, the charm setting where it's exported
+    with TRACER.span(os.environ.get("JUJU_DISPATCH_PATH", "dispatch")):
+        main(SamlIntegratorOperatorCharm)
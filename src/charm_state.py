@@ -5,11 +5,19 @@
 
 """Module defining the CharmState class which represents the state of the SAML Integrator charm."""
 
+import hashlib
 import itertools
-from typing import Optional
+import json
+from typing import Any, MutableMapping, Optional
 
 import ops
-from pydantic import AnyHttpUrl, BaseModel, Field, ValidationError
+from pydantic import AnyHttpUrl, BaseModel, Field, ValidationError, validator
+
+from tracing import TRACER
+
+# Part of the key of the memoized configurations, to be increased whenever the validation rules
+# change so that the configuration is validated again after an upgrade
+CONFIG_SCHEMA_VERSION = 1
 
 
 class SamlIntegratorConfig(BaseModel):  # pylint: disable=too-few-public-methods
@@ -18,12 +26,124 @@ class SamlIntegratorConfig(BaseModel):  # pylint: disable=too-few-public-methods
     Attrs:
         entity_id: Entity ID.
         fingerprint: fingerprint to validate the signing certificate against.
-        metadata_url: Metadata URL.
+        metadata_max_refresh_interval: maximum seconds between two metadata refreshes.
+        metadata_max_size: maximum size of the metadata, in MiB.
+        metadata_min_refresh_interval: minimum seconds between two metadata refreshes.
+        metadata_refresh_interval: seconds between two metadata refreshes without cacheDuration.
+        metadata_refresher: whether the metadata is refreshed by a systemd timer.
+        metadata_streaming: whether to extract the entity reading the metadata incrementally.
+        metadata_urls: Metadata URL, followed by the URLs of its mirrors.
     """
 
     entity_id: str = Field(..., min_length=1)
     fingerprint: Optional[str]
-    metadata_url: AnyHttpUrl
+    metadata_max_refresh_interval: int = Field(86400, ge=0)
+    metadata_max_size: int = Field(128, gt=0)
+    metadata_min_refresh_interval: int = Field(300, ge=0)
+    metadata_refresh_interval: int = Field(3600, ge=0)
+    metadata_refresher: bool = False
+    metadata_streaming: bool = False
+    metadata_urls: tuple[AnyHttpUrl, ...] = Field(..., alias="metadata_url")
+
+    @validator("fingerprint")
+    @classmethod
+    def normalize_fingerprint(cls, value: Optional[str]) -> Optional[str]:
+        """Normalize the fingerprint to lowercase hexadecimal digits, as computed.
+
+        Args:
+            value: fingerprint value, optionally with colons or spaces.
+
+        Returns:
+            The normalized fingerprint.
+        """
+        return "".join(value.replace(":", "").split()).lower() if value else value
+
+    @validator("metadata_urls", pre=True)
+    @classmethod
+    def split_metadata_urls(cls, value: Any) -> Any:
+        """Split the metadata URL and its mirrors, separated by whitespace.
+
+        Commas are valid in URLs, so they don't separate them.
+
+        Args:
+            value: metadata_url value.
+
+        Returns:
+            The list of URLs.
+
+        Raises:
+            ValueError: if no URL is provided.
+        """
+        urls = value.split() if isinstance(value, str) else value
+        if not urls:
+            raise ValueError("at least one metadata URL is required")
+        return urls
+
+    @validator("metadata_min_refresh_interval")
+    @classmethod
+    def min_refresh_interval_below_max(cls, value: int, values: dict) -> int:
+        """Check that the minimum refresh interval doesn't exceed the maximum.
+
+        Args:
+            value: metadata_min_refresh_interval value.
+            values: values of the fields validated so far.
+
+        Returns:
+            The metadata_min_refresh_interval value.
+
+        Raises:
+            ValueError: if the minimum refresh interval exceeds the maximum.
+        """
+        maximum = values.get("metadata_max_refresh_interval")
+        if maximum is not None and value > maximum:
+            raise ValueError("the minimum refresh interval exceeds the maximum")
+        return value
+
+    @validator("metadata_streaming")
+    @classmethod
+    def streaming_without_fingerprint(cls, value: bool, values: dict) -> bool:
+        """Check that streaming is not enabled when the signature needs to be validated.
+
+        Args:
+            value: metadata_streaming value.
+            values: values of the fields validated so far.
+
+        Returns:
+            The metadata_streaming value.
+
+        Raises:
+            ValueError: if both streaming and fingerprint are set.
+        """
+        if value and values.get("fingerprint"):
+            raise ValueError("the metadata signature can't be validated while streaming")
+        return value
+
+    @classmethod
+    def from_validated(cls, content: str) -> "SamlIntegratorConfig":
+        """Load a configuration serialized once validated, without validating it again.
+
+        Args:
+            content: the JSON serialized configuration.
+
+        Returns:
+            The configuration.
+        """
+        fields = json.loads(content)
+        fields["metadata_urls"] = tuple(fields["metadata_urls"])
+        return cls.construct(**fields)
+
+
+def config_digest(config: dict[str, Any]) -> str:
+    """Compute a digest identifying a charm configuration and the rules validating it.
+
+    Args:
+        config: the charm configuration.
+
+    Returns:
+        The hexadecimal digest.
+    """
+    content = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(f"{CONFIG_SCHEMA_VERSION}:{content}".encode("utf-8")).hexdigest()
 
 
 class CharmConfigInvalidError(Exception):
@@ -48,7 +168,14 @@ class CharmState:
     Attrs:
         entity_id: Entity ID for SAML.
         fingerprint: fingerprint to validate the signing certificate against.
+        metadata_max_refresh_interval: maximum seconds between two SAML metadata refreshes.
+        metadata_max_size: maximum size of the SAML metadata, in MiB.
+        metadata_min_refresh_interval: minimum seconds between two SAML metadata refreshes.
+        metadata_refresh_interval: seconds between two SAML metadata refreshes by default.
+        metadata_refresher: whether the SAML metadata is refreshed by a systemd timer.
+        metadata_streaming: whether to extract the entity reading the metadata incrementally.
         metadata_url: URL for the SAML metadata.
+        metadata_urls: URLs for the SAML metadata, the first one followed by its mirrors.
     """
 
     def __init__(self, *, saml_integrator_config: SamlIntegratorConfig):
@@ -77,6 +204,60 @@ class CharmState:
         """
         return self._saml_integrator_config.fingerprint
 
+    @property
+    def metadata_max_refresh_interval(self) -> int:
+        """Return metadata_max_refresh_interval config.
+
+        Returns:
+            int: metadata_max_refresh_interval config.
+        """
+        return self._saml_integrator_config.metadata_max_refresh_interval
+
+    @property
+    def metadata_max_size(self) -> int:
+        """Return metadata_max_size config.
+
+        Returns:
+            int: metadata_max_size config.
+        """
+        return self._saml_integrator_config.metadata_max_size
+
+    @property
+    def metadata_min_refresh_interval(self) -> int:
+        """Return metadata_min_refresh_interval config.
+
+        Returns:
+            int: metadata_min_refresh_interval config.
+        """
+        return self._saml_integrator_config.metadata_min_refresh_interval
+
+    @property
+    def metadata_refresh_interval(self) -> int:
+        """Return metadata_refresh_interval config.
+
+        Returns:
+            int: metadata_refresh_interval config.
+        """
+        return self._saml_integrator_config.metadata_refresh_interval
+
+    @property
+    def metadata_refresher(self) -> bool:
+        """Return metadata_refresher config.
+
+        Returns:
+            bool: metadata_refresher config.
+        """
+        return self._saml_integrator_config.metadata_refresher
+
+    @property
+    def metadata_streaming(self) -> bool:
+        """Return metadata_streaming config.
+
+        Returns:
+            bool: metadata_streaming config.
+        """
+        return self._saml_integrator_config.metadata_streaming
+
     @property
     def metadata_url(self) -> str:
         """Return metadata_url config.
@@ -84,14 +265,29 @@ class CharmState:
         Returns:
             str: metadata_url config.
         """
-        return self._saml_integrator_config.metadata_url
+        return self._saml_integrator_config.metadata_urls[0]
+
+    @property
+    def metadata_urls(self) -> tuple[str, ...]:
+        """Return the metadata URL followed by its mirrors.
+
+        Returns:
+            tuple: metadata_url config and mirrors.
+        """
+        return self._saml_integrator_config.metadata_urls
 
     @classmethod
-    def from_charm(cls, charm: "ops.CharmBase") -> "CharmState":
+    @TRACER.traced
+    def from_charm(
+        cls, charm: "ops.CharmBase", memo: Optional[MutableMapping[str, str]] = None
+    ) -> "CharmState":
         """Initialize a new instance of the CharmState class from the associated charm.
 
+        The configuration is only validated when it differs from the one memoized, if any.
+
         Args:
             charm: The charm instance associated with this state.
+            memo: the last valid configuration and its digest, persisted across hooks.
 
         Return:
             The CharmState instance created by the provided charm.
@@ -99,13 +295,25 @@ class CharmState:
         Raises:
             CharmConfigInvalidError: if the charm configuration is invalid.
         """
+        config = dict(charm.config.items())
+        digest = config_digest(config)
+        if memo is not None and memo.get("digest") == digest:
+            try:
+                return cls(
+                    saml_integrator_config=SamlIntegratorConfig.from_validated(memo["config"])
+                )
+            except (KeyError, TypeError, ValueError):
+                pass
         try:
             # Incompatible with pydantic.AnyHttpUrl
-            valid_config = SamlIntegratorConfig(**dict(charm.config.items()))  # type: ignore
+            valid_config = SamlIntegratorConfig(**config)  # type: ignore
         except ValidationError as exc:
             error_fields = set(
                 itertools.chain.from_iterable(error["loc"] for error in exc.errors())
             )
             error_field_str = " ".join(str(f) for f in error_fields)
             raise CharmConfigInvalidError(f"invalid configuration: {error_field_str}") from exc
+        if memo is not None:
+            memo["digest"] = digest
+            memo["config"] = valid_config.json()
         return cls(saml_integrator_config=valid_config)
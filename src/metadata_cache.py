@@ -0,0 +1,468 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the MetadataCache class to persist the SAML data across hooks."""
+import hashlib
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Optional, cast
+
+from charms.saml_integrator.v0 import saml
+from pydantic import BaseModel, ValidationError
+
+from metrics import CACHE_REQUESTS, RECORDER
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILENAME = "metadata-snapshot.json"
+EXTRACTED_DIRNAME = "extracted"
+MAX_EXTRACTED_ENTRIES = 32
+VERDICTS_FILENAME = "signature-verdicts.json"
+MAX_VERIFIED_SIGNATURES = 16
+DOCUMENTS_DIRNAME = "documents"
+# Time before validUntil from which the metadata is refreshed as often as allowed
+VALID_UNTIL_MARGIN = timedelta(hours=1)
+
+
+class ExtractedSamlData(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent the SAML data extracted from a metadata document.
+
+    Attrs:
+        digest: SHA-256 of the raw metadata the data was extracted from.
+        entity_id: Entity ID the data was extracted for.
+        fingerprint: fingerprint the signing certificate was validated against.
+        certificates: public certificates.
+        endpoints: SAML endpoints.
+        valid_until: expiration of the metadata, as declared by its validUntil attributes.
+        cache_duration: time the metadata can be cached, as declared by its cacheDuration
+            attributes.
+        streamed: whether the data was extracted while streaming, without verifying the
+            signature of the metadata.
+    """
+
+    digest: Optional[str]
+    entity_id: str
+    fingerprint: Optional[str]
+    certificates: list[str]
+    endpoints: list[saml.SamlEndpoint]
+    valid_until: Optional[datetime] = None
+    cache_duration: Optional[timedelta] = None
+    streamed: bool = False
+
+    def is_expired(self, now: Optional[datetime] = None) -> bool:
+        """Check if the metadata the data was extracted from has expired.
+
+        Args:
+            now: the current time, by default the actual one.
+
+        Returns:
+            True if the metadata declares a validUntil time which has passed.
+        """
+        return bool(self.valid_until and self.valid_until <= (now or datetime.now(timezone.utc)))
+
+
+class MetadataSnapshot(ExtractedSamlData):  # pylint: disable=too-few-public-methods
+    """Represent the SAML data extracted from the last successful metadata fetch.
+
+    Attrs:
+        metadata_url: URL the metadata was fetched from.
+        etag: ETag validator returned by the server, if any.
+        last_modified: Last-Modified validator returned by the server, if any.
+        fetched_at: time the metadata was last fetched or revalidated.
+    """
+
+    metadata_url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: Optional[datetime] = None
+
+    def next_refresh(
+        self, refresh_interval: timedelta, min_interval: timedelta, max_interval: timedelta
+    ) -> datetime:
+        """Get the time by which the metadata has to be refreshed.
+
+        The metadata is refreshed once its cacheDuration has elapsed, or as often as allowed
+        once its validUntil is near. Without a cacheDuration the refresh interval is used. The
+        interval is always kept between the minimum and the maximum.
+
+        Args:
+            refresh_interval: time between two refreshes if the metadata has no cacheDuration.
+            min_interval: minimum time between two refreshes.
+            max_interval: maximum time between two refreshes.
+
+        Returns:
+            The time of the next refresh.
+        """
+        if self.fetched_at is None:
+            return datetime.min.replace(tzinfo=timezone.utc)
+        cache_duration = refresh_interval if self.cache_duration is None else self.cache_duration
+        interval = min(max(cache_duration, min_interval), max_interval)
+        refresh_at = self.fetched_at + interval
+        if self.valid_until:
+            refresh_at = min(refresh_at, self.valid_until - VALID_UNTIL_MARGIN)
+        return max(refresh_at, self.fetched_at + min_interval)
+
+    def matches(
+        self,
+        metadata_url: str,
+        entity_id: str,
+        fingerprint: Optional[str],
+        streaming: bool = False,
+    ) -> bool:
+        """Check if the snapshot was extracted for the given configuration.
+
+        Args:
+            metadata_url: URL to the metadata.
+            entity_id: Entity ID.
+            fingerprint: fingerprint to validate the signing certificate against.
+            streaming: whether the metadata is streamed, so unverified data can be reused.
+
+        Returns:
+            True if the snapshot can be reused for the configuration.
+        """
+        return (
+            self.metadata_url == str(metadata_url)
+            and self.entity_id == entity_id
+            and (self.fingerprint or None) == (fingerprint or None)
+            and (streaming or not self.streamed)
+        )
+
+
+class SharedSnapshot(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent the SAML data shared by the leader with the other units through the peer relation.
+
+    Attrs:
+        snapshot: the snapshot of the last successful fetch.
+        extracted: the data extracted from the same metadata for the other requested entities.
+    """
+
+    snapshot: MetadataSnapshot
+    extracted: list[ExtractedSamlData] = []
+
+
+class SignatureVerdicts(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent the signature verifications already performed.
+
+    Attrs:
+        verified: keys of the verified signatures, most recent last.
+        hits: number of verifications skipped.
+        misses: number of verifications performed.
+    """
+
+    verified: list[str] = []
+    hits: int = 0
+    misses: int = 0
+
+
+class EntityIndex(BaseModel):  # pylint: disable=too-few-public-methods
+    """Represent the location of each entity in a raw metadata aggregate.
+
+    Attrs:
+        digest: SHA-256 of the raw metadata.
+        root: offset and length of the start tag of the root EntitiesDescriptor.
+        root_name: qualified name of the root element.
+        signing_certificate: signing certificate of the metadata, if any.
+        signed: whether the metadata has a Signature element.
+        entities: offset and length of each EntityDescriptor, by entity ID.
+    """
+
+    digest: str
+    root: tuple[int, int]
+    root_name: str
+    signing_certificate: Optional[str]
+    signed: bool
+    entities: dict[str, tuple[int, int]]
+
+
+class MetadataCache:
+    """Unit-local storage for the SAML data extracted from the metadata.
+
+    Besides the snapshot of the last fetch, the data extracted from the most recently used
+    metadata documents is kept, keyed by the SHA-256 of their contents and the entity ID, so
+    that a document already seen doesn't need to be parsed and verified again. The signature
+    verification verdicts are also kept, keyed by the document digest, signing certificate and
+    fingerprint.
+    Finally, the most recent raw metadata is kept together with the index of its entities.
+
+    Attrs:
+        cache_dir: directory where the data is persisted.
+        verdicts: the signature verifications already performed.
+    """
+
+    def __init__(self, cache_dir: Path):
+        """Initialize a new instance of the MetadataCache class.
+
+        Args:
+            cache_dir: directory where the data is persisted.
+        """
+        self.cache_dir = cache_dir
+
+    def _write(self, filename: str, content: str | bytes) -> None:
+        """Atomically write a file in the cache directory.
+
+        Args:
+            filename: name of the file, relative to the cache directory.
+            content: file contents.
+        """
+        path = self.cache_dir / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wb" if isinstance(content, bytes) else "w",
+            dir=path.parent,
+            prefix=f".{path.name}.",
+            delete=False,
+        ) as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_file.name, path)
+
+    def load_snapshot(self) -> Optional[MetadataSnapshot]:
+        """Load the last persisted snapshot.
+
+        Returns:
+            The snapshot or None if there's no valid one.
+        """
+        try:
+            return MetadataSnapshot.parse_file(self.cache_dir / SNAPSHOT_FILENAME)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, ValidationError):
+            logger.warning("Ignoring unreadable metadata snapshot in %s", self.cache_dir)
+            return None
+
+    def save_snapshot(self, snapshot: MetadataSnapshot) -> None:
+        """Persist a snapshot.
+
+        Args:
+            snapshot: the snapshot to persist.
+        """
+        self._write(SNAPSHOT_FILENAME, snapshot.json())
+
+    def restore_shared(self, shared: SharedSnapshot) -> bool:
+        """Persist the SAML data shared by another unit, unless the local snapshot is as recent.
+
+        Args:
+            shared: the shared SAML data.
+
+        Returns:
+            True if the shared data was persisted.
+        """
+        local = self.load_snapshot()
+        never = datetime.min.replace(tzinfo=timezone.utc)
+        if local and (local.fetched_at or never) >= (shared.snapshot.fetched_at or never):
+            return False
+        for extracted in shared.extracted:
+            if extracted.digest == shared.snapshot.digest:
+                self.save_extracted(extracted)
+        self.save_snapshot(shared.snapshot)
+        return True
+
+    def _extracted_filename(self, digest: str, entity_id: str) -> str:
+        """Get the name of the file holding the data extracted for an entity.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+            entity_id: Entity ID the data is extracted for.
+
+        Returns:
+            The file name, relative to the cache directory.
+        """
+        entity_key = hashlib.sha256(entity_id.encode("utf-8")).hexdigest()[:16]
+        return f"{EXTRACTED_DIRNAME}/{digest}-{entity_key}.json"
+
+    def load_extracted(
+        self, digest: str, entity_id: str, fingerprint: Optional[str], streaming: bool = False
+    ) -> Optional[ExtractedSamlData]:
+        """Load the data extracted for an entity from a metadata document.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+            entity_id: Entity ID the data has to be extracted for.
+            fingerprint: fingerprint the signing certificate has to be validated against.
+            streaming: whether the metadata is streamed, so the data extracted without verifying
+                the signature can be reused.
+
+        Returns:
+            The extracted data or None if the document wasn't seen for this configuration.
+        """
+        path = self.cache_dir / self._extracted_filename(digest, entity_id)
+        try:
+            extracted = ExtractedSamlData.parse_file(path)
+        except FileNotFoundError:
+            RECORDER.inc(CACHE_REQUESTS, cache="extracted", result="miss")
+            return None
+        except (OSError, ValueError, ValidationError):
+            logger.warning("Ignoring unreadable extracted data in %s", path)
+            RECORDER.inc(CACHE_REQUESTS, cache="extracted", result="miss")
+            return None
+        if extracted.digest != digest or not (
+            extracted.entity_id == entity_id
+            and (extracted.fingerprint or None) == (fingerprint or None)
+            and (streaming or not extracted.streamed)
+        ):
+            RECORDER.inc(CACHE_REQUESTS, cache="extracted", result="miss")
+            return None
+        RECORDER.inc(CACHE_REQUESTS, cache="extracted", result="hit")
+        # The modification time tracks the last use for the LRU eviction
+        os.utime(path)
+        return extracted
+
+    def save_extracted(self, extracted: ExtractedSamlData) -> None:
+        """Persist the data extracted from a metadata document, evicting the least recently used.
+
+        The data extracted from the same document is never evicted, as all the entities it was
+        extracted for are still requested, however many they are.
+
+        Args:
+            extracted: the extracted data.
+        """
+        digest = cast(str, extracted.digest)
+        self._write(self._extracted_filename(digest, extracted.entity_id), extracted.json())
+        entries = sorted(
+            (self.cache_dir / EXTRACTED_DIRNAME).glob("*.json"),
+            key=lambda path: path.stat().st_mtime,
+            reverse=True,
+        )
+        current = [path for path in entries if path.name.startswith(f"{digest}-")]
+        others = [path for path in entries if not path.name.startswith(f"{digest}-")]
+        kept = max(MAX_EXTRACTED_ENTRIES - len(current), 0)
+        for path in others[kept:]:
+            path.unlink(missing_ok=True)
+
+    @property
+    def verdicts(self) -> SignatureVerdicts:
+        """Load the signature verifications already performed.
+
+        Returns:
+            The signature verdicts.
+        """
+        try:
+            return SignatureVerdicts.parse_file(self.cache_dir / VERDICTS_FILENAME)
+        except FileNotFoundError:
+            return SignatureVerdicts()
+        except (OSError, ValueError, ValidationError):
+            logger.warning("Ignoring unreadable signature verdicts in %s", self.cache_dir)
+            return SignatureVerdicts()
+
+    @staticmethod
+    def _verdict_key(digest: str, signing_certificate: str, fingerprint: Optional[str]) -> str:
+        """Get the key identifying a signature verification.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+            signing_certificate: certificate the signature was verified with.
+            fingerprint: fingerprint the signing certificate was validated against.
+
+        Returns:
+            The verdict key.
+        """
+        return hashlib.sha256(
+            "\0".join((digest, signing_certificate, fingerprint or "")).encode("utf-8")
+        ).hexdigest()
+
+    def is_signature_verified(
+        self,
+        digest: str,
+        signing_certificate: str,
+        fingerprint: Optional[str],
+        count_miss: bool = True,
+    ) -> bool:
+        """Check if the signature of a document was already verified, counting hits and misses.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+            signing_certificate: certificate the signature is verified with.
+            fingerprint: fingerprint the signing certificate is validated against.
+            count_miss: whether a miss has to be counted, as the verification will be performed.
+
+        Returns:
+            True if the same verification already succeeded.
+        """
+        verdicts = self.verdicts
+        verified = self._verdict_key(digest, signing_certificate, fingerprint) in verdicts.verified
+        if verified:
+            verdicts.hits += 1
+        elif count_miss:
+            verdicts.misses += 1
+        else:
+            return False
+        RECORDER.inc(CACHE_REQUESTS, cache="signature", result="hit" if verified else "miss")
+        self._write(VERDICTS_FILENAME, verdicts.json())
+        return verified
+
+    def record_signature_verified(
+        self, digest: str, signing_certificate: str, fingerprint: Optional[str]
+    ) -> None:
+        """Record a successful signature verification.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+            signing_certificate: certificate the signature was verified with.
+            fingerprint: fingerprint the signing certificate was validated against.
+        """
+        verdicts = self.verdicts
+        key = self._verdict_key(digest, signing_certificate, fingerprint)
+        verdicts.verified = [verified for verified in verdicts.verified if verified != key] + [key]
+        verdicts.verified = verdicts.verified[-MAX_VERIFIED_SIGNATURES:]
+        self._write(VERDICTS_FILENAME, verdicts.json())
+
+    def has_document(self, digest: str) -> bool:
+        """Check if a raw metadata document is cached.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+
+        Returns:
+            True if the document is cached.
+        """
+        return (self.cache_dir / DOCUMENTS_DIRNAME / f"{digest}.xml").exists()
+
+    def save_document(self, digest: str, raw_data: bytes, index: Optional[EntityIndex]) -> None:
+        """Persist a raw metadata document and its entity index, replacing the previous one.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+            raw_data: the raw metadata.
+            index: location of the entities in the raw metadata, if it's an aggregate.
+        """
+        self._write(f"{DOCUMENTS_DIRNAME}/{digest}.xml", raw_data)
+        if index:
+            self._write(f"{DOCUMENTS_DIRNAME}/{digest}.index.json", index.json())
+        for path in (self.cache_dir / DOCUMENTS_DIRNAME).iterdir():
+            if not path.name.startswith(f"{digest}."):
+                path.unlink(missing_ok=True)
+
+    def load_document(self, digest: str) -> Optional[bytes]:
+        """Load a raw metadata document.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+
+        Returns:
+            The raw metadata or None if it's not cached.
+        """
+        try:
+            return (self.cache_dir / DOCUMENTS_DIRNAME / f"{digest}.xml").read_bytes()
+        except OSError:
+            return None
+
+    def load_index(self, digest: str) -> Optional[EntityIndex]:
+        """Load the entity index of a raw metadata document.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+
+        Returns:
+            The entity index or None if there's no valid one.
+        """
+        path = self.cache_dir / DOCUMENTS_DIRNAME / f"{digest}.index.json"
+        try:
+            index = EntityIndex.parse_file(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, ValidationError):
+            logger.warning("Ignoring unreadable entity index in %s", path)
+            return None
+        return index if index.digest == digest else None
@@ -0,0 +1,452 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the MetadataFetcher class to download the metadata within a deadline."""
+import concurrent.futures
+import contextvars
+import hashlib
+import logging
+import queue
+import random
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from functools import partial
+from typing import Callable, Iterator, NamedTuple, Optional, Sequence, TypeVar, cast
+
+from charm_state import CharmConfigInvalidError
+from metadata_cache import MetadataSnapshot
+from metrics import DOWNLOADED_BYTES, FETCH_DURATION, RECORDER
+from tracing import TRACER
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+ACCEPT_ENCODING = "gzip, deflate"
+READ_CHUNK_SIZE = 64 * 1024
+# Bytes of metadata kept in memory while downloading before spooling it to disk
+SPOOL_MEMORY_SIZE = 1024 * 1024
+MAX_METADATA_SIZE = 128 * 1024 * 1024
+# Seconds allowed for all the metadata downloads of a hook, retries included
+FETCH_DEADLINE = 30.0
+# Seconds allowed for each socket operation
+FETCH_SOCKET_TIMEOUT = 10.0
+MAX_FETCH_ATTEMPTS = 3
+# Seconds of the first retry backoff, doubled on each retry
+FETCH_RETRY_BACKOFF = 0.5
+TRANSIENT_HTTP_ERRORS = frozenset({408, 425, 429, 500, 502, 503, 504})
+# Seconds to wait for a mirror before requesting the next one
+MIRROR_HEDGE_DELAY = 1.0
+
+Validators = dict[str, Optional[str]]
+
+
+class FetchedMetadata(NamedTuple):
+    """Metadata downloaded from its URL or one of its mirrors.
+
+    Attrs:
+        content: the raw metadata.
+        digest: SHA-256 of the raw metadata.
+        validators: the ETag and Last-Modified of the response.
+        status: the HTTP status of the response, if downloaded.
+    """
+
+    content: bytes
+    digest: str
+    validators: Validators
+    status: Optional[int] = None
+
+
+class MetadataNotModifiedError(Exception):
+    """Exception raised when the metadata hasn't been modified since it was last fetched."""
+
+
+class MetadataTooLargeError(CharmConfigInvalidError):
+    """Exception raised when the metadata exceeds the maximum size."""
+
+
+class TransientFetchError(CharmConfigInvalidError):
+    """Exception raised when the metadata can't be retrieved due to an error worth retrying."""
+
+
+def _read_chunks(resource, deadline: float) -> Iterator[bytes]:
+    """Read the body of an HTTP response in chunks, giving up once the deadline has passed.
+
+    Args:
+        resource: the HTTP response.
+        deadline: monotonic time by which the body has to be read.
+
+    Yields:
+        The chunks of the body.
+
+    Raises:
+        TimeoutError: if the deadline has passed.
+    """
+    for chunk in iter(partial(resource.read, READ_CHUNK_SIZE), b""):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Deadline exceeded while reading the response")
+        RECORDER.inc(DOWNLOADED_BYTES, len(chunk))
+        yield chunk
+
+
+def _decode_chunks(resource, deadline: float, limit: int) -> Iterator[bytes]:
+    """Read the body of an HTTP response in chunks, decompressing them while they're received.
+
+    Args:
+        resource: the HTTP response.
+        deadline: monotonic time by which the body has to be read.
+        limit: bytes after which the decompression stops, bounding the memory used by a bomb.
+
+    Yields:
+        The decoded chunks of the body.
+
+    Raises:
+        ValueError: if the content encoding is not supported or the body can't be decompressed.
+    """
+    encoding = (resource.headers.get("Content-Encoding") or "identity").strip().lower()
+    if encoding == "identity":
+        yield from _read_chunks(resource, deadline)
+        return
+    if encoding not in ("gzip", "x-gzip", "deflate"):
+        raise ValueError(f"Unsupported content encoding {encoding}")
+    # Detect the gzip or zlib header automatically
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    decoded = 0
+    for position, chunk in enumerate(_read_chunks(resource, deadline)):
+        try:
+            data = decompressor.decompress(chunk, max(limit - decoded, 0) + 1)
+        except zlib.error as ex:
+            if encoding != "deflate" or position:
+                raise ValueError("Invalid compressed data") from ex
+            # Some servers send raw deflate data without the zlib header
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = decompressor.decompress(chunk, max(limit - decoded, 0) + 1)
+        decoded += len(data)
+        yield data
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed data")
+
+
+def _read_body(resource, deadline: float, max_size: int) -> tuple[bytes, str]:
+    """Read the body of an HTTP response, hashing it while it's being received.
+
+    The body is spooled to a temporary file once it outgrows SPOOL_MEMORY_SIZE, so only the
+    final copy of the body is held in memory.
+
+    Args:
+        resource: the HTTP response.
+        deadline: monotonic time by which the body has to be read.
+        max_size: maximum size of the decoded body, in bytes.
+
+    Returns:
+        The decoded body and its SHA-256.
+
+    Raises:
+        MetadataTooLargeError: if the body exceeds the maximum size.
+    """
+    length = resource.headers.get("Content-Length")
+    if (
+        not resource.headers.get("Content-Encoding")
+        and length
+        and length.isdigit()
+        and int(length) > max_size
+    ):
+        raise MetadataTooLargeError(f"The metadata exceeds the maximum size of {max_size} bytes")
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE) as spool:
+        for chunk in _decode_chunks(resource, deadline, max_size):
+            size += len(chunk)
+            if size > max_size:
+                raise MetadataTooLargeError(
+                    f"The metadata exceeds the maximum size of {max_size} bytes"
+                )
+            digest.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+        return spool.read(), digest.hexdigest()
+
+
+def _request(
+    request: urllib.request.Request, timeout: float, deadline: float, max_size: int
+) -> FetchedMetadata:
+    """Send an HTTP request for the metadata.
+
+    Args:
+        request: the HTTP request.
+        timeout: seconds allowed for each socket operation.
+        deadline: monotonic time by which the body has to be read.
+        max_size: maximum size of the metadata, in bytes.
+
+    Returns:
+        The downloaded metadata.
+    """
+    # Includes the name resolution, the connection and TLS handshakes and the response headers
+    with TRACER.span("http.request", url=request.full_url), urllib.request.urlopen(
+        request, timeout=timeout
+    ) as resource:  # nosec
+        with TRACER.span("http.read_body") as span:
+            content, digest = _read_body(resource, deadline, max_size)
+            span.set_attribute("size", len(content))
+        return FetchedMetadata(
+            content,
+            digest,
+            {
+                "etag": resource.headers.get("ETag"),
+                "last_modified": resource.headers.get("Last-Modified"),
+            },
+            resource.getcode(),
+        )
+
+
+def call_with_deadline(function: Callable[[], T], timeout: float) -> T:
+    """Call a blocking function in a daemon thread, abandoning it once the timeout expires.
+
+    The exceptions raised by the function are raised again in the caller.
+
+    Args:
+        function: the function to call.
+        timeout: seconds to wait for the function to return.
+
+    Returns:
+        The value returned by the function.
+    """
+    future: concurrent.futures.Future = concurrent.futures.Future()
+
+    def run() -> None:
+        """Call the function, reporting the outcome."""
+        try:
+            future.set_result(function())
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            future.set_exception(ex)
+
+    # The spans started by the function are nested in the current one
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+    return future.result(timeout=max(timeout, 0))
+
+
+class MetadataFetcher:
+    """Download the metadata from its URL or its mirrors within a deadline.
+
+    The deadline applies to all the downloads performed by the instance, retries included, and
+    starts with the first one.
+
+    Attrs:
+        urls: URL of the metadata, followed by the URLs of its mirrors.
+        max_size: maximum size of the metadata, in bytes.
+    """
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        check: Optional[Callable[[FetchedMetadata], None]] = None,
+        max_size: int = MAX_METADATA_SIZE,
+    ):
+        """Initialize a new instance of the MetadataFetcher class.
+
+        Args:
+            urls: URL of the metadata, followed by the URLs of its mirrors.
+            check: function rejecting a mirror response by raising a CharmConfigInvalidError.
+            max_size: maximum size of the metadata, in bytes.
+        """
+        self.urls = tuple(urls)
+        self.max_size = max_size
+        self._check = check
+        self._deadline: Optional[float] = None
+
+    def remaining(self) -> float:
+        """Get the time left to download the metadata, starting the countdown on first use.
+
+        Returns:
+            The seconds left before the deadline.
+        """
+        if self._deadline is None:
+            self._deadline = time.monotonic() + FETCH_DEADLINE
+        return self._deadline - time.monotonic()
+
+    def _fetch_url_once(
+        self, url: str, previous: Optional[MetadataSnapshot] = None
+    ) -> FetchedMetadata:
+        """Fetch the metadata contents from a URL once, within the deadline.
+
+        Args:
+            url: URL to the metadata or one of its mirrors.
+            previous: snapshot whose validators are used to revalidate the metadata, if any.
+
+        Returns:
+            The downloaded metadata.
+
+        Raises:
+            MetadataNotModifiedError: if the metadata hasn't been modified since the previous
+                snapshot was extracted.
+            TransientFetchError: if the metadata can't be retrieved due to a transient error.
+            CharmConfigInvalidError: if the metadata can't be retrieved.
+        """
+        headers = {"Accept-Encoding": ACCEPT_ENCODING}
+        if previous and previous.etag:
+            headers["If-None-Match"] = previous.etag
+        if previous and previous.last_modified:
+            headers["If-Modified-Since"] = previous.last_modified
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise CharmConfigInvalidError(f"Deadline exceeded retrieving data from {url}")
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            return call_with_deadline(
+                partial(
+                    _request,
+                    request,
+                    min(FETCH_SOCKET_TIMEOUT, remaining),
+                    cast(float, self._deadline),
+                    self.max_size,
+                ),
+                remaining,
+            )
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304 and previous:
+                raise MetadataNotModifiedError() from ex
+            if ex.code in TRANSIENT_HTTP_ERRORS:
+                raise TransientFetchError(f"Error while retrieving data from {url}") from ex
+            raise CharmConfigInvalidError(f"Error while retrieving data from {url}") from ex
+        except (zlib.error, ValueError) as ex:
+            raise CharmConfigInvalidError(f"Data from {url} can't be decompressed") from ex
+        except (OSError, concurrent.futures.TimeoutError) as ex:
+            # Includes the connection errors and the timeouts
+            raise TransientFetchError(f"Error while retrieving data from {url}") from ex
+
+    def _fetch_url(self, url: str, previous: Optional[MetadataSnapshot] = None) -> FetchedMetadata:
+        """Fetch the metadata contents from a URL, retrying on transient errors.
+
+        The retries are delayed with a jittered exponential backoff and stop at the deadline.
+
+        Args:
+            url: URL to the metadata or one of its mirrors.
+            previous: snapshot whose validators are used to revalidate the metadata, if any.
+
+        Returns:
+            The downloaded metadata.
+
+        Raises:
+            TransientFetchError: if the last attempt failed due to a transient error.
+        """
+        for attempt in range(1, MAX_FETCH_ATTEMPTS):
+            try:
+                return self._fetch_url_once(url, previous)
+            except TransientFetchError as ex:
+                backoff = random.uniform(0, FETCH_RETRY_BACKOFF * 2 ** (attempt - 1))  # nosec
+                if backoff >= self.remaining():
+                    raise
+                logger.warning("%s, retrying in %.2f seconds", ex.msg, backoff)
+                time.sleep(backoff)
+        return self._fetch_url_once(url, previous)
+
+    def _report(
+        self, outcomes: queue.Queue, url: str, previous: Optional[MetadataSnapshot]
+    ) -> None:
+        """Fetch the metadata from a mirror, reporting the outcome.
+
+        Args:
+            outcomes: queue the outcome is reported to.
+            url: URL of the mirror.
+            previous: snapshot whose validators are used to revalidate the metadata, if any.
+        """
+        try:
+            outcomes.put((url, self._fetch_url(url, previous), None))
+        except (CharmConfigInvalidError, MetadataNotModifiedError) as ex:
+            outcomes.put((url, None, ex))
+
+    def _hedged_responses(
+        self, previous: Optional[MetadataSnapshot] = None
+    ) -> Iterator[tuple[str, FetchedMetadata]]:
+        """Request the metadata mirrors with a staggered start, yielding the responses.
+
+        The mirrors are requested in order, starting the next one when the previous ones haven't
+        answered after a delay, have failed or their response has been rejected by the caller by
+        requesting the next one.
+
+        Args:
+            previous: snapshot whose validators are used to revalidate the metadata, if any.
+
+        Yields:
+            The URL of the mirror and the downloaded metadata.
+
+        Raises:
+            MetadataNotModifiedError: if the metadata hasn't been modified since the previous
+                snapshot was extracted.
+        """
+        outcomes: queue.Queue = queue.Queue()
+        pending = list(self.urls)
+        running = 0
+        while pending or running:
+            # Each iteration follows a delay, a failure or a rejection, so the next mirror starts
+            if pending:
+                threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self._report, outcomes, pending.pop(0), previous),
+                    daemon=True,
+                ).start()
+                running += 1
+            remaining = self.remaining()
+            if remaining <= 0:
+                logger.warning("Deadline exceeded waiting for the metadata mirrors")
+                return
+            try:
+                url, response, error = outcomes.get(
+                    timeout=min(MIRROR_HEDGE_DELAY, remaining) if pending else remaining
+                )
+            except queue.Empty:
+                continue
+            running -= 1
+            if isinstance(error, MetadataNotModifiedError):
+                raise MetadataNotModifiedError() from error
+            if response is None:
+                logger.warning("Discarding the metadata from %s: %s", url, error)
+                continue
+            yield url, response
+
+    def _fetch_mirrors(self, previous: Optional[MetadataSnapshot] = None) -> FetchedMetadata:
+        """Fetch the metadata from all its mirrors, hedging the requests.
+
+        The first response passing the checks is used, the remaining mirrors are not requested and
+        the requests in flight are abandoned.
+
+        Args:
+            previous: snapshot whose validators are used to revalidate the metadata, if any.
+
+        Returns:
+            The downloaded metadata.
+
+        Raises:
+            CharmConfigInvalidError: if no mirror returns valid metadata.
+        """
+        for url, response in self._hedged_responses(previous):
+            try:
+                if self._check:
+                    self._check(response)
+            except CharmConfigInvalidError as ex:
+                logger.warning("Discarding the metadata from %s: %s", url, ex.msg)
+                continue
+            logger.info("Using the metadata from %s", url)
+            return response
+        raise CharmConfigInvalidError(
+            f"Error while retrieving data from {self.urls[0]} and its mirrors"
+        )
+
+    def fetch(self, previous: Optional[MetadataSnapshot] = None) -> FetchedMetadata:
+        """Fetch the metadata contents.
+
+        Args:
+            previous: snapshot whose validators are used to revalidate the metadata, if any.
+
+        Returns:
+            The downloaded metadata.
+        """
+        with RECORDER.time(FETCH_DURATION), TRACER.span("MetadataFetcher.fetch"):
+            if len(self.urls) > 1:
+                return self._fetch_mirrors(previous)
+            return self._fetch_url(self.urls[0], previous)
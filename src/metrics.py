@@ -0,0 +1,247 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the MetricsRecorder class to expose the metrics of the metadata refreshes.
+
+Each hook and each refresher run is a new process, so the metrics recorded in memory are
+merged on flush into a JSON file in the state directory. They're then rendered in the Prometheus
+text format, for the textfile collector of a node exporter or any local scraper.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+METRICS_STATE_FILENAME = "metrics.json"
+METRICS_LOCK_FILENAME = "metrics.lock"
+METRICS_TEXTFILE_NAME = "saml-integrator.prom"
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+FETCH_DURATION = "saml_integrator_fetch_duration_seconds"
+DOWNLOADED_BYTES = "saml_integrator_downloaded_bytes_total"
+PARSE_DURATION = "saml_integrator_parse_duration_seconds"
+SIGNATURE_VERIFICATION_DURATION = "saml_integrator_signature_verification_duration_seconds"
+CACHE_REQUESTS = "saml_integrator_cache_requests_total"
+RELATION_UPDATES = "saml_integrator_relation_updates_total"
+LAST_REFRESH = "saml_integrator_last_refresh_timestamp_seconds"
+
+# Type and help of each metric, by name
+METRICS = {
+    FETCH_DURATION: ("histogram", "Time spent fetching the metadata, retries included."),
+    DOWNLOADED_BYTES: ("counter", "Bytes of metadata downloaded, before decompression."),
+    PARSE_DURATION: ("histogram", "Time spent parsing the metadata."),
+    SIGNATURE_VERIFICATION_DURATION: (
+        "histogram",
+        "Time spent verifying the signature of the metadata.",
+    ),
+    CACHE_REQUESTS: ("counter", "Lookups in the metadata cache, by cache and result."),
+    RELATION_UPDATES: ("counter", "Relation data updates, by result."),
+    LAST_REFRESH: ("gauge", "Time of the last successful metadata fetch or revalidation."),
+}
+
+
+def _labels_key(labels: dict[str, str]) -> str:
+    """Render the labels of a sample.
+
+    Args:
+        labels: the label values, by name.
+
+    Returns:
+        The labels, in the Prometheus text format without the braces.
+    """
+    return ",".join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+
+
+def _sample(name: str, labels_key: str, value: float) -> str:
+    """Render a sample.
+
+    Args:
+        name: the sample name.
+        labels_key: the rendered labels.
+        value: the sample value.
+
+    Returns:
+        The sample line, in the Prometheus text format.
+    """
+    labels = f"{{{labels_key}}}" if labels_key else ""
+    return f"{name}{labels} {float(value)!r}"
+
+
+class MetricsRecorder:
+    """Record the metrics of the current process, merging them into the state directory.
+
+    Counters and histograms are added to the persisted values, gauges replace them. Histograms
+    are stored as their cumulative bucket counts, followed by their count and sum.
+    """
+
+    def __init__(self) -> None:
+        """Initialize a new instance of the MetricsRecorder class."""
+        self._lock = threading.RLock()
+        self._values: dict[str, dict[str, float]] = {}
+        self._histograms: dict[str, dict[str, list[float]]] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Increment a counter.
+
+        Args:
+            name: the counter name.
+            amount: the increment.
+            labels: the label values.
+        """
+        with self._lock:
+            samples = self._values.setdefault(name, {})
+            key = _labels_key(labels)
+            samples[key] = samples.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set a gauge.
+
+        Args:
+            name: the gauge name.
+            value: the gauge value.
+            labels: the label values.
+        """
+        with self._lock:
+            self._values.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Observe a value in a histogram.
+
+        Args:
+            name: the histogram name.
+            value: the observed value.
+            labels: the label values.
+        """
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {}).setdefault(
+                _labels_key(labels), [0] * (len(DURATION_BUCKETS) + 2)
+            )
+            for position, bound in enumerate(DURATION_BUCKETS):
+                histogram[position] += value <= bound
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        """Observe the time spent in a block in a histogram, even if it fails.
+
+        Args:
+            name: the histogram name.
+            labels: the label values.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _merge(self, persisted: dict) -> dict:
+        """Merge the metrics recorded in memory into the persisted ones.
+
+        Args:
+            persisted: the persisted metrics.
+
+        Returns:
+            The merged metrics.
+        """
+        values = persisted.setdefault("values", {})
+        for name, samples in self._values.items():
+            merged = values.setdefault(name, {})
+            for key, value in samples.items():
+                if METRICS[name][0] == "counter":
+                    value += merged.get(key, 0)
+                merged[key] = value
+        histograms = persisted.setdefault("histograms", {})
+        for name, histogram_samples in self._histograms.items():
+            merged = histograms.setdefault(name, {})
+            for key, histogram in histogram_samples.items():
+                previous = merged.get(key, [0] * len(histogram))
+                merged[key] = [first + second for first, second in zip(previous, histogram)]
+        return persisted
+
+    @staticmethod
+    def render(persisted: dict) -> str:
+        """Render the metrics in the Prometheus text format.
+
+        Args:
+            persisted: the persisted metrics.
+
+        Returns:
+            The metrics, in the Prometheus text format.
+        """
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {metric_type}"]
+            if metric_type != "histogram":
+                for key, value in sorted(persisted.get("values", {}).get(name, {}).items()):
+                    lines.append(_sample(name, key, value))
+                continue
+            for key, histogram in sorted(persisted.get("histograms", {}).get(name, {}).items()):
+                for bound, count in zip((*DURATION_BUCKETS, math.inf), histogram):
+                    le = "+Inf" if math.isinf(bound) else f"{bound:g}"
+                    le_key = ",".join(filter(None, (key, f'le="{le}"')))
+                    lines.append(_sample(f"{name}_bucket", le_key, count))
+                lines.append(_sample(f"{name}_count", key, histogram[-2]))
+                lines.append(_sample(f"{name}_sum", key, histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+    def _write(self, state_dir: Path) -> None:
+        """Merge the metrics recorded in memory into the persisted ones and render them.
+
+        Args:
+            state_dir: directory where the metrics are persisted.
+        """
+        state_dir.mkdir(parents=True, exist_ok=True)
+        # Hooks and refresher runs may flush concurrently
+        with open(state_dir / METRICS_LOCK_FILENAME, "w", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                persisted = json.loads(
+                    (state_dir / METRICS_STATE_FILENAME).read_text(encoding="utf-8")
+                )
+            except (OSError, ValueError):
+                persisted = {}
+            persisted = self._merge(persisted)
+            for filename, content in (
+                (METRICS_STATE_FILENAME, json.dumps(persisted, sort_keys=True)),
+                (METRICS_TEXTFILE_NAME, self.render(persisted)),
+            ):
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=state_dir, prefix=f".{filename}.", delete=False
+                ) as tmp_file:
+                    tmp_file.write(content)
+                os.chmod(tmp_file.name, 0o644)
+                os.replace(tmp_file.name, state_dir / filename)
+
+    def flush(self, state_dir: Path) -> None:
+        """Merge the metrics recorded in memory into the state directory and render them.
+
+        Args:
+            state_dir: directory where the metrics are persisted.
+        """
+        with self._lock:
+            if not self._values and not self._histograms:
+                return
+            try:
+                self._write(state_dir)
+            except OSError as ex:
+                logger.warning("Failed to write the metrics in %s: %s", state_dir, ex)
+            self.clear()
+
+    def clear(self) -> None:
+        """Discard the metrics recorded in memory."""
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+
+RECORDER = MetricsRecorder()
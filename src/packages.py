@@ -0,0 +1,86 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Install the apt packages needed by the charm, skipping apt if they're already present.
+
+The state of all the packages is queried with a single dpkg-query call, so images with the
+packages pre-installed don't pay for an apt-get update. The missing packages are installed in
+a single apt-get transaction.
+"""
+import logging
+import os
+import subprocess  # nosec
+from typing import Sequence
+
+from charms.operator_libs_linux.v0 import apt
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_PACKAGES = ("libssl-dev", "libxml2", "libxslt1-dev")
+# Abbreviated dpkg status of a package both desired and installed
+INSTALLED_STATUS = "ii"
+
+
+def missing_packages(package_names: Sequence[str]) -> list[str]:
+    """Get the packages that aren't installed.
+
+    Args:
+        package_names: names of the packages.
+
+    Returns:
+        The names of the packages that aren't installed, in the requested order.
+    """
+    try:
+        # Exits with an error when some of the packages are unknown, still listing the others
+        result = subprocess.run(  # nosec
+            ["dpkg-query", "--show", "--showformat=${Package}\t${db:Status-Abbrev}\n"]
+            + list(package_names),
+            capture_output=True,
+            check=False,
+            text=True,
+        )
+    except OSError as ex:
+        logger.warning("Querying the installed packages failed: %s", ex)
+        return list(package_names)
+    installed = set()
+    for line in result.stdout.splitlines():
+        name, _, status = line.partition("\t")
+        # Multi-arch packages are listed once per architecture
+        if status.startswith(INSTALLED_STATUS):
+            installed.add(name)
+    return [name for name in package_names if name not in installed]
+
+
+def install_packages(package_names: Sequence[str] = REQUIRED_PACKAGES) -> None:
+    """Install the packages that aren't installed yet, in a single transaction.
+
+    Args:
+        package_names: names of the packages.
+
+    Raises:
+        PackageError: if the packages fail to install.
+    """
+    missing = missing_packages(package_names)
+    if not missing:
+        logger.info("Packages %s already installed", ", ".join(package_names))
+        return
+    logger.info("Installing packages %s", ", ".join(missing))
+    env = {**os.environ, "DEBIAN_FRONTEND": "noninteractive"}
+    try:
+        apt.update()
+        subprocess.run(  # nosec
+            [
+                "apt-get",
+                "--assume-yes",
+                "--option=Dpkg::Options::=--force-confold",
+                "install",
+                *missing,
+            ],
+            capture_output=True,
+            check=True,
+            env=env,
+        )
+    except subprocess.CalledProcessError as ex:
+        raise apt.PackageError(
+            f"Failed to install packages {', '.join(missing)}: {ex.stderr!r}"
+        ) from ex
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the MetadataRefresher class to refresh the metadata outside of the Juju hooks.
+
+The refresher is a systemd timer running this module, which fetches and verifies the metadata
+on its own schedule and persists the extracted SAML data in the metadata cache. The hooks then
+only need to publish the persisted snapshot.
+
+The same module is also started as a detached process on configuration changes. Once the
+metadata is persisted, it dispatches the metadata_ready charm event through juju-exec (juju-run
+before Juju 3), so the publishing happens in that event instead of holding up the configuration
+hook.
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import subprocess  # nosec
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Collection, Optional
+
+from charm_state import CharmConfigInvalidError, CharmState, SamlIntegratorConfig
+from metadata_cache import MetadataCache
+from metrics import RECORDER
+from saml import SamlIntegrator
+from tracing import TRACER, TRACES_FILENAME
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "saml-integrator-refresher"
+SYSTEMD_DIR = Path("/etc/systemd/system")
+REFRESHER_CONFIG_FILENAME = "refresher-config.json"
+FETCH_LOCK_FILENAME = "fetch.lock"
+FETCH_LOG_FILENAME = "fetch.log"
+METADATA_READY_EVENT = "metadata_ready"
+# Exit code of the refresh, passed to the metadata_ready event
+REFRESH_STATUS_ENV = "SAML_INTEGRATOR_REFRESH_STATUS"
+# Seconds between the end of a refresh and the start of the next one
+REFRESH_INTERVAL = 300
+
+SERVICE_TEMPLATE = """[Unit]
+Description=Refresh the SAML metadata of the SAML Integrator charm
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+Type=oneshot
+WorkingDirectory={charm_dir}
+Environment=PYTHONPATH={charm_dir}/lib:{charm_dir}/venv:{charm_dir}/src
+ExecStart={python} {charm_dir}/src/refresher.py {state_dir}
+"""
+
+TIMER_TEMPLATE = """[Unit]
+Description=Refresh the SAML metadata of the SAML Integrator charm periodically
+
+[Timer]
+OnActiveSec=0
+OnUnitInactiveSec={interval}
+RandomizedDelaySec={jitter}
+
+[Install]
+WantedBy=timers.target
+"""
+
+
+def _write_atomically(path: Path, content: str) -> None:
+    """Atomically write a file.
+
+    Args:
+        path: path of the file.
+        content: file contents.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as tmp_file:
+        tmp_file.write(content)
+    os.chmod(tmp_file.name, 0o644)
+    os.replace(tmp_file.name, path)
+
+
+def _systemctl(*args: str) -> None:
+    """Run a systemctl command.
+
+    Args:
+        args: systemctl arguments.
+    """
+    subprocess.run(["systemctl", *args], check=True)  # nosec
+
+
+class MetadataRefresher:
+    """Install and configure the systemd timer refreshing the metadata, or fetch it in background.
+
+    Attrs:
+        state_dir: directory where the metadata cache is persisted.
+        charm_dir: directory of the charm code.
+    """
+
+    def __init__(self, state_dir: Path, charm_dir: Path):
+        """Initialize a new instance of the MetadataRefresher class.
+
+        Args:
+            state_dir: directory where the metadata cache is persisted.
+            charm_dir: directory of the charm code.
+        """
+        self.state_dir = state_dir
+        self.charm_dir = charm_dir
+
+    @property
+    def _environment(self) -> dict[str, str]:
+        """Get the environment the refresher runs in.
+
+        Returns:
+            The environment variables.
+        """
+        return {
+            "PATH": os.environ.get("PATH", os.defpath),
+            "PYTHONPATH": f"{self.charm_dir}/lib:{self.charm_dir}/venv:{self.charm_dir}/src",
+        }
+
+    @property
+    def _unit_files(self) -> dict[Path, str]:
+        """Get the systemd unit files of the refresher.
+
+        Returns:
+            The contents of the unit files, by path.
+        """
+        return {
+            SYSTEMD_DIR
+            / f"{SERVICE_NAME}.service": SERVICE_TEMPLATE.format(
+                charm_dir=self.charm_dir, python=sys.executable, state_dir=self.state_dir
+            ),
+            SYSTEMD_DIR
+            / f"{SERVICE_NAME}.timer": TIMER_TEMPLATE.format(
+                interval=REFRESH_INTERVAL, jitter=REFRESH_INTERVAL // 10
+            ),
+        }
+
+    def configure(self, config: dict[str, Any], entity_ids: Collection[str]) -> None:
+        """Persist the configuration used by the refresher, if it changed.
+
+        Args:
+            config: the charm configuration.
+            entity_ids: the entities whose SAML data has to be extracted.
+        """
+        path = self.state_dir / REFRESHER_CONFIG_FILENAME
+        content = json.dumps(
+            {"config": config, "entity_ids": sorted(set(entity_ids))}, sort_keys=True
+        )
+        if not path.exists() or path.read_text(encoding="utf-8") != content:
+            _write_atomically(path, content)
+
+    def install(self) -> None:
+        """Install and start the refresher timer, unless it's already up to date."""
+        changed = False
+        for path, content in self._unit_files.items():
+            if not path.exists() or path.read_text(encoding="utf-8") != content:
+                _write_atomically(path, content)
+                changed = True
+        if changed:
+            logger.info("Installing the metadata refresher")
+            _systemctl("daemon-reload")
+            _systemctl("enable", "--now", f"{SERVICE_NAME}.timer")
+
+    def start_fetch(self, unit_name: str, force: bool = True) -> None:
+        """Fetch the metadata in a detached process, dispatching metadata_ready once done.
+
+        Args:
+            unit_name: the unit the metadata_ready event is dispatched to.
+            force: whether to fetch the metadata even if the persisted snapshot isn't due.
+        """
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        logger.info("Fetching the metadata in background")
+        with open(self.state_dir / FETCH_LOG_FILENAME, "ab") as log_file:
+            subprocess.Popen(  # pylint: disable=consider-using-with # nosec
+                [
+                    sys.executable,
+                    str(self.charm_dir / "src" / "refresher.py"),
+                    str(self.state_dir),
+                    "--dispatch",
+                    unit_name,
+                    "--charm-dir",
+                    str(self.charm_dir),
+                    *([] if force else ["--if-due"]),
+                ],
+                cwd=self.charm_dir,
+                # The hook context must not leak into the juju-exec call
+                env=self._environment,
+                stdin=subprocess.DEVNULL,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+
+    def remove(self) -> None:
+        """Stop and remove the refresher timer, if installed."""
+        unit_files = [path for path in self._unit_files if path.exists()]
+        if not unit_files:
+            return
+        logger.info("Removing the metadata refresher")
+        _systemctl("disable", "--now", f"{SERVICE_NAME}.timer")
+        for path in unit_files:
+            path.unlink()
+        _systemctl("daemon-reload")
+
+
+def refresh(state_dir: Path, force: bool = False) -> None:
+    """Fetch and verify the metadata, persisting the extracted SAML data.
+
+    Args:
+        state_dir: directory where the metadata cache is persisted.
+        force: whether to fetch the metadata even if the persisted snapshot isn't due.
+
+    Raises:
+        CharmConfigInvalidError: if the refresher configuration or the metadata is invalid.
+    """
+    path = state_dir / REFRESHER_CONFIG_FILENAME
+    try:
+        refresher_config = json.loads(path.read_text(encoding="utf-8"))
+        # Incompatible with pydantic.AnyHttpUrl
+        config = SamlIntegratorConfig(**refresher_config["config"])  # type: ignore
+        entity_ids = list(refresher_config["entity_ids"])
+    except (OSError, ValueError, KeyError, TypeError) as ex:
+        raise CharmConfigInvalidError(f"Invalid refresher configuration {path}") from ex
+    charm_state = CharmState(saml_integrator_config=config)
+    saml_integrator = SamlIntegrator(charm_state=charm_state, cache=MetadataCache(state_dir))
+    entity_ids = [charm_state.entity_id, *entity_ids]
+    if (
+        not force
+        and not saml_integrator.is_refresh_due()
+        and saml_integrator.cached_entities(entity_ids)
+    ):
+        logger.info("Metadata refresh not due yet")
+        return
+    saml_integrator.entities(entity_ids)
+
+
+def dispatch(unit_name: str, charm_dir: Path, exit_code: int) -> None:
+    """Dispatch the metadata_ready event to the charm.
+
+    Args:
+        unit_name: the unit the event is dispatched to.
+        charm_dir: directory of the charm code.
+        exit_code: exit code of the refresh, for the charm to report a failure.
+    """
+    command = (
+        f"{REFRESH_STATUS_ENV}={exit_code} "
+        f"JUJU_DISPATCH_PATH=hooks/{METADATA_READY_EVENT} {charm_dir}/dispatch"
+    )
+    try:
+        try:
+            subprocess.run(["juju-exec", "-u", unit_name, command], check=True)  # nosec
+        except FileNotFoundError:
+            # Named juju-run before Juju 3
+            subprocess.run(["juju-run", unit_name, command], check=True)  # nosec
+    except (OSError, subprocess.CalledProcessError) as ex:
+        logger.error("Dispatching %s failed: %s", METADATA_READY_EVENT, ex)
+
+
+def main(args: Optional[list[str]] = None) -> int:
+    """Refresh the metadata once, as run by the systemd timer or after a configuration change.
+
+    Args:
+        args: command line arguments, the state directory and optionally the unit to dispatch
+            the metadata_ready event to, the fetch being forced unless only done if due.
+
+    Returns:
+        The exit code.
+    """
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    parser = argparse.ArgumentParser(description="Refresh the SAML metadata.")
+    parser.add_argument("state_dir", type=Path)
+    parser.add_argument("--dispatch", metavar="UNIT")
+    parser.add_argument("--charm-dir", type=Path, default=Path.cwd())
+    parser.add_argument("--if-due", action="store_true")
+    parsed = parser.parse_args(sys.argv[1:] if args is None else args)
+    parsed.state_dir.mkdir(parents=True, exist_ok=True)
+    # Concurrent fetches are serialized, so the last one uses the last configuration
+    with open(parsed.state_dir / FETCH_LOCK_FILENAME, "w", encoding="utf-8") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        TRACER.path = parsed.state_dir / TRACES_FILENAME
+        force = bool(parsed.dispatch) and not parsed.if_due
+        try:
+            with TRACER.span("refresher.refresh", dispatch=bool(parsed.dispatch), force=force):
+                refresh(parsed.state_dir, force=force)
+        except CharmConfigInvalidError as ex:
+            logger.error("Metadata refresh failed: %s", ex.msg)
+            exit_code = 1
+        else:
+            logger.info("Metadata refreshed")
+            exit_code = 0
+        RECORDER.flush(parsed.state_dir)
+        # Dispatched even on failure, for the charm to report it
+        if parsed.dispatch:
+            dispatch(parsed.dispatch, parsed.charm_dir, exit_code)
+    return exit_code
+
+
+if __name__ == "__main__":  # pragma: nocover
+    sys.exit(main())
@@ -4,15 +4,24 @@
 """Provide the SamlApp class to encapsulate the business logic."""
 import base64
 import hashlib
+import io
 import logging
+import re
 import secrets
-import urllib.request
-from functools import cached_property
-from typing import TYPE_CHECKING, Optional
+from datetime import datetime, timedelta, timezone
+from functools import cached_property, lru_cache
+from typing import TYPE_CHECKING, Collection, Iterable, Optional, cast
+from xml.sax.saxutils import unescape  # nosec
 
 from charms.saml_integrator.v0 import saml
+from pydantic import ValidationError
+from pydantic.datetime_parse import parse_datetime
 
 from charm_state import CharmConfigInvalidError, CharmState
+from metadata_cache import EntityIndex, ExtractedSamlData, MetadataCache, MetadataSnapshot
+from metadata_fetcher import FetchedMetadata, MetadataFetcher, MetadataNotModifiedError
+from metrics import LAST_REFRESH, PARSE_DURATION, RECORDER, SIGNATURE_VERIFICATION_DURATION
+from tracing import TRACER
 
 if TYPE_CHECKING:  # pragma: nocover
     # Bandit classifies this import as vulnerable. For more details, see
@@ -22,10 +31,394 @@ if TYPE_CHECKING:  # pragma: nocover
 logger = logging.getLogger(__name__)
 
 
+NAMESPACES = {
+    "md": "urn:oasis:names:tc:SAML:2.0:metadata",
+    "ds": "http://www.w3.org/2000/09/xmldsig#",
+}
+
+
+ENTITY_DESCRIPTOR_TAG = f"{{{NAMESPACES['md']}}}EntityDescriptor"
+KEY_DESCRIPTOR_TAG = f"{{{NAMESPACES['md']}}}KeyDescriptor"
+X509_CERTIFICATE_TAG = f"{{{NAMESPACES['ds']}}}X509Certificate"
+ENDPOINT_TAGS = {
+    f"{{{NAMESPACES['md']}}}{name}": name
+    for name in ("SingleSignOnService", "SingleLogoutService")
+}
+SIGNING_CERTIFICATES_XPATH = "//md:KeyDescriptor[@use='signing']//ds:X509Certificate/text()"
+SIGNATURE_XPATH = "//ds:Signature"
+
+ROOT_START_RE = re.compile(rb"<((?:[\w.-]+:)?EntitiesDescriptor)(?=[\s>])[^>]*>")
+# Comments, CDATA sections and processing instructions are matched so that the EntityDescriptor
+# tags they contain are skipped, as they aren't markup
+ENTITY_TAG_RE = re.compile(
+    rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>"
+    rb"|<(?P<end>/)?(?:[\w.-]+:)?EntityDescriptor(?=[\s/>])[^>]*>",
+    re.DOTALL,
+)
+ENTITY_ID_RE = re.compile(rb"""\sentityID\s*=\s*(["'])(.*?)\1""", re.DOTALL)
+# xs:duration, with years and months approximated to 365 and 30 days
+DURATION_RE = re.compile(
+    r"P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?(?:(?P<weeks>\d+)W)?(?:(?P<days>\d+)D)?"
+    r"(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?"
+)
+
+
+def fingerprint_matches(certificate: Optional[str], fingerprint: str) -> bool:
+    """Check if a certificate matches a SHA-256 fingerprint.
+
+    Args:
+        certificate: the base64 encoded certificate.
+        fingerprint: the fingerprint, optionally with colons or spaces.
+
+    Returns:
+        True if the certificate matches the fingerprint.
+    """
+    return bool(certificate) and secrets.compare_digest(
+        hashlib.sha256(base64.b64decode(cast(str, certificate))).hexdigest(),
+        fingerprint.replace(":", "").replace(" ", ""),
+    )
+
+
+def build_entity_index(
+    raw_data: bytes,
+) -> Optional[tuple[tuple[int, int], str, dict[str, tuple[int, int]]]]:
+    """Locate each EntityDescriptor in a raw metadata aggregate without parsing it.
+
+    Args:
+        raw_data: the raw metadata.
+
+    Returns:
+        The offset and length of the root start tag, the root qualified name and the offset and
+        length of each entity by entity ID, or None if the metadata is not an aggregate.
+    """
+    root = ROOT_START_RE.search(raw_data)
+    if not root or raw_data[: root.start()].count(b"<") != raw_data[: root.start()].count(b"<?"):
+        return None
+    entities: dict[str, tuple[int, int]] = {}
+    start = None
+    for tag in ENTITY_TAG_RE.finditer(raw_data, root.end()):
+        if tag.group(0)[1:2] in (b"!", b"?"):
+            continue
+        if not tag.group("end"):
+            start = tag
+            if not tag.group(0).endswith(b"/>"):
+                continue
+        entity_id = ENTITY_ID_RE.search(start.group(0)) if start else None
+        if start and entity_id:
+            entities.setdefault(
+                unescape(entity_id.group(2).decode("utf-8"), {"&quot;": '"', "&apos;": "'"}),
+                (start.start(), tag.end() - start.start()),
+            )
+        start = None
+    return (root.start(), root.end() - root.start()), root.group(1).decode("utf-8"), entities
+
+
+def parse_indexed_entity(
+    raw_data: bytes, index: EntityIndex, entity_id: str
+) -> Optional["etree.Element"]:
+    """Parse a single entity of a raw metadata aggregate using its index.
+
+    The entity is wrapped in the root start tag so that the namespace declarations are preserved.
+
+    Args:
+        raw_data: the raw metadata.
+        index: location of the entities in the raw metadata.
+        entity_id: the entity ID to parse.
+
+    Returns:
+        The EntityDescriptor element or None if it can't be found at the indexed location.
+    """
+    # Lazy importing. Required deb packages won't be present on charm startup
+    # pylint: disable=import-outside-toplevel
+    from lxml import etree  # nosec
+
+    if entity_id not in index.entities:
+        return None
+    root_start, root_length = index.root
+    root_end = root_start + root_length
+    start, length = index.entities[entity_id]
+    end = start + length
+    fragment = b"".join(
+        (raw_data[root_start:root_end], raw_data[start:end], f"</{index.root_name}>".encode())
+    )
+    try:
+        root = etree.fromstring(fragment)  # nosec
+    except etree.XMLSyntaxError:
+        return None
+    entity = root.find(ENTITY_DESCRIPTOR_TAG)
+    return entity if entity is not None and entity.get("entityID") == entity_id else None
+
+
+@lru_cache(maxsize=None)
+def compiled_xpath(expression: str) -> "etree.XPath":
+    """Compile an XPath expression using the metadata namespaces, once per expression.
+
+    Args:
+        expression: the XPath expression.
+
+    Returns:
+        The compiled expression.
+    """
+    # Lazy importing. Required deb packages won't be present on charm startup
+    # pylint: disable=import-outside-toplevel
+    from lxml import etree  # nosec
+
+    return etree.XPath(expression, namespaces=NAMESPACES)
+
+
+def parse_duration(value: str) -> Optional[timedelta]:
+    """Parse an xs:duration, such as the cacheDuration of the metadata.
+
+    Args:
+        value: the duration.
+
+    Returns:
+        The duration or None if it's invalid or negative.
+    """
+    value = value.strip()
+    match = DURATION_RE.fullmatch(value)
+    # At least one part is required, and a time part is required after T
+    if not match or not any(match.groupdict().values()) or value.endswith("T"):
+        logger.warning("Ignoring invalid duration %s", value)
+        return None
+    parts = {name: float(part) for name, part in match.groupdict().items() if part}
+    return timedelta(
+        days=parts.pop("years", 0) * 365 + parts.pop("months", 0) * 30 + parts.pop("days", 0),
+        **parts,
+    )
+
+
+def parse_date_time(value: str) -> Optional[datetime]:
+    """Parse an xs:dateTime, such as the validUntil of the metadata.
+
+    Args:
+        value: the date and time, in UTC if no time zone is specified.
+
+    Returns:
+        The date and time or None if it's invalid.
+    """
+    try:
+        parsed = parse_datetime(value.strip())
+    except (ValueError, ValidationError):
+        logger.warning("Ignoring invalid date and time %s", value)
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _extract_validity(entity: "etree.Element") -> tuple[Optional[datetime], Optional[timedelta]]:
+    """Extract the validUntil and cacheDuration applying to an EntityDescriptor element.
+
+    The attributes of the entity and of its ancestors apply, so the most restrictive are used.
+
+    Args:
+        entity: the EntityDescriptor element.
+
+    Returns:
+        The expiration of the metadata and the time it can be cached, if declared.
+    """
+    valid_until: Optional[datetime] = None
+    cache_duration: Optional[timedelta] = None
+    for element in (entity, *entity.iterancestors()):
+        if (value := element.get("validUntil")) and (parsed := parse_date_time(value)):
+            valid_until = min(valid_until or parsed, parsed)
+        duration = parse_duration(value) if (value := element.get("cacheDuration")) else None
+        if duration is not None:
+            cache_duration = duration if cache_duration is None else min(cache_duration, duration)
+    return valid_until, cache_duration
+
+
+def _extract_entity(entity: "etree.Element") -> tuple[list[str], list[saml.SamlEndpoint]]:
+    """Extract the certificates and endpoints from an EntityDescriptor element in a single walk.
+
+    Args:
+        entity: the EntityDescriptor element.
+
+    Returns:
+        The certificates and endpoints of the entity.
+    """
+    certificates: list[str] = []
+    endpoints = []
+    for element in entity.iter(KEY_DESCRIPTOR_TAG, *ENDPOINT_TAGS):
+        if element.tag == KEY_DESCRIPTOR_TAG:
+            certificates.extend(
+                certificate.text
+                for certificate in element.iter(X509_CERTIFICATE_TAG)
+                if certificate.text
+            )
+        else:
+            endpoints.append(
+                saml.SamlEndpoint(
+                    name=ENDPOINT_TAGS[element.tag],
+                    url=element.get("Location"),
+                    binding=element.get("Binding"),
+                    response_url=element.get("ResponseLocation"),
+                )
+            )
+    return sorted(certificates), endpoints
+
+
+def stream_entities(raw_data: bytes, entity_ids: Collection[str]) -> dict[str, "etree.Element"]:
+    """Find several entities in the metadata, reading it incrementally in a single pass.
+
+    Only the matching EntityDescriptor elements are kept. The other entities are discarded as soon
+    as they have been read, so the memory used doesn't depend on the number of entities in the
+    metadata. The metadata is read until all the entities have been found.
+
+    Args:
+        raw_data: the raw metadata.
+        entity_ids: the entity IDs to look for.
+
+    Returns:
+        The EntityDescriptor elements found, by entity ID.
+    """
+    # Lazy importing. Required deb packages won't be present on charm startup
+    # pylint: disable=import-outside-toplevel
+    from lxml import etree  # nosec
+
+    found: dict[str, "etree.Element"] = {}
+    for _, element in etree.iterparse(  # nosec
+        io.BytesIO(raw_data), events=("end",), tag=ENTITY_DESCRIPTOR_TAG
+    ):
+        # The matching entities are kept as previous siblings or inside them, such as in a nested
+        # EntitiesDescriptor, everything else is dropped
+        previous = element.getprevious()
+        while previous is not None:
+            sibling, previous = previous, previous.getprevious()
+            if not any(
+                kept is sibling or sibling in kept.iterancestors() for kept in found.values()
+            ):
+                element.getparent().remove(sibling)
+        entity_id = element.get("entityID")
+        if entity_id in entity_ids and entity_id not in found:
+            found[entity_id] = element
+            if len(found) == len(entity_ids):
+                break
+        else:
+            element.clear(keep_tail=True)
+    return found
+
+
+def stream_entity(raw_data: bytes, entity_id: str) -> Optional["etree.Element"]:
+    """Find an entity in the metadata, reading it incrementally.
+
+    Args:
+        raw_data: the raw metadata.
+        entity_id: the entity ID to look for.
+
+    Returns:
+        The EntityDescriptor element or None if the entity is not present.
+    """
+    return stream_entities(raw_data, {entity_id}).get(entity_id)
+
+
+class MetadataDocument:  # pylint: disable=import-outside-toplevel
+    """An immutable snapshot of the fetched, parsed and verified IdP metadata.
+
+    Attrs:
+        digest: SHA-256 of the raw metadata.
+        tree: the element tree for the metadata.
+        signature: the Signature element in the metadata.
+        signing_certificate: signing certificate.
+    """
+
+    def __init__(
+        self,
+        tree: "etree.ElementTree",
+        fingerprint: Optional[str],
+        digest: Optional[str] = None,
+        cache: Optional[MetadataCache] = None,
+    ):
+        """Initialize a new instance of the MetadataDocument class.
+
+        Args:
+            tree: the parsed metadata.
+            fingerprint: fingerprint to validate the signing certificate against, if any.
+            digest: SHA-256 of the raw metadata, if known.
+            cache: storage for the signature verification verdicts.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata signature is invalid.
+        """
+        # Lazy importing. Required deb packages won't be present on charm startup
+        import signxml
+
+        self.digest = digest
+        self._tree = tree
+        signing_certificates = compiled_xpath(SIGNING_CERTIFICATES_XPATH)(tree)
+        self._signing_certificate = next(iter(signing_certificates), None)
+        signature = compiled_xpath(SIGNATURE_XPATH)(tree)
+        self._signature = signature[0] if signature else None
+
+        if fingerprint and not fingerprint_matches(self._signing_certificate, fingerprint):
+            raise CharmConfigInvalidError("The metadata signature does not match the provided one")
+        if self._signing_certificate and self._signature is not None:
+            if (
+                cache
+                and digest
+                and cache.is_signature_verified(digest, self._signing_certificate, fingerprint)
+            ):
+                logger.info("Signature of metadata %s already verified", digest)
+                return
+            # The metadata can be tampered unless the metadata contents used are signed. To prevent
+            # this, instead of arbitrarily validating the signature for all fragments that can be
+            # shared with the requirer, the whole contents will need to be signed.
+            try:
+                with RECORDER.time(SIGNATURE_VERIFICATION_DURATION), TRACER.span(
+                    "MetadataDocument.verify_signature"
+                ):
+                    signxml.XMLVerifier().verify(tree, x509_cert=self._signing_certificate)
+            except signxml.exceptions.InvalidSignature as ex:
+                raise CharmConfigInvalidError("The metadata has an invalid signature") from ex
+            if cache and digest:
+                cache.record_signature_verified(digest, self._signing_certificate, fingerprint)
+
+    @property
+    def tree(self) -> "etree.ElementTree":
+        """Return the verified element tree for the metadata."""
+        return self._tree
+
+    @property
+    def signature(self) -> Optional["etree.ElementTree"]:
+        """Return the Signature element in the metadata, if any."""
+        return self._signature
+
+    @property
+    def signing_certificate(self) -> Optional[str]:
+        """Return the signing certificate for the metadata, if any."""
+        return self._signing_certificate
+
+    def entities(self, entity_ids: Collection[str]) -> dict[str, "etree.Element"]:
+        """Find several entities in a single pass over the metadata.
+
+        Args:
+            entity_ids: the entity IDs to look for.
+
+        Returns:
+            The EntityDescriptor elements found, by entity ID.
+        """
+        found: dict[str, "etree.Element"] = {}
+        for element in self._tree.iter(ENTITY_DESCRIPTOR_TAG):
+            entity_id = element.get("entityID")
+            if entity_id in entity_ids and entity_id not in found:
+                found[entity_id] = element
+                if len(found) == len(entity_ids):
+                    break
+        return found
+
+
 class SamlIntegrator:  # pylint: disable=import-outside-toplevel
     """A class representing the SAML Integrator application.
 
+    The metadata is fetched, parsed and verified at most once per instance. All the properties
+    read from the same MetadataDocument snapshot. If a cache is provided, the metadata is
+    revalidated conditionally and the SAML data extracted previously is reused when the server
+    reports that the metadata has not been modified or when the same contents were already seen,
+    unless forced.
+
     Attrs:
+        document: the verified metadata snapshot.
+        metadata: the metadata fetched or read from the cache by this instance, if any.
+        snapshot: the SAML data extracted from the metadata.
         endpoints: SAML endpoints.
         certificates: public certificates.
         signature: the Signature element in the metadata.
@@ -34,152 +427,520 @@ class SamlIntegrator:  # pylint: disable=import-outside-toplevel
         nsmap: namespaces list.
     """
 
-    def __init__(self, charm_state: CharmState):
+    def __init__(
+        self, charm_state: CharmState, cache: Optional[MetadataCache] = None, force: bool = False
+    ):
         """Initialize a new instance of the SamlApp class.
 
         Args:
             charm_state: The state of the charm that the Saml instance belongs to.
+            cache: storage for the data extracted from the metadata across hooks.
+            force: whether to fetch, verify and extract the metadata again, only updating the
+                cache.
         """
         self._charm_state = charm_state
+        self._cache = cache
+        self._force = force
+        self._document: Optional[MetadataDocument] = None
+        self._metadata: Optional[FetchedMetadata] = None
+        self._extracted: dict[str, ExtractedSamlData] = {}
+        self._fetcher = MetadataFetcher(
+            charm_state.metadata_urls,
+            check=self._check_mirror_response,
+            max_size=charm_state.metadata_max_size * 1024 * 1024,
+        )
+
+    def _check_mirror_response(self, metadata: FetchedMetadata) -> None:
+        """Check that a mirror response parses and passes the fingerprint and signature checks.
+
+        Args:
+            metadata: the downloaded metadata.
+        """
+        if self._charm_state.metadata_streaming:
+            # The signature can't be verified while streaming, so the first response is used
+            return
+        if (
+            self._cache
+            and not self._force
+            and self._cache.load_extracted(
+                metadata.digest, self._charm_state.entity_id, self._charm_state.fingerprint
+            )
+        ):
+            return
+        # The parsed document is kept, so the winning response isn't parsed again
+        self._load_document(metadata)
+
+    def _load_document(self, metadata: FetchedMetadata) -> MetadataDocument:
+        """Parse and validate the metadata contents.
+
+        The raw bytes are parsed directly, leaving the character decoding to lxml.
 
-    def _read_tree(self) -> "etree.ElementTree":
-        """Fetch the metadata contents.
+        Args:
+            metadata: the downloaded metadata.
 
         Returns:
-            The metadata as an XML tree.
+            The verified metadata snapshot.
 
         Raises:
-            CharmConfigInvalidError: if the metadata URL can't be parsed.
+            CharmConfigInvalidError: if the metadata can't be parsed.
         """
         # Lazy importing. Required deb packages won't be present on charm startup
         from lxml import etree  # nosec
 
+        if self._document is not None and self._document.digest == metadata.digest:
+            return self._document
         try:
-            with urllib.request.urlopen(
-                self._charm_state.metadata_url, timeout=10
-            ) as resource:  # nosec
-                raw_data = resource.read().decode("utf-8")
-                tree = etree.fromstring(raw_data)  # nosec
-                return tree
-        except urllib.error.URLError as ex:
+            with RECORDER.time(PARSE_DURATION, mode="document"), TRACER.span(
+                "SamlIntegrator.parse", mode="document", size=len(metadata.content)
+            ):
+                tree = etree.fromstring(metadata.content)  # nosec
+        except etree.XMLSyntaxError as ex:
             raise CharmConfigInvalidError(
-                f"Error while retrieving data from {self._charm_state.metadata_url}"
+                f"Data from {self._charm_state.metadata_url} can't be parsed"
             ) from ex
+        self._document = MetadataDocument(
+            tree,
+            fingerprint=self._charm_state.fingerprint,
+            digest=metadata.digest,
+            cache=None if self._force else self._cache,
+        )
+        return self._document
+
+    @property
+    def document(self) -> MetadataDocument:
+        """Fetch, parse and validate the metadata contents once.
+
+        Returns:
+            The verified metadata snapshot.
+        """
+        if self._document is None:
+            self._metadata = self._fetcher.fetch()
+            return self._load_document(self._metadata)
+        return self._document
+
+    @property
+    def metadata(self) -> Optional[FetchedMetadata]:
+        """Return the metadata fetched or read from the cache by this instance.
+
+        Returns:
+            The metadata or None if the SAML data was published from the persisted snapshot.
+        """
+        return self._metadata
+
+    def _load_previous_snapshot(self) -> Optional[MetadataSnapshot]:
+        """Load the persisted snapshot if it was extracted from the current metadata URL.
+
+        Returns:
+            The previous snapshot, if any.
+        """
+        if not self._cache or self._force:
+            return None
+        previous = self._cache.load_snapshot()
+        if previous and previous.metadata_url == str(self._charm_state.metadata_url):
+            return previous
+        return None
+
+    def _revalidate(self, previous: MetadataSnapshot) -> Optional[FetchedMetadata]:
+        """Fetch the metadata contents unless they haven't been modified.
+
+        Args:
+            previous: snapshot whose validators are used to revalidate the metadata.
+
+        Returns:
+            The metadata or None if the previous snapshot is still valid.
+        """
+        try:
+            return self._fetcher.fetch(previous)
+        except MetadataNotModifiedError:
+            logger.info("Metadata from %s not modified", self._charm_state.metadata_url)
+        if previous.matches(
+            self._charm_state.metadata_url,
+            self._charm_state.entity_id,
+            self._charm_state.fingerprint,
+            self._charm_state.metadata_streaming,
+        ):
+            return None
+        # The configuration changed but the metadata is the same, so the cached copy can be used
+        return self._load_cached_metadata(previous) or self._fetcher.fetch()
+
+    def _load_cached_metadata(self, snapshot: MetadataSnapshot) -> Optional[FetchedMetadata]:
+        """Load the metadata a snapshot was extracted from out of the cache.
+
+        Args:
+            snapshot: the snapshot extracted from the metadata.
+
+        Returns:
+            The cached metadata, if any.
+        """
+        raw_data = (
+            self._cache.load_document(snapshot.digest) if self._cache and snapshot.digest else None
+        )
+        if raw_data is None:
+            return None
+        return FetchedMetadata(
+            raw_data,
+            cast(str, snapshot.digest),
+            {"etag": snapshot.etag, "last_modified": snapshot.last_modified},
+        )
+
+    def _to_extracted(
+        self, digest: str, entity_id: str, entity: Optional["etree.Element"]
+    ) -> ExtractedSamlData:
+        """Extract the SAML data from an EntityDescriptor element and cache it.
+
+        Args:
+            digest: SHA-256 of the raw metadata.
+            entity_id: Entity ID the data is extracted for.
+            entity: the EntityDescriptor element or None if the entity is not present.
+
+        Returns:
+            The extracted SAML data.
+        """
+        certificates, endpoints = _extract_entity(entity) if entity is not None else ([], [])
+        valid_until, cache_duration = (
+            _extract_validity(entity) if entity is not None else (None, None)
+        )
+        extracted = ExtractedSamlData(
+            digest=digest,
+            entity_id=entity_id,
+            fingerprint=self._charm_state.fingerprint,
+            certificates=certificates,
+            endpoints=endpoints,
+            valid_until=valid_until,
+            cache_duration=cache_duration,
+            # Only trusted by the following extractions if they are streamed too
+            streamed=self._charm_state.metadata_streaming,
+        )
+        if self._cache:
+            self._cache.save_extracted(extracted)
+        return extracted
+
+    def _extract(
+        self, metadata: FetchedMetadata, entity_ids: Collection[str]
+    ) -> dict[str, ExtractedSamlData]:
+        """Extract the SAML data of several entities from the raw metadata in a single pass.
+
+        Previous extractions are reused when possible.
+
+        Args:
+            metadata: the downloaded metadata.
+            entity_ids: the entity IDs to extract the data for.
+
+        Returns:
+            The extracted SAML data, by entity ID.
+        """
+        raw_data, digest = metadata.content, metadata.digest
+        extracted: dict[str, ExtractedSamlData] = {}
+        if self._cache and not self._force:
+            for entity_id in entity_ids:
+                cached = self._cache.load_extracted(
+                    digest,
+                    entity_id,
+                    self._charm_state.fingerprint,
+                    self._charm_state.metadata_streaming,
+                )
+                if cached:
+                    logger.info("Reusing the SAML data extracted from metadata %s", digest)
+                    extracted[entity_id] = cached
+                    continue
+                indexed = self._index_extract(raw_data, digest, entity_id)
+                if indexed:
+                    logger.info("Extracted %s from the metadata index", entity_id)
+                    self._cache.save_extracted(indexed)
+                    extracted[entity_id] = indexed
+        pending = [entity_id for entity_id in entity_ids if entity_id not in extracted]
+        if not pending:
+            return extracted
+        document: Optional[MetadataDocument] = None
+        entities: dict[str, "etree.Element"] = {}
+        if self._charm_state.metadata_streaming:
+            entities = self._stream_entities(raw_data, pending)
+        else:
+            document = self._load_document(metadata)
+            if self._cache and not self._cache.has_document(digest):
+                self._cache.save_document(digest, raw_data, self._build_index(raw_data, document))
+        with TRACER.span(
+            "SamlIntegrator.extract",
+            mode="streaming" if document is None else "document",
+            entities=len(pending),
+        ):
+            if document is not None:
+                entities = document.entities(pending)
+            for entity_id in pending:
+                extracted[entity_id] = self._to_extracted(
+                    digest, entity_id, entities.get(entity_id)
+                )
+        return extracted
+
+    @staticmethod
+    def _build_index(raw_data: bytes, document: MetadataDocument) -> Optional[EntityIndex]:
+        """Build the entity index of a verified metadata aggregate.
+
+        Args:
+            raw_data: the raw metadata.
+            document: the verified metadata snapshot.
+
+        Returns:
+            The entity index or None if the metadata is not an aggregate.
+        """
+        located = build_entity_index(raw_data)
+        if not located:
+            return None
+        root, root_name, entities = located
+        # The index is only trusted if it locates the same entities as the verified document.
+        # The entities are parsed wrapped in the root only, so the nested ones aren't indexed as
+        # the attributes of their other ancestors, such as validUntil, would be lost.
+        verified = dict.fromkeys(
+            element.get("entityID")
+            for element in document.tree.iterchildren(ENTITY_DESCRIPTOR_TAG)
+        )
+        if list(entities) != list(verified):
+            logger.warning(
+                "Not indexing metadata %s, its entities can't be located", document.digest
+            )
+            return None
+        return EntityIndex(
+            digest=cast(str, document.digest),
+            root=root,
+            root_name=root_name,
+            signing_certificate=document.signing_certificate,
+            signed=document.signature is not None,
+            entities=entities,
+        )
+
+    def _index_extract(
+        self, raw_data: bytes, digest: str, entity_id: str
+    ) -> Optional[ExtractedSamlData]:
+        """Extract the SAML data parsing only the given entity of an indexed aggregate.
+
+        This is only possible if the whole metadata has been verified before with the same
+        signing certificate and fingerprint.
+
+        Args:
+            raw_data: the raw metadata.
+            digest: SHA-256 of the raw metadata.
+            entity_id: the entity ID to extract the data for.
+
+        Returns:
+            The extracted SAML data or None if the entity can't be extracted from the index.
+        """
+        cache = cast(MetadataCache, self._cache)
+        index = cache.load_index(digest)
+        fingerprint = self._charm_state.fingerprint
+        if not index or (
+            fingerprint and not fingerprint_matches(index.signing_certificate, fingerprint)
+        ):
+            return None
+        if (
+            index.signed
+            and index.signing_certificate
+            and not cache.is_signature_verified(
+                digest, index.signing_certificate, fingerprint, count_miss=False
+            )
+        ):
+            return None
+        entity = parse_indexed_entity(raw_data, index, entity_id)
+        if entity is None:
+            return None
+        with TRACER.span("SamlIntegrator.extract", mode="index", entities=1):
+            certificates, endpoints = _extract_entity(entity)
+            valid_until, cache_duration = _extract_validity(entity)
+            return ExtractedSamlData(
+                digest=digest,
+                entity_id=entity_id,
+                fingerprint=fingerprint,
+                certificates=certificates,
+                endpoints=endpoints,
+                valid_until=valid_until,
+                cache_duration=cache_duration,
+            )
+
+    def _stream_entities(
+        self, raw_data: bytes, entity_ids: Collection[str]
+    ) -> dict[str, "etree.Element"]:
+        """Find several entities reading the raw metadata incrementally.
+
+        The metadata is never fully loaded in memory, hence its signature can't be verified.
+
+        Args:
+            raw_data: the raw metadata.
+            entity_ids: the entity IDs to look for.
+
+        Returns:
+            The EntityDescriptor elements found, by entity ID.
+
+        Raises:
+            CharmConfigInvalidError: if the metadata can't be parsed.
+        """
+        # Lazy importing. Required deb packages won't be present on charm startup
+        from lxml import etree  # nosec
+
+        try:
+            with RECORDER.time(PARSE_DURATION, mode="streaming"), TRACER.span(
+                "SamlIntegrator.parse", mode="streaming", size=len(raw_data)
+            ):
+                return stream_entities(raw_data, entity_ids)
         except etree.XMLSyntaxError as ex:
             raise CharmConfigInvalidError(
                 f"Data from {self._charm_state.metadata_url} can't be parsed"
             ) from ex
 
     @cached_property
-    def tree(self) -> "etree.ElementTree":
-        """Fetch and validate the metadata contents.
+    def snapshot(self) -> MetadataSnapshot:
+        """Return the SAML data extracted from the metadata.
 
         Returns:
-            The metadata as an XML tree.
+            The extracted SAML data.
+        """
+        entity_id = self._charm_state.entity_id
+        if self._metadata is None:
+            previous = self._load_previous_snapshot()
+            metadata = self._revalidate(previous) if previous else self._fetcher.fetch()
+            if metadata is None:
+                now = datetime.now(timezone.utc)
+                RECORDER.set(LAST_REFRESH, now.timestamp())
+                revalidated = cast(MetadataSnapshot, previous).copy(update={"fetched_at": now})
+                if self._cache:
+                    self._cache.save_snapshot(revalidated)
+                self._extracted[entity_id] = revalidated
+                return revalidated
+            self._metadata = metadata
+        snapshot = MetadataSnapshot(
+            metadata_url=str(self._charm_state.metadata_url),
+            **self._extract(self._metadata, [entity_id])[entity_id].dict(),
+            **self._metadata.validators,
+            fetched_at=datetime.now(timezone.utc),
+        )
+        RECORDER.set(LAST_REFRESH, cast(datetime, snapshot.fetched_at).timestamp())
+        if self._cache:
+            self._cache.save_snapshot(snapshot)
+        self._extracted[entity_id] = snapshot
+        return snapshot
 
-        Raises:
-            CharmConfigInvalidError: if the metadata URL or the metadata itself is invalid.
+    def entities(self, entity_ids: Iterable[str]) -> dict[str, ExtractedSamlData]:
+        """Return the SAML data of several entities, extracted from a single metadata fetch.
+
+        Args:
+            entity_ids: the entity IDs to extract the data for.
+
+        Returns:
+            The extracted SAML data, by entity ID.
         """
-        # Lazy importing. Required deb packages won't be present on charm startup
-        import signxml
+        requested = list(dict.fromkeys(entity_ids))
+        if all(entity_id in self._extracted for entity_id in requested):
+            return {entity_id: self._extracted[entity_id] for entity_id in requested}
+        snapshot = self.snapshot
+        pending = [entity_id for entity_id in requested if entity_id not in self._extracted]
+        if pending and self._metadata is None and self._cache and snapshot.digest:
+            # The metadata wasn't modified, so the extractions from it are still valid
+            for entity_id in pending:
+                cached = self._cache.load_extracted(
+                    snapshot.digest,
+                    entity_id,
+                    self._charm_state.fingerprint,
+                    self._charm_state.metadata_streaming,
+                )
+                if cached:
+                    self._extracted[entity_id] = cached
+            pending = [entity_id for entity_id in pending if entity_id not in self._extracted]
+        if pending:
+            if self._metadata is None:
+                self._metadata = self._load_cached_metadata(snapshot) or self._fetcher.fetch()
+            self._extracted.update(self._extract(self._metadata, pending))
+        return {entity_id: self._extracted[entity_id] for entity_id in requested}
 
-        if self._charm_state.fingerprint and (
-            not self.signing_certificate
-            or not secrets.compare_digest(
-                hashlib.sha256(base64.b64decode(self.signing_certificate)).hexdigest(),
-                self._charm_state.fingerprint.replace(":", "").replace(" ", ""),
-            )
+    def is_refresh_due(self) -> bool:
+        """Check if the metadata has to be refreshed according to its cacheDuration and validUntil.
+
+        Returns:
+            True if there's no persisted snapshot for the metadata URL or it has to be refreshed.
+        """
+        previous = self._load_previous_snapshot()
+        return previous is None or datetime.now(timezone.utc) >= previous.next_refresh(
+            timedelta(seconds=self._charm_state.metadata_refresh_interval),
+            timedelta(seconds=self._charm_state.metadata_min_refresh_interval),
+            timedelta(seconds=self._charm_state.metadata_max_refresh_interval),
+        )
+
+    def cached_entities(self, entity_ids: Iterable[str]) -> Optional[dict[str, ExtractedSamlData]]:
+        """Return the SAML data of several entities from the persisted snapshot, without fetching.
+
+        Args:
+            entity_ids: the entity IDs to return the data for.
+
+        Returns:
+            The extracted SAML data, by entity ID, or None if the cache doesn't hold the data of
+            all the entities for the current configuration.
+        """
+        previous = self._load_previous_snapshot()
+        if not previous or not previous.matches(
+            self._charm_state.metadata_url,
+            self._charm_state.entity_id,
+            self._charm_state.fingerprint,
+            self._charm_state.metadata_streaming,
         ):
-            raise CharmConfigInvalidError("The metadata signature does not match the provided one")
-        tree = self._read_tree()
-        if self.signing_certificate and self.signature:
-            # The metadata can be tampered unless the metadata contents used are signed. To prevent
-            # this, instead of arbitrarily validating the signature for all fragments that can be
-            # shared with the requirer, the whole contents will need to be signed.
-            try:
-                signxml.XMLVerifier().verify(tree, x509_cert=self.signing_certificate)
-            except signxml.exceptions.InvalidSignature as ex:
-                raise CharmConfigInvalidError("The metadata has an invalid signature") from ex
-        return tree
+            return None
+        extracted: dict[str, ExtractedSamlData] = {}
+        for entity_id in dict.fromkeys(entity_ids):
+            if entity_id == previous.entity_id:
+                cached: Optional[ExtractedSamlData] = previous
+            elif previous.digest:
+                cached = cast(MetadataCache, self._cache).load_extracted(
+                    previous.digest,
+                    entity_id,
+                    self._charm_state.fingerprint,
+                    self._charm_state.metadata_streaming,
+                )
+            else:
+                cached = None
+            if not cached:
+                return None
+            extracted[entity_id] = cached
+        self._extracted.update(extracted)
+        return extracted
 
-    @cached_property
+    @property
+    def tree(self) -> "etree.ElementTree":
+        """Fetch and validate the metadata contents.
+
+        Returns:
+            The metadata as an XML tree.
+        """
+        return self.document.tree
+
+    @property
     def nsmap(self) -> dict:
         """Get namespaces.
 
         Returns:
             The namespaces list without None.
         """
-        return {
-            "md": "urn:oasis:names:tc:SAML:2.0:metadata",
-            "ds": "http://www.w3.org/2000/09/xmldsig#",
-        }
+        return NAMESPACES
 
-    @cached_property
+    @property
     def signing_certificate(self) -> str | None:
         """Return the signing certificate for the metadata, if any."""
-        tree = self._read_tree()
-        signing_certificates = tree.xpath(
-            "//md:KeyDescriptor[@use='signing']//ds:X509Certificate/text()",
-            namespaces=self.nsmap,
-        )
-        return next(iter(signing_certificates), None)
+        return self.document.signing_certificate
 
-    @cached_property
+    @property
     def signature(self) -> Optional["etree.ElementTree"]:
         """Check if the metadata has a Signature element."""
-        tree = self._read_tree()
-        signature = tree.xpath(
-            "//ds:Signature",
-            namespaces=self.nsmap,
-        )
-        return signature[0] if signature else None
+        return self.document.signature
 
-    @cached_property
+    @property
     def certificates(self) -> list[str]:
         """Return public certificates defined in the metadata.
 
         Returns:
             List of certificates.
         """
-        tree = self.tree
-        return sorted(
-            tree.xpath(
-                (
-                    f"//md:EntityDescriptor[@entityID='{self._charm_state.entity_id}']"
-                    "//md:KeyDescriptor//ds:X509Certificate/text()"
-                ),
-                namespaces=self.nsmap,
-            )
-        )
+        return self.snapshot.certificates
 
-    @cached_property
+    @property
     def endpoints(self) -> list[saml.SamlEndpoint]:
         """Return endpoints defined in the metadata.
 
         Returns:
             List of endpoints.
         """
-        # Lazy importing. Required deb packages won't be present on charm startup
-        from lxml import etree  # nosec
-
-        tree = self.tree
-        results = tree.xpath(
-            (
-                f"//md:EntityDescriptor[@entityID='{self._charm_state.entity_id}']"
-                f"//md:SingleSignOnService | "
-                f"//md:EntityDescriptor[@entityID='{self._charm_state.entity_id}']"
-                f"//md:SingleLogoutService"
-            ),
-            namespaces=self.nsmap,
-        )
-        endpoints = []
-        for result in results:
-            endpoints.append(
-                saml.SamlEndpoint(
-                    name=etree.QName(result).localname,
-                    url=result.get("Location"),
-                    binding=result.get("Binding"),
-                    response_url=result.get("ResponseLocation"),
-                )
-            )
-        return endpoints
+        return self.snapshot.endpoints
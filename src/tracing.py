@@ -0,0 +1,265 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Provide the Tracer class to record nested spans of the work done in a hook.
+
+The spans of a trace are exported once its root span ends, as a line of OpenTelemetry (OTLP)
+JSON appended to a local file, rotated once it grows past TRACES_MAX_SIZE. Each line can be
+replayed to an OpenTelemetry collector as is.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional, TypeVar, cast
+
+logger = logging.getLogger(__name__)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+SERVICE_NAME = "saml-integrator"
+TRACES_FILENAME = "traces.jsonl"
+TRACES_MAX_SIZE = 1024 * 1024
+TRACES_BACKUP_COUNT = 3
+# OTLP span kind and status codes
+SPAN_KIND_INTERNAL = 1
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+
+def _attribute(key: str, value: Any) -> dict[str, Any]:
+    """Convert an attribute to its OTLP JSON representation.
+
+    Args:
+        key: the attribute name.
+        value: the attribute value.
+
+    Returns:
+        The OTLP attribute.
+    """
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Span:  # pylint: disable=too-many-instance-attributes
+    """Represent a timed operation, part of a trace.
+
+    Attrs:
+        name: the operation name.
+        trace_id: identifier of the trace, shared by all its spans.
+        span_id: identifier of the span.
+        parent: the parent span, if any.
+        root: the root span of the trace.
+        attributes: attributes describing the operation.
+        spans: the ended spans of the trace, only held by the root span.
+    """
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict[str, Any]):
+        """Initialize a new instance of the Span class, starting it.
+
+        Args:
+            name: the operation name.
+            parent: the parent span, if any.
+            attributes: attributes describing the operation.
+        """
+        self.name = name
+        self.parent = parent
+        self.trace_id: str = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id: str = secrets.token_hex(8)
+        self.attributes = attributes
+        self.spans: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._start = time.time_ns()
+        self._error: Optional[str] = None
+
+    @property
+    def root(self) -> "Span":
+        """Get the root span of the trace.
+
+        Returns:
+            The root span.
+        """
+        return self.parent.root if self.parent else self
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Set an attribute of the span.
+
+        Args:
+            key: the attribute name.
+            value: the attribute value.
+        """
+        self.attributes[key] = value
+
+    def set_error(self, error: BaseException) -> None:
+        """Mark the span as failed.
+
+        Args:
+            error: the exception the operation failed with.
+        """
+        self._error = f"{type(error).__name__}: {error}"
+
+    def durations(self) -> dict[str, float]:
+        """Get the time spent in the ended spans nested in this one.
+
+        Returns:
+            The seconds spent, by span name.
+        """
+        root = self.root
+        with root._lock:  # pylint: disable=protected-access
+            spans = list(root.spans)
+        parents = {span["spanId"]: span["parentSpanId"] for span in spans}
+        durations: dict[str, float] = {}
+        for span in spans:
+            ancestor = span["parentSpanId"]
+            while ancestor and ancestor != self.span_id:
+                ancestor = parents.get(ancestor, "")
+            if ancestor:
+                elapsed = int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])
+                durations[span["name"]] = durations.get(span["name"], 0) + elapsed / 1e9
+        return durations
+
+    def end(self) -> None:
+        """End the span, recording it in the root span."""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent.span_id if self.parent else "",
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self._start),
+            "endTimeUnixNano": str(time.time_ns()),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items()],
+            "status": (
+                {"code": STATUS_CODE_ERROR, "message": self._error}
+                if self._error
+                else {"code": STATUS_CODE_OK}
+            ),
+        }
+        root = self.root
+        with root._lock:  # pylint: disable=protected-access
+            root.spans.append(span)
+
+
+class Tracer:
+    """Record nested spans, exporting each trace to a local file once its root span ends.
+
+    The current span is tracked in a context variable, so the spans started in a thread are
+    nested under the span that started the thread if it runs in a copy of its context.
+
+    Attrs:
+        path: file the traces are exported to, if any.
+    """
+
+    def __init__(self) -> None:
+        """Initialize a new instance of the Tracer class."""
+        self.path: Optional[Path] = None
+        self._current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+            "current_span", default=None
+        )
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Record a span for the operation run in the block, nested in the current one.
+
+        Args:
+            name: the operation name.
+            attributes: attributes describing the operation.
+
+        Yields:
+            The started span.
+
+        Raises:
+            BaseException: the exception raised in the block, once the span is marked as failed.
+        """
+        span = Span(name, self._current.get(), attributes)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as ex:
+            span.set_error(ex)
+            raise
+        finally:
+            self._current.reset(token)
+            span.end()
+            if span.parent is None:
+                self._export(span)
+
+    def traced(self, function: F) -> F:
+        """Decorate a function to record a span for each call, named after the function.
+
+        Args:
+            function: the function to trace.
+
+        Returns:
+            The decorated function.
+        """
+
+        @functools.wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            """Call the function in a span.
+
+            Args:
+                args: the positional arguments.
+                kwargs: the keyword arguments.
+
+            Returns:
+                The value returned by the function.
+            """
+            with self.span(function.__qualname__):
+                return function(*args, **kwargs)
+
+        return cast(F, wrapper)
+
+    def _export(self, root: Span) -> None:
+        """Append a trace to the traces file, rotating it if needed.
+
+        Args:
+            root: the root span of the trace.
+        """
+        if not self.path:
+            return
+        resource = {
+            "service.name": SERVICE_NAME,
+            "juju.unit": os.environ.get("JUJU_UNIT_NAME", ""),
+            "juju.dispatch_path": os.environ.get("JUJU_DISPATCH_PATH", ""),
+        }
+        line = json.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": [
+                                _attribute(key, value) for key, value in resource.items()
+                            ]
+                        },
+                        "scopeSpans": [{"scope": {"name": __name__}, "spans": root.spans}],
+                    }
+                ]
+            }
+        )
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.path.exists() and self.path.stat().st_size + len(line) > TRACES_MAX_SIZE:
+                for index in range(TRACES_BACKUP_COUNT - 1, 0, -1):
+                    backup = self.path.with_name(f"{self.path.name}.{index}")
+                    if backup.exists():
+                        backup.replace(self.path.with_name(f"{self.path.name}.{index + 1}"))
+                self.path.replace(self.path.with_name(f"{self.path.name}.1"))
+            with open(self.path, "a", encoding="utf-8") as traces_file:
+                traces_file.write(line + "\n")
+        except OSError as ex:
+            logger.warning("Failed to export the trace to %s: %s", self.path, ex)
+
+
+TRACER = Tracer()
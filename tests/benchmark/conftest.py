@@ -0,0 +1,54 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Benchmark fixtures."""
+
+from pathlib import Path
+
+import pytest
+
+ENTITY_TEMPLATE = """
+    <md:EntityDescriptor entityID="https://idp{index}.federation.test">
+        <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+            <md:KeyDescriptor use="signing">
+                <ds:KeyInfo>
+                    <ds:X509Data>
+                        <ds:X509Certificate>{certificate}</ds:X509Certificate>
+                    </ds:X509Data>
+                </ds:KeyInfo>
+            </md:KeyDescriptor>
+            <md:SingleLogoutService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+                Location="https://idp{index}.federation.test/slo" />
+            <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+                Location="https://idp{index}.federation.test/sso" />
+            <md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+                Location="https://idp{index}.federation.test/sso" />
+        </md:IDPSSODescriptor>
+    </md:EntityDescriptor>"""
+
+AGGREGATE_ENTITIES = 5000
+
+
+@pytest.fixture(scope="session", name="aggregate_path")
+def aggregate_path_fixture(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """Generate a federation aggregate similar in size to the large public federations.
+
+    Args:
+        tmp_path_factory: pytest temporary path factory.
+
+    Returns:
+        Path to the generated metadata.
+    """
+    certificate = "MIIFazCCA1OgAwIBAgIU" + "A" * 1800
+    entities = "".join(
+        ENTITY_TEMPLATE.format(index=index, certificate=certificate)
+        for index in range(AGGREGATE_ENTITIES)
+    )
+    path = tmp_path_factory.mktemp("benchmark") / "aggregate.xml"
+    path.write_text(
+        '<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"'
+        ' xmlns:ds="http://www.w3.org/2000/09/xmldsig#">'
+        f"{entities}\n</md:EntitiesDescriptor>",
+        encoding="utf-8",
+    )
+    return path
@@ -0,0 +1,55 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Benchmark of the charm construction, done at the start of every hook."""
+
+import timeit
+from unittest.mock import MagicMock
+
+from ops.testing import Harness
+
+from charm import SamlIntegratorOperatorCharm
+from charm_state import CharmState
+
+CONFIG = {
+    "entity_id": "https://login.staging.ubuntu.com",
+    "fingerprint": "1c:73:51:f2:0f:1b:ff:9e:4f:d1:c0:3b:41:6e:0b:35",
+    "metadata_url": (
+        "https://login.staging.ubuntu.com/saml/metadata https://mirror.federation.test/metadata"
+    ),
+}
+NUMBER = 1000
+REPEAT = 5
+
+
+def test_charm_construction(tmp_path, monkeypatch):
+    """
+    arrange: set up a configured charm.
+    act: build the charm state with and without a memoized configuration, and the whole charm.
+    assert: the memoized configuration is faster to load than validating it.
+    """
+    monkeypatch.setattr("charm.STATE_DIR", tmp_path)
+    charm = MagicMock(config=CONFIG)
+    memo = {}
+    CharmState.from_charm(charm, memo=memo)
+
+    validated = min(
+        timeit.repeat(lambda: CharmState.from_charm(charm), number=NUMBER, repeat=REPEAT)
+    )
+    memoized = min(
+        timeit.repeat(
+            lambda: CharmState.from_charm(charm, memo=memo), number=NUMBER, repeat=REPEAT
+        )
+    )
+
+    def construct() -> None:
+        """Construct the charm, as done at the start of a hook."""
+        harness = Harness(SamlIntegratorOperatorCharm)
+        harness.update_config(CONFIG)
+        harness.begin()
+
+    constructed = min(timeit.repeat(construct, number=10, repeat=REPEAT)) / 10
+    print(f"\n   validated state: {validated / NUMBER * 1e6:.1f} us")
+    print(f"    memoized state: {memoized / NUMBER * 1e6:.1f} us")
+    print(f"charm construction: {constructed * 1e3:.2f} ms, Harness included")
+    assert memoized < validated
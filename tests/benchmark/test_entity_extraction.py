@@ -0,0 +1,120 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Microbenchmarks for the extraction of the SAML data from the metadata."""
+
+import timeit
+from pathlib import Path
+
+from charms.saml_integrator.v0 import saml as saml_library
+from lxml import etree  # nosec
+
+import saml
+
+from .conftest import AGGREGATE_ENTITIES
+
+REPEAT = 5
+
+
+def extract_entity_with_xpath(
+    entity: "etree.Element",
+) -> tuple[list[str], list[saml_library.SamlEndpoint]]:
+    """Extract the SAML data of an entity as the charm used to, with uncompiled XPaths.
+
+    Args:
+        entity: the EntityDescriptor element.
+
+    Returns:
+        The certificates and endpoints of the entity.
+    """
+    certificates = sorted(
+        entity.xpath(".//md:KeyDescriptor//ds:X509Certificate/text()", namespaces=saml.NAMESPACES)
+    )
+    endpoints = [
+        saml_library.SamlEndpoint(
+            name=etree.QName(result).localname,
+            url=result.get("Location"),
+            binding=result.get("Binding"),
+            response_url=result.get("ResponseLocation"),
+        )
+        for result in entity.xpath(
+            ".//md:SingleSignOnService | .//md:SingleLogoutService", namespaces=saml.NAMESPACES
+        )
+    ]
+    return certificates, endpoints
+
+
+def locate_with_xpath(entity: "etree.Element") -> tuple[list[str], list["etree.Element"]]:
+    """Locate the certificates and endpoints of an entity with the uncompiled XPaths.
+
+    Args:
+        entity: the EntityDescriptor element.
+
+    Returns:
+        The certificates and the endpoint elements of the entity.
+    """
+    return entity.xpath(
+        ".//md:KeyDescriptor//ds:X509Certificate/text()", namespaces=saml.NAMESPACES
+    ), entity.xpath(
+        ".//md:SingleSignOnService | .//md:SingleLogoutService", namespaces=saml.NAMESPACES
+    )
+
+
+def best_time(function) -> float:
+    """Time a function, keeping the best of several runs.
+
+    Args:
+        function: the function to time.
+
+    Returns:
+        The best elapsed time, in seconds.
+    """
+    return min(timeit.repeat(function, number=1, repeat=REPEAT))
+
+
+def test_entity_extraction_time(aggregate_path: Path):
+    """
+    arrange: parse a large federation aggregate.
+    act: extract the data of all its entities with the uncompiled XPaths and with a single walk.
+    assert: both extract the same data and the single walk locates the elements faster.
+    """
+    tree = etree.fromstring(aggregate_path.read_bytes())  # nosec
+    entities = list(tree.iter(saml.ENTITY_DESCRIPTOR_TAG))
+    extract_entity = saml._extract_entity  # pylint: disable=protected-access
+    assert [extract_entity_with_xpath(entity) for entity in entities] == [
+        extract_entity(entity) for entity in entities
+    ]
+    tags = (saml.KEY_DESCRIPTOR_TAG, *saml.ENDPOINT_TAGS)
+
+    timings = {
+        "xpath": best_time(lambda: [extract_entity_with_xpath(entity) for entity in entities]),
+        "walk": best_time(lambda: [extract_entity(entity) for entity in entities]),
+        # Building the SamlEndpoint models costs the same with both, so the lookup is also timed
+        "xpath lookup": best_time(lambda: [locate_with_xpath(entity) for entity in entities]),
+        "walk lookup": best_time(lambda: [list(entity.iter(*tags)) for entity in entities]),
+    }
+
+    print(f"\n{AGGREGATE_ENTITIES} entities")
+    for name, elapsed in timings.items():
+        print(f"{name:>14}: {elapsed * 1000:8.1f} ms, {elapsed / AGGREGATE_ENTITIES * 1e6:.1f} us")
+    assert timings["walk lookup"] < timings["xpath lookup"]
+
+
+def test_document_xpath_time(aggregate_path: Path):
+    """
+    arrange: parse a large federation aggregate.
+    act: look for the signing certificates with an XPath string and with the compiled XPath.
+    assert: both find the same certificates.
+    """
+    tree = etree.fromstring(aggregate_path.read_bytes())  # nosec
+    compiled = saml.compiled_xpath(saml.SIGNING_CERTIFICATES_XPATH)
+    assert tree.xpath(saml.SIGNING_CERTIFICATES_XPATH, namespaces=saml.NAMESPACES) == compiled(
+        tree
+    )
+
+    string = best_time(
+        lambda: tree.xpath(saml.SIGNING_CERTIFICATES_XPATH, namespaces=saml.NAMESPACES)
+    )
+    precompiled = best_time(lambda: compiled(tree))
+
+    print(f"\n  string: {string * 1000:8.1f} ms\ncompiled: {precompiled * 1000:8.1f} ms")
@@ -0,0 +1,87 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Benchmarks for the metadata parsing."""
+
+import json
+import subprocess  # nosec
+import sys
+from pathlib import Path
+
+from .conftest import AGGREGATE_ENTITIES
+
+# Each measurement runs in a fresh interpreter so that the peak RSS of one mode doesn't leak
+# into the other.
+MEASURE_SCRIPT = """
+import hashlib, json, sys, time
+from types import SimpleNamespace
+from metadata_fetcher import FetchedMetadata
+from saml import SamlIntegrator
+
+path, mode, entity_id = sys.argv[1:]
+raw_data = open(path, "rb").read()
+integrator = SamlIntegrator(
+    charm_state=SimpleNamespace(
+        entity_id=entity_id,
+        fingerprint=None,
+        metadata_max_size=128,
+        metadata_streaming=mode == "streaming",
+        metadata_url="https://federation.test/metadata",
+        metadata_urls=("https://federation.test/metadata",),
+    )
+)
+metadata = FetchedMetadata(raw_data, hashlib.sha256(raw_data).hexdigest(), {})
+start = time.perf_counter()
+if mode != "baseline":
+    extracted = integrator._extract(metadata, [entity_id])[entity_id]
+    assert extracted.endpoints
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "elapsed": elapsed,
+    # Unlike ru_maxrss, VmHWM isn't inherited from the parent process
+    "max_rss_kib": next(
+        int(line.split()[1]) for line in open("/proc/self/status") if line.startswith("VmHWM:")
+    ),
+}))
+"""
+
+
+def measure(path: Path, mode: str, entity_id: str) -> dict:
+    """Measure the extraction of an entity in a separate interpreter.
+
+    Args:
+        path: path to the metadata.
+        mode: "baseline", "dom" or "streaming".
+        entity_id: the entity to extract.
+
+    Returns:
+        The elapsed time and peak RSS.
+    """
+    output = subprocess.check_output(  # nosec
+        [sys.executable, "-c", MEASURE_SCRIPT, str(path), mode, entity_id]
+    )
+    return json.loads(output)
+
+
+def test_streaming_extraction_peak_memory_and_time(aggregate_path):
+    """
+    arrange: generate a large federation aggregate.
+    act: extract the last entity with the full document and with streaming.
+    assert: streaming needs less memory on top of the raw data than building the whole tree.
+    """
+    entity_id = f"https://idp{AGGREGATE_ENTITIES - 1}.federation.test"
+
+    baseline = measure(aggregate_path, "baseline", entity_id)
+    dom = measure(aggregate_path, "dom", entity_id)
+    streaming = measure(aggregate_path, "streaming", entity_id)
+
+    size_mib = aggregate_path.stat().st_size / 2**20
+    print(f"\nmetadata size: {size_mib:.1f} MiB, {AGGREGATE_ENTITIES} entities")
+    for name, result in (("dom", dom), ("streaming", streaming)):
+        print(
+            f"{name:>10}: {result['elapsed'] * 1000:8.1f} ms, "
+            f"peak RSS +{(result['max_rss_kib'] - baseline['max_rss_kib']) / 1024:.1f} MiB"
+        )
+    assert streaming["max_rss_kib"] - baseline["max_rss_kib"] < (
+        dom["max_rss_kib"] - baseline["max_rss_kib"]
+    )
@@ -0,0 +1,90 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Benchmark of the relation data writes needed to publish the SAML data."""
+
+import timeit
+from unittest.mock import patch
+
+from charms.saml_integrator.v0 import saml
+from ops.testing import Harness
+
+from tests.unit.test_library_saml import PROVIDER_METADATA, SamlProviderCharm
+
+ENDPOINTS = 500
+REPEAT = 5
+
+
+def get_saml_data(endpoints: int) -> saml.SamlRelationData:
+    """Build SAML data with many endpoints, each published as two keys.
+
+    Args:
+        endpoints: number of endpoints.
+
+    Returns:
+        The SAML data.
+    """
+    return saml.SamlRelationData(
+        entity_id="https://idp.federation.test",
+        metadata_url="https://federation.test/metadata",
+        certificates=["cert_content"],
+        endpoints=[
+            saml.SamlEndpoint(
+                name=f"Service{index}",
+                url=f"https://idp.federation.test/service{index}",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+            )
+            for index in range(endpoints)
+        ],
+    )
+
+
+def test_relation_data_write_volume():
+    """
+    arrange: set up a provider charm with a relation holding the data of many endpoints.
+    act: publish the same data and the data without one of the endpoints, replacing the whole
+        databag content as the library used to and reconciling it.
+    assert: reconciling writes only the keys that changed, deleting the stale ones.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.set_leader(True)
+    harness.begin()
+    relation = harness.model.get_relation("saml", harness.add_relation("saml", "indico"))
+    saml_data = get_saml_data(ENDPOINTS)
+    updated_saml_data = get_saml_data(ENDPOINTS - 1)
+    harness.charm.saml.update_relation_data(relation, saml_data)
+    databag = relation.data[harness.model.app]
+    # Each write is a relation-set call in a deployed charm
+    # pylint: disable=protected-access
+    with patch.object(
+        harness._backend, "update_relation_data", wraps=harness._backend.update_relation_data
+    ) as relation_set_mock:
+        databag.update(saml_data.to_relation_data())
+        full_unchanged = relation_set_mock.call_count
+        relation_set_mock.reset_mock()
+        databag.update(updated_saml_data.to_relation_data())
+        full_removed = relation_set_mock.call_count
+        relation_set_mock.reset_mock()
+
+        harness.charm.saml.update_relation_data(relation, saml_data)
+        relation_set_mock.reset_mock()
+        harness.charm.saml.update_relation_data(relation, saml_data)
+        reconciled_unchanged = relation_set_mock.call_count
+        harness.charm.saml.update_relation_data(relation, updated_saml_data)
+        reconciled_removed = relation_set_mock.call_count - reconciled_unchanged
+
+    elapsed = min(
+        timeit.repeat(
+            lambda: harness.charm.saml.update_relation_data(relation, updated_saml_data),
+            number=1,
+            repeat=REPEAT,
+        )
+    )
+    print(f"\n{ENDPOINTS} endpoints, {len(saml_data.to_relation_data())} keys")
+    print(f"   full update, unchanged: {full_unchanged} writes")
+    print(f"full update, one removed: {full_removed} writes, 2 stale keys left")
+    print(f"    reconcile, unchanged: {reconciled_unchanged} writes, {elapsed * 1000:.1f} ms")
+    print(f" reconcile, one removed: {reconciled_removed} writes")
+    assert reconciled_unchanged == 0
+    assert reconciled_removed == 2
+    assert databag == updated_saml_data.to_relation_data()
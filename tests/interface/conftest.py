@@ -3,6 +3,7 @@
 
 """Fixtures for charm-relation-interfaces tests."""
 
+from pathlib import Path
 from unittest import mock
 
 import ops
@@ -11,8 +12,10 @@ from charms.saml_integrator.v0.saml import SamlEndpoint
 from interface_tester.plugin import InterfaceTester
 from scenario import State
 
+import charm
 import saml
 from charm import SamlIntegratorOperatorCharm
+from metadata_cache import ExtractedSamlData
 
 
 # Interface tests are centrally hosted at https://github.com/canonical/charm-relation-interfaces.
@@ -22,21 +25,38 @@ from charm import SamlIntegratorOperatorCharm
 # https://github.com/canonical/charm-relation-interfaces and change saml's test configuration
 # to include the new identifier/location.
 @pytest.fixture
-def interface_tester(interface_tester: InterfaceTester, monkeypatch: pytest.MonkeyPatch):
+def interface_tester(
+    interface_tester: InterfaceTester, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
     def _on_install_patched(self, _) -> None:
         """Patched start event handler."""
         self.unit.status = ops.ActiveStatus()
 
     monkeypatch.setattr(SamlIntegratorOperatorCharm, "_on_install", _on_install_patched)
+    monkeypatch.setattr(charm, "STATE_DIR", tmp_path)
 
     sso_endpoint = SamlEndpoint(
         name="SingleSignOnService",
         url="https://login.staging.ubuntu.com/saml/",
         binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
     )
+    extracted = ExtractedSamlData(
+        digest=None,
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=None,
+        certificates=["cert_content"],
+        endpoints=[sso_endpoint],
+    )
+
+    def _entities_patched(_, entity_ids):
+        """Patched entities returning the same SAML data for every entity."""
+        return {
+            entity_id: extracted.copy(update={"entity_id": entity_id}) for entity_id in entity_ids
+        }
+
     with (
-        mock.patch.object(saml.SamlIntegrator, "certificates", ["cert_content"]),
-        mock.patch.object(saml.SamlIntegrator, "endpoints", [sso_endpoint]),
+        mock.patch.object(saml.SamlIntegrator, "entities", _entities_patched),
+        mock.patch.object(saml.SamlIntegrator, "cached_entities", _entities_patched),
     ):
         interface_tester.configure(
             charm_type=SamlIntegratorOperatorCharm,
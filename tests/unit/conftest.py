@@ -0,0 +1,228 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Unit tests fixtures."""
+
+import http.server
+import threading
+import time
+import typing
+from pathlib import Path
+from unittest.mock import MagicMock
+
+import pytest
+
+import charm
+import refresher
+from metrics import RECORDER
+from tracing import TRACER
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    """Use a temporary directory as the charm state directory.
+
+    Args:
+        tmp_path: pytest temporary directory.
+        monkeypatch: pytest monkeypatch fixture.
+
+    Returns:
+        Path to the temporary state directory.
+    """
+    path = tmp_path / "state"
+    monkeypatch.setattr(charm, "STATE_DIR", path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def systemd_dir(tmp_path, monkeypatch):
+    """Use a temporary directory as the systemd unit files directory.
+
+    Args:
+        tmp_path: pytest temporary directory.
+        monkeypatch: pytest monkeypatch fixture.
+
+    Returns:
+        Path to the temporary systemd directory.
+    """
+    path = tmp_path / "systemd"
+    monkeypatch.setattr(refresher, "SYSTEMD_DIR", path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def metrics_recorder():
+    """Discard the metrics recorded by the previous tests.
+
+    Returns:
+        The metrics recorder.
+    """
+    RECORDER.clear()
+    return RECORDER
+
+
+@pytest.fixture(autouse=True)
+def tracer(monkeypatch):
+    """Don't export the traces unless a test sets where to.
+
+    Args:
+        monkeypatch: pytest monkeypatch fixture.
+
+    Returns:
+        The tracer.
+    """
+    monkeypatch.setattr(TRACER, "path", None)
+    return TRACER
+
+
+@pytest.fixture(autouse=True, name="popen_mock")
+def popen_mock_fixture(monkeypatch):
+    """Don't start the detached process fetching the metadata in background.
+
+    Args:
+        monkeypatch: pytest monkeypatch fixture.
+
+    Returns:
+        Mock for subprocess.Popen.
+    """
+    mock = MagicMock()
+    monkeypatch.setattr(refresher.subprocess, "Popen", mock)
+    return mock
+
+
+class MetadataRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the metadata of a MetadataServer, compressed if negotiated.
+
+    Attrs:
+        server: the server handling the request.
+    """
+
+    server: "MetadataServer"
+
+    def do_GET(self) -> None:  # noqa: N802 pylint: disable=invalid-name
+        """Handle a GET request."""
+        self.server.requests.append(dict(self.headers))
+        time.sleep(self.server.delay)
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_error(self.server.failure_status)
+            return
+        body = self.server.metadata
+        accepted = [
+            encoding.strip() for encoding in self.headers.get("Accept-Encoding", "").split(",")
+        ]
+        self.send_response(200)
+        if self.server.content_encoding and (
+            self.server.content_encoding in accepted or not self.server.negotiate
+        ):
+            body = self.server.encoder(body)
+            self.send_header("Content-Encoding", self.server.content_encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # Counted before writing, as the client may be done as soon as the body is written
+        self.server.bytes_sent += len(body)
+        if not self.server.chunk_delay:
+            self.wfile.write(body)
+            return
+        for position in range(0, len(body), 16):
+            self.wfile.write(body[position:][:16])
+            self.wfile.flush()
+            time.sleep(self.server.chunk_delay)
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        """Don't log the requests.
+
+        Args:
+            args: log arguments.
+        """
+
+
+class MetadataServer(
+    http.server.ThreadingHTTPServer
+):  # pylint: disable=too-many-instance-attributes
+    """Local HTTP server standing in for the metadata server.
+
+    Attrs:
+        block_on_close: whether closing the server waits for the pending requests.
+        daemon_threads: whether the requests are handled by daemon threads.
+        metadata: raw metadata served.
+        delay: seconds to wait before answering.
+        chunk_delay: seconds to wait between each 16 bytes of the body.
+        failures: number of requests to answer with the failure status.
+        failure_status: HTTP status of the failed requests.
+        content_encoding: content encoding used if the client accepts it, if any.
+        negotiate: whether the content encoding is only used if the client accepts it.
+        encoder: function encoding the metadata with the content encoding.
+        bytes_sent: number of body bytes sent.
+        requests: headers of the requests received.
+        url: URL of the metadata.
+    """
+
+    block_on_close = False
+    daemon_threads = True
+
+    def __init__(self, metadata: bytes):
+        """Initialize a new instance of the MetadataServer class.
+
+        Args:
+            metadata: raw metadata served.
+        """
+        super().__init__(("127.0.0.1", 0), MetadataRequestHandler)
+        self.metadata = metadata
+        self.delay = 0.0
+        self.chunk_delay = 0.0
+        self.failures = 0
+        self.failure_status = 503
+        self.content_encoding: typing.Optional[str] = None
+        self.negotiate = True
+        self.encoder: typing.Callable[[bytes], bytes] = lambda data: data
+        self.bytes_sent = 0
+        self.requests: list[dict] = []
+
+    @property
+    def url(self) -> str:
+        """Return the URL of the metadata."""
+        return f"http://127.0.0.1:{self.server_port}/metadata"
+
+
+@pytest.fixture(name="metadata_server_factory")
+def metadata_server_factory_fixture(monkeypatch):
+    """Serve the aggregate metadata from local HTTP servers.
+
+    Args:
+        monkeypatch: pytest monkeypatch fixture.
+
+    Yields:
+        A function starting a new server.
+    """
+    monkeypatch.setenv("no_proxy", "127.0.0.1")
+    servers = []
+
+    def start() -> MetadataServer:
+        """Start a new server.
+
+        Returns:
+            The running server.
+        """
+        server = MetadataServer(Path("tests/unit/files/metadata_aggregate.xml").read_bytes())
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(name="metadata_server")
+def metadata_server_fixture(metadata_server_factory):
+    """Serve the aggregate metadata from a local HTTP server.
+
+    Args:
+        metadata_server_factory: function starting a new server.
+
+    Returns:
+        The running server.
+    """
+    return metadata_server_factory()
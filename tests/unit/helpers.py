@@ -0,0 +1,65 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Helpers for the unit tests."""
+
+import io
+from typing import Optional
+from unittest.mock import MagicMock
+
+
+def get_urlopen_result_mock(code: int, result: bytes, headers: Optional[dict] = None) -> MagicMock:
+    """Get a MagicMock for the urlopen response.
+
+    Args:
+        code: response code.
+        result: response content.
+        headers: response headers.
+
+    Returns:
+        Mock for the response.
+    """
+    body = io.BytesIO(result)
+
+    def read(size: int = -1) -> bytes:
+        """Read the response content, rewinding it once fully read.
+
+        Args:
+            size: maximum number of bytes to read.
+
+        Returns:
+            The bytes read.
+        """
+        chunk = body.read(size)
+        if not chunk:
+            body.seek(0)
+        return chunk
+
+    urlopen_result_mock = MagicMock()
+    urlopen_result_mock.getcode.return_value = code
+    urlopen_result_mock.read.side_effect = read
+    urlopen_result_mock.headers = headers or {}
+    return urlopen_result_mock
+
+
+def get_charm_state_mock(**kwargs) -> MagicMock:
+    """Get a MagicMock for the charm state.
+
+    Args:
+        kwargs: charm state attributes, overriding the defaults.
+
+    Returns:
+        Mock for the charm state.
+    """
+    if "metadata_url" in kwargs:
+        kwargs.setdefault("metadata_urls", (kwargs["metadata_url"],))
+    return MagicMock(
+        **{
+            "metadata_max_refresh_interval": 86400,
+            "metadata_max_size": 128,
+            "metadata_min_refresh_interval": 300,
+            "metadata_refresh_interval": 3600,
+            "metadata_streaming": False,
+            **kwargs,
+        }
+    )
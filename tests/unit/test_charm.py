@@ -3,18 +3,26 @@
 
 """SAML Integrator Charm unit tests."""
 # pylint: disable=protected-access
+import urllib.error
 from pathlib import Path
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
 import ops
-from charms.operator_libs_linux.v0 import apt
-from ops.testing import Harness
+import pytest
+from charms.saml_integrator.v0 import saml
+from ops.testing import ActionFailed, Harness
 
-from charm import SamlIntegratorOperatorCharm
+import metrics
+import refresher
+from charm import PEER_RELATION_NAME, SHARED_SNAPSHOT_KEY, SamlIntegratorOperatorCharm
+from tests.unit.helpers import get_urlopen_result_mock
+from tests.unit.test_metrics import scrape
+from tests.unit.test_tracing import read_spans
+from tracing import TRACER, TRACES_FILENAME
 
 
-@patch.object(apt, "add_package")
-def test_libs_installed(apt_add_package_mock):
+@patch("charm.install_packages")
+def test_libs_installed(install_packages_mock):
     """
     arrange: set up a charm.
     act: trigger the install event.
@@ -31,12 +39,10 @@ def test_libs_installed(apt_add_package_mock):
     )
     harness.begin()
     # First confirm no packages have been installed.
-    apt_add_package_mock.assert_not_called()
+    install_packages_mock.assert_not_called()
     harness.charm.on.install.emit()
     # And now confirm we've installed the required packages.
-    apt_add_package_mock.assert_called_once_with(
-        ["libssl-dev", "libxml2", "libxslt1-dev"], update_cache=True
-    )
+    install_packages_mock.assert_called_once_with()
 
 
 def test_misconfigured_charm_reaches_blocked_status():
@@ -58,9 +64,7 @@ def test_charm_reaches_active_status(urlopen_mock):
     assert: the charm reaches ActiveStatus.
     """
     metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
-    urlopen_result_mock = MagicMock()
-    urlopen_result_mock.getcode.return_value = 200
-    urlopen_result_mock.read.return_value = metadata
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
     urlopen_result_mock.__enter__.return_value = urlopen_result_mock
     urlopen_mock.return_value = urlopen_result_mock
 
@@ -86,9 +90,7 @@ def test_relation_joined_when_leader(urlopen_mock):
     assert: the relation get populated with the SAML data.
     """
     metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
-    urlopen_result_mock = MagicMock()
-    urlopen_result_mock.getcode.return_value = 200
-    urlopen_result_mock.read.return_value = metadata
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
     urlopen_result_mock.__enter__.return_value = urlopen_result_mock
     urlopen_mock.return_value = urlopen_result_mock
 
@@ -104,6 +106,8 @@ def test_relation_joined_when_leader(urlopen_mock):
     )
     harness.begin()
     harness.charm.on.config_changed.emit()
+    assert harness.model.unit.status == ops.MaintenanceStatus("Fetching metadata")
+    harness.charm.on.metadata_ready.emit()
     assert harness.model.unit.status == ops.ActiveStatus()
     harness.add_relation("saml", "indico")
     data = harness.model.get_relation("saml").data[harness.model.app]
@@ -161,9 +165,7 @@ def test_relation_joined_when_not_leader(urlopen_mock):
     assert: the relation get populated with the SAML data.
     """
     metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
-    urlopen_result_mock = MagicMock()
-    urlopen_result_mock.getcode.return_value = 200
-    urlopen_result_mock.read.return_value = metadata
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
     urlopen_result_mock.__enter__.return_value = urlopen_result_mock
     urlopen_mock.return_value = urlopen_result_mock
 
@@ -183,3 +185,726 @@ def test_relation_joined_when_not_leader(urlopen_mock):
     harness.add_relation("saml", "indico")
     data = harness.model.get_relation("saml").data[harness.model.app]
     assert data == {}
+
+
+@patch("urllib.request.urlopen")
+def test_update_status_fetches_metadata_once(urlopen_mock):
+    """
+    arrange: set up a configured leader charm with several relations.
+    act: trigger the update status event.
+    assert: the metadata is fetched only once for all the relations.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.add_relation("saml", "indico")
+    harness.add_relation("saml", "discourse")
+    harness.begin()
+    harness.charm.on.update_status.emit()
+
+    assert urlopen_mock.call_count == 1
+    for relation in harness.model.relations["saml"]:
+        assert relation.data[harness.model.app]["x509certs"] == "cert1_content"
+
+
+@patch("urllib.request.urlopen")
+def test_update_status_skips_unchanged_relation_data(urlopen_mock):
+    """
+    arrange: set up a configured leader charm with several relations, published once.
+    act: trigger the update status event again, then lose and regain the leadership.
+    assert: the unchanged relation data is not written again until the leadership was lost.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.set_leader(True)
+    harness.add_relation("saml", "indico")
+    harness.add_relation("saml", "discourse")
+    harness.begin()
+    harness.charm.on.update_status.emit()
+
+    with patch.object(saml.SamlProvides, "update_relation_data") as update_relation_data_mock:
+        harness.charm.on.update_status.emit()
+        update_relation_data_mock.assert_not_called()
+        assert harness.charm._stored.skipped_writes == 2
+
+        harness.set_leader(False)
+        harness.charm.on.update_status.emit()
+        harness.set_leader(True)
+        harness.charm.on.update_status.emit()
+        assert update_relation_data_mock.call_count == 2
+
+    for relation in harness.model.relations["saml"]:
+        assert relation.data[harness.model.app]["x509certs"] == "cert1_content"
+
+
+@patch("urllib.request.urlopen")
+def test_leader_elected_rewrites_relation_data(urlopen_mock):
+    """
+    arrange: set up a configured leader charm with several relations, published once.
+    act: lose and regain the leadership without any hook running in between.
+    assert: the relation data is written again, as another leader may have changed it.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.set_leader(True)
+    harness.add_relation("saml", "indico")
+    harness.add_relation("saml", "discourse")
+    harness.begin()
+    harness.charm.on.update_status.emit()
+
+    with patch.object(saml.SamlProvides, "update_relation_data") as update_relation_data_mock:
+        harness.set_leader(False)
+        harness.set_leader(True)
+
+        assert update_relation_data_mock.call_count == 2
+
+
+@patch("urllib.request.urlopen")
+def test_relations_get_their_requested_entity(urlopen_mock):
+    """
+    arrange: set up a configured leader charm for an aggregate with several relations,
+        one of them requesting a different entity.
+    act: trigger the update status event.
+    assert: the metadata is fetched once and each relation gets its own entity.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://federation.test/metadata",
+        }
+    )
+    indico_relation_id = harness.add_relation("saml", "indico")
+    discourse_relation_id = harness.add_relation(
+        "saml", "discourse", app_data={"entity_id": "https://idp1.federation.test"}
+    )
+    harness.begin()
+    harness.charm.on.update_status.emit()
+
+    assert urlopen_mock.call_count == 1
+    indico_data = harness.get_relation_data(indico_relation_id, harness.model.app)
+    discourse_data = harness.get_relation_data(discourse_relation_id, harness.model.app)
+    assert indico_data["entity_id"] == "https://login.staging.ubuntu.com"
+    assert indico_data["x509certs"] == "cert1_content,cert2_content"
+    assert discourse_data["entity_id"] == "https://idp1.federation.test"
+    assert discourse_data["x509certs"] == "idp1_cert_content"
+
+
+@patch("urllib.request.urlopen")
+def test_relation_changed_publishes_requested_entity(urlopen_mock):
+    """
+    arrange: set up a configured leader charm for an aggregate with a relation.
+    act: request a different entity from the requirer side.
+    assert: the relation gets the data of the requested entity.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://federation.test/metadata",
+        }
+    )
+    harness.begin()
+    relation_id = harness.add_relation("saml", "indico")
+
+    harness.update_relation_data(
+        relation_id, "indico", {"entity_id": "https://idp3.federation.test"}
+    )
+
+    data = harness.get_relation_data(relation_id, harness.model.app)
+    assert data["entity_id"] == "https://idp3.federation.test"
+    assert data["single_sign_on_service_post_url"] == "https://idp3.federation.test/sso"
+
+
+@patch.object(refresher.subprocess, "run")
+def test_config_changed_installs_refresher(run_mock, systemd_dir, state_dir):
+    """
+    arrange: set up a charm with the metadata refresher enabled.
+    act: trigger a configuration change, then remove the unit.
+    assert: the refresher is configured and installed, then removed.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_refresher": True,
+            "metadata_url": "https://federation.test/metadata",
+        }
+    )
+    harness.begin()
+    harness.charm.on.config_changed.emit()
+
+    assert (systemd_dir / f"{refresher.SERVICE_NAME}.timer").exists()
+    assert (state_dir / refresher.REFRESHER_CONFIG_FILENAME).exists()
+    run_mock.assert_called_with(
+        ["systemctl", "enable", "--now", f"{refresher.SERVICE_NAME}.timer"], check=True
+    )
+
+    harness.charm.on.remove.emit()
+
+    assert not (systemd_dir / f"{refresher.SERVICE_NAME}.timer").exists()
+    run_mock.assert_called_with(["systemctl", "daemon-reload"], check=True)
+
+
+@patch.object(refresher.subprocess, "run")
+@patch("urllib.request.urlopen")
+def test_config_changed_fetches_metadata_in_background(urlopen_mock, run_mock, popen_mock):
+    """
+    arrange: set up a configured leader charm with a relation.
+    act: trigger a configuration change, run the detached process it starts, then trigger the
+        metadata ready event it dispatches.
+    assert: the metadata is only fetched by the detached process and published on metadata ready.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+
+    harness.charm.on.config_changed.emit()
+
+    assert harness.model.unit.status == ops.MaintenanceStatus("Fetching metadata")
+    assert harness.get_relation_data(relation_id, harness.model.app) == {}
+    urlopen_mock.assert_not_called()
+    command = popen_mock.call_args.args[0]
+    assert command[3:5] == ["--dispatch", "saml-integrator/0"]
+
+    assert refresher.main(command[2:]) == 0
+    run_mock.assert_called_once_with(
+        [
+            "juju-exec",
+            "-u",
+            "saml-integrator/0",
+            "SAML_INTEGRATOR_REFRESH_STATUS=0 "
+            f"JUJU_DISPATCH_PATH=hooks/metadata_ready {harness.charm.charm_dir}/dispatch",
+        ],
+        check=True,
+    )
+    harness.charm.on.metadata_ready.emit()
+
+    assert urlopen_mock.call_count == 1
+    data = harness.get_relation_data(relation_id, harness.model.app)
+    assert data["x509certs"] == "cert1_content"
+    assert harness.model.unit.status == ops.ActiveStatus()
+
+
+@patch("urllib.request.urlopen")
+def test_metadata_ready_fetch_failure(urlopen_mock):
+    """
+    arrange: set up a configured leader charm fetching the metadata in background and make the
+        metadata unavailable.
+    act: trigger the metadata ready event without a fetched snapshot.
+    assert: the charm reaches BlockedStatus instead of staying in MaintenanceStatus.
+    """
+    urlopen_mock.side_effect = urllib.error.HTTPError(
+        "https://login.staging.ubuntu.com/saml/metadata", 404, "Not Found", {}, None
+    )
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.add_relation("saml", "indico")
+    harness.begin()
+    harness.charm.on.config_changed.emit()
+
+    harness.charm.on.metadata_ready.emit()
+
+    assert harness.model.unit.status.name == ops.BlockedStatus().name
+    assert "metadata" in harness.model.unit.status.message
+
+
+@pytest.mark.parametrize("refresh_status", ["0", "1"], ids=["refreshed", "failed"])
+@patch("urllib.request.urlopen")
+def test_metadata_ready_reports_refresh_failure(urlopen_mock, refresh_status, monkeypatch):
+    """
+    arrange: set up a configured leader charm with a relation, publish the metadata and make it
+        unavailable.
+    act: trigger the metadata ready event dispatched by a background fetch, succeeding or not.
+    assert: the persisted snapshot is only published if the background fetch succeeded,
+        otherwise the charm reaches BlockedStatus.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    config = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+    }
+    published = Harness(SamlIntegratorOperatorCharm)
+    published.set_leader(True)
+    published.update_config(config)
+    published.add_relation("saml", "indico")
+    published.begin()
+    published.charm.on.update_status.emit()
+    urlopen_mock.side_effect = urllib.error.HTTPError(
+        "https://login.staging.ubuntu.com/saml/metadata", 404, "Not Found", {}, None
+    )
+    monkeypatch.setenv(refresher.REFRESH_STATUS_ENV, refresh_status)
+
+    # Dispatched to a new charm instance, reading the persisted snapshot
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(config)
+    harness.add_relation("saml", "indico")
+    harness.begin()
+    harness.charm.on.metadata_ready.emit()
+
+    if refresh_status == "0":
+        assert harness.model.unit.status == ops.ActiveStatus()
+    else:
+        assert harness.model.unit.status.name == ops.BlockedStatus().name
+
+
+def test_metadata_ready_after_losing_leadership():
+    """
+    arrange: set up a configured leader charm fetching the metadata in background.
+    act: lose the leadership, then trigger the metadata ready and update status events.
+    assert: the charm leaves MaintenanceStatus without publishing the metadata.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.begin()
+    harness.charm.on.config_changed.emit()
+    assert harness.model.unit.status == ops.MaintenanceStatus("Fetching metadata")
+
+    harness.set_leader(False)
+    harness.charm.on.metadata_ready.emit()
+
+    assert harness.model.unit.status == ops.ActiveStatus()
+
+
+@pytest.mark.parametrize("snapshot_refreshed", [True, False])
+@patch("urllib.request.urlopen")
+def test_update_status_publishes_refreshed_snapshot(urlopen_mock, snapshot_refreshed, state_dir):
+    """
+    arrange: set up a leader charm with the metadata refresher enabled and several relations,
+        one of them requesting a different entity.
+    act: trigger the update status event, with and without a refreshed snapshot.
+    assert: the metadata is only fetched if the refresher didn't persist a snapshot.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    config = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "metadata_refresher": True,
+        "metadata_url": "https://federation.test/metadata",
+    }
+    if snapshot_refreshed:
+        refresher.MetadataRefresher(state_dir, Path("/charm")).configure(
+            config, ["https://idp1.federation.test"]
+        )
+        refresher.refresh(state_dir)
+        urlopen_mock.reset_mock()
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(config)
+    harness.add_relation("saml", "indico")
+    discourse_relation_id = harness.add_relation(
+        "saml", "discourse", app_data={"entity_id": "https://idp1.federation.test"}
+    )
+    harness.begin()
+
+    harness.charm.on.update_status.emit()
+
+    assert urlopen_mock.call_count == (0 if snapshot_refreshed else 1)
+    discourse_data = harness.get_relation_data(discourse_relation_id, harness.model.app)
+    assert discourse_data["x509certs"] == "idp1_cert_content"
+
+
+@pytest.mark.parametrize(
+    "refresh_interval, expected_fetches", [(3600, 1), (0, 2)], ids=["not due", "due"]
+)
+@patch("urllib.request.urlopen")
+def test_update_status_fetches_metadata_when_due(urlopen_mock, refresh_interval, expected_fetches):
+    """
+    arrange: set up a configured leader charm with a relation and publish the metadata.
+    act: trigger the update status event in a new hook.
+    assert: the metadata is only fetched again once the refresh interval has passed.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harnesses = []
+    for _ in range(2):
+        harness = Harness(SamlIntegratorOperatorCharm)
+        harness.set_leader(True)
+        harness.update_config(
+            {
+                "entity_id": "https://login.staging.ubuntu.com",
+                "metadata_min_refresh_interval": 0,
+                "metadata_refresh_interval": refresh_interval,
+                "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+            }
+        )
+        relation_id = harness.add_relation("saml", "indico")
+        harness.begin()
+        harness.charm.on.update_status.emit()
+        harnesses.append(harness)
+
+    assert urlopen_mock.call_count == expected_fetches
+    data = harnesses[-1].get_relation_data(relation_id, harnesses[-1].model.app)
+    assert data["x509certs"] == "cert1_content"
+    assert harnesses[-1].model.unit.status == ops.ActiveStatus()
+
+
+@patch("urllib.request.urlopen")
+def test_expired_metadata_reaches_blocked_status(urlopen_mock):
+    """
+    arrange: set up a configured leader charm with a relation and mock expired metadata.
+    act: trigger the update status event.
+    assert: the metadata is published and the charm reaches BlockedStatus.
+    """
+    metadata = (
+        Path("tests/unit/files/metadata_unsigned.xml")
+        .read_bytes()
+        .replace(
+            b'entityID="https://login.staging.ubuntu.com"',
+            b'entityID="https://login.staging.ubuntu.com" validUntil="2020-01-01T00:00:00Z"',
+        )
+    )
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+
+    harness.charm.on.update_status.emit()
+
+    assert harness.get_relation_data(relation_id, harness.model.app)["x509certs"]
+    assert harness.model.unit.status == ops.BlockedStatus(
+        "Expired metadata for https://login.staging.ubuntu.com"
+    )
+
+
+@pytest.mark.parametrize("shared", [True, False], ids=["shared", "invalid"])
+@patch("urllib.request.urlopen")
+def test_leader_elected_republishes_shared_snapshot(urlopen_mock, shared, tmp_path):
+    """
+    arrange: set up a configured leader charm with a peer relation and publish the metadata.
+    act: elect a new leader with an empty cache, the peer relation holding the shared data.
+    assert: the new leader republishes the shared data without fetching the metadata again,
+        unless the shared data is invalid.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    config = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "metadata_url": "https://federation.test/metadata",
+    }
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(config)
+    peer_relation_id = harness.add_relation(PEER_RELATION_NAME, "saml-integrator")
+    harness.add_relation("saml", "indico")
+    harness.add_relation(
+        "saml", "discourse", app_data={"entity_id": "https://idp1.federation.test"}
+    )
+    harness.begin()
+    harness.charm.on.update_status.emit()
+    content = harness.get_relation_data(peer_relation_id, harness.model.app)[SHARED_SNAPSHOT_KEY]
+
+    with patch("charm.STATE_DIR", tmp_path / "new-leader"):
+        new_harness = Harness(SamlIntegratorOperatorCharm)
+        new_harness.update_config(config)
+        new_harness.add_relation(
+            PEER_RELATION_NAME,
+            "saml-integrator",
+            app_data={SHARED_SNAPSHOT_KEY: content if shared else "{}"},
+        )
+        indico_relation_id = new_harness.add_relation("saml", "indico")
+        discourse_relation_id = new_harness.add_relation(
+            "saml", "discourse", app_data={"entity_id": "https://idp1.federation.test"}
+        )
+        new_harness.begin()
+        new_harness.set_leader(True)
+
+    assert urlopen_mock.call_count == (1 if shared else 2)
+    indico_data = new_harness.get_relation_data(indico_relation_id, new_harness.model.app)
+    discourse_data = new_harness.get_relation_data(discourse_relation_id, new_harness.model.app)
+    assert indico_data["x509certs"] == "cert1_content,cert2_content"
+    assert discourse_data["x509certs"] == "idp1_cert_content"
+
+
+@patch("urllib.request.urlopen")
+def test_update_status_records_metrics(urlopen_mock, state_dir):
+    """
+    arrange: set up a configured leader charm with a relation.
+    act: trigger the update status event twice.
+    assert: the metrics of the fetch, parse and publish phases are rendered in the state directory.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.add_relation("saml", "indico")
+    harness.begin()
+
+    harness.charm.on.update_status.emit()
+    harness.charm.on.update_status.emit()
+
+    samples = scrape(state_dir)
+    assert samples[f"{metrics.FETCH_DURATION}_count"] == 1
+    assert samples[metrics.DOWNLOADED_BYTES] == len(metadata)
+    assert samples[f'{metrics.PARSE_DURATION}_count{{mode="document"}}'] == 1
+    assert samples[f'{metrics.RELATION_UPDATES}{{result="written"}}'] == 1
+    assert samples[f'{metrics.RELATION_UPDATES}{{result="skipped"}}'] == 1
+    assert samples[metrics.LAST_REFRESH] > 0
+
+
+@patch("urllib.request.urlopen")
+def test_update_status_records_traces(urlopen_mock, state_dir):
+    """
+    arrange: set up a configured leader charm with a relation.
+    act: initialize the charm and trigger the update status event within a root span, as the
+        charm main does.
+    assert: a trace is exported in the state directory, with the configuration validation and
+        the event handler spans nested in the root span.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.add_relation("saml", "indico")
+
+    with TRACER.span("hooks/update-status"):
+        harness.begin()
+        harness.charm.on.update_status.emit()
+
+    (spans,) = read_spans(state_dir / TRACES_FILENAME)
+    by_name = {span["name"]: span for span in spans}
+    root = by_name["hooks/update-status"]
+    handler = by_name["SamlIntegratorOperatorCharm._on_update_status"]
+    assert handler["parentSpanId"] == root["spanId"]
+    assert by_name["CharmState.from_charm"]["parentSpanId"] == root["spanId"]
+    assert by_name["MetadataFetcher.fetch"]["parentSpanId"] == handler["spanId"]
+    assert by_name["SamlProvides.update_relation_data"]["parentSpanId"] == handler["spanId"]
+    assert by_name["http.read_body"]["parentSpanId"] == by_name["http.request"]["spanId"]
+    assert by_name["SamlIntegrator.parse"]["attributes"][0] == {
+        "key": "mode",
+        "value": {"stringValue": "document"},
+    }
+
+
+@patch("urllib.request.urlopen")
+def test_refresh_metadata_action(urlopen_mock):
+    """
+    arrange: set up a configured leader charm with a relation holding the published SAML data.
+    act: run the refresh metadata action, then again once the metadata changed.
+    assert: the metadata is fetched each time despite the persisted snapshot, the results report
+        the metadata, the timings and only the relation changed by the second run.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    relation_id = harness.add_relation("saml", "indico")
+    harness.begin()
+    harness.charm.on.update_status.emit()
+
+    results = harness.run_action("refresh-metadata").results
+
+    assert urlopen_mock.call_count == 2
+    assert results["bytes"] == len(metadata)
+    assert results["status"] == 200
+    assert results["digest"] == harness.charm._cache.load_snapshot().digest
+    assert set(results["timings"]) == {"fetch", "parse", "verify", "extract"}
+    assert results["timings"]["fetch"] > 0
+    assert results["changed-relations"] == ""
+
+    updated_metadata = metadata.replace(b"/+logout", b"/logout")
+    urlopen_result_mock = get_urlopen_result_mock(200, updated_metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+
+    results = harness.run_action("refresh-metadata").results
+
+    assert results["changed-relations"] == str(relation_id)
+    data = harness.model.get_relation("saml").data[harness.model.app]
+    assert data["single_logout_service_post_url"] == "https://login.staging.ubuntu.com/logout"
+
+
+@patch("urllib.request.urlopen")
+def test_refresh_metadata_action_fetch_failure(urlopen_mock):
+    """
+    arrange: set up a configured leader charm and make the metadata unavailable.
+    act: run the refresh metadata action.
+    assert: the action fails, reporting the error.
+    """
+    urlopen_mock.side_effect = urllib.error.HTTPError(
+        "https://login.staging.ubuntu.com/saml/metadata", 404, "Not Found", {}, None
+    )
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.set_leader(True)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.begin()
+
+    with pytest.raises(ActionFailed):
+        harness.run_action("refresh-metadata")
+
+
+def test_refresh_metadata_action_not_leader():
+    """
+    arrange: set up a configured charm that isn't the leader.
+    act: run the refresh metadata action.
+    assert: the action fails without fetching the metadata.
+    """
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.begin()
+
+    with pytest.raises(ActionFailed, match="leader"):
+        harness.run_action("refresh-metadata")
+
+
+@pytest.mark.parametrize("event", ["start", "leader_elected"])
+@patch.object(refresher.subprocess, "run")
+@patch("urllib.request.urlopen")
+def test_snapshot_warmed(urlopen_mock, _, event, popen_mock):
+    """
+    arrange: set up a configured charm without relations nor persisted snapshot.
+    act: trigger the start or leader elected event, run the detached process it starts, then
+        make the unit the leader and add a relation.
+    assert: the metadata is fetched by the detached process, unless due, and the relation is
+        published from the warm snapshot without fetching the metadata again.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    harness = Harness(SamlIntegratorOperatorCharm)
+    harness.update_config(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    harness.begin()
+
+    if event == "start":
+        harness.charm.on.start.emit()
+    else:
+        harness.set_leader(True)
+
+    command = popen_mock.call_args.args[0]
+    assert command[-1] == "--if-due"
+    assert refresher.main(command[2:]) == 0
+    assert urlopen_mock.call_count == 1
+    popen_mock.reset_mock()
+
+    harness.set_leader(True)
+    harness.charm.on.start.emit()
+    relation_id = harness.add_relation("saml", "indico")
+
+    popen_mock.assert_not_called()
+    assert urlopen_mock.call_count == 1
+    data = harness.get_relation_data(relation_id, harness.model.app)
+    assert data["x509certs"] == "cert1_content"
@@ -3,10 +3,11 @@
 
 """CharmState unit tests."""
 
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import pytest
 
+import charm_state
 from charm_state import CharmConfigInvalidError, CharmState
 
 
@@ -27,6 +28,10 @@ def test_charm_state_from_charm():
     state = CharmState.from_charm(charm)
     assert state.entity_id == entity_id
     assert state.metadata_url == metadata_url
+    assert state.metadata_max_size == 128
+    assert state.metadata_min_refresh_interval == 300
+    assert state.metadata_refresh_interval == 3600
+    assert state.metadata_max_refresh_interval == 86400
 
 
 def test_charm_state_from_charm_with_invalid_config():
@@ -38,3 +43,198 @@ def test_charm_state_from_charm_with_invalid_config():
     charm = MagicMock(config={})
     with pytest.raises(CharmConfigInvalidError):
         CharmState.from_charm(charm)
+
+
+def test_charm_state_metadata_streaming():
+    """
+    arrange: set up a charm configured to stream the metadata.
+    act: access the status properties
+    assert: streaming is enabled in the state.
+    """
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_streaming": True,
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    assert CharmState.from_charm(charm).metadata_streaming
+
+
+def test_charm_state_metadata_streaming_with_fingerprint():
+    """
+    arrange: set up a charm configured to stream the metadata and to validate its signature.
+    act: access the status properties
+    assert: a CharmConfigInvalidError is raised.
+    """
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "fingerprint": "1c:73:51:f2",
+            "metadata_streaming": True,
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    with pytest.raises(CharmConfigInvalidError, match="metadata_streaming"):
+        CharmState.from_charm(charm)
+
+
+def test_charm_state_metadata_url_with_commas():
+    """
+    arrange: set up a charm configured with a single metadata URL holding commas.
+    act: access the status properties
+    assert: the URL is not split.
+    """
+    metadata_url = "https://mds.example.org/entities?filter=a,b"
+    charm = MagicMock(
+        config={"entity_id": "https://login.staging.ubuntu.com", "metadata_url": metadata_url}
+    )
+    assert CharmState.from_charm(charm).metadata_urls == (metadata_url,)
+
+
+def test_charm_state_metadata_mirrors():
+    """
+    arrange: set up a charm configured with metadata mirrors.
+    act: access the status properties
+    assert: the first URL is the metadata URL and all of them are available.
+    """
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": (
+                "https://login.staging.ubuntu.com/saml/metadata"
+                " https://mirror1.example.com/metadata\nhttps://mirror2.example.com/metadata"
+            ),
+        }
+    )
+    state = CharmState.from_charm(charm)
+    assert state.metadata_url == "https://login.staging.ubuntu.com/saml/metadata"
+    assert state.metadata_urls == (
+        "https://login.staging.ubuntu.com/saml/metadata",
+        "https://mirror1.example.com/metadata",
+        "https://mirror2.example.com/metadata",
+    )
+
+
+@pytest.mark.parametrize(
+    "metadata_url",
+    [
+        pytest.param("", id="empty"),
+        pytest.param(
+            "https://login.staging.ubuntu.com/saml/metadata invalid", id="invalid mirror"
+        ),
+    ],
+)
+def test_charm_state_invalid_metadata_mirrors(metadata_url):
+    """
+    arrange: set up a charm configured with invalid metadata URLs.
+    act: access the status properties
+    assert: a CharmConfigInvalidError is raised.
+    """
+    charm = MagicMock(
+        config={"entity_id": "https://login.staging.ubuntu.com", "metadata_url": metadata_url}
+    )
+    with pytest.raises(CharmConfigInvalidError, match="metadata_url"):
+        CharmState.from_charm(charm)
+
+
+def test_charm_state_invalid_metadata_max_size():
+    """
+    arrange: set up a charm configured with a zero maximum metadata size.
+    act: access the status properties
+    assert: a CharmConfigInvalidError is raised.
+    """
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_max_size": 0,
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    with pytest.raises(CharmConfigInvalidError, match="metadata_max_size"):
+        CharmState.from_charm(charm)
+
+
+def test_charm_state_min_refresh_interval_above_max():
+    """
+    arrange: set up a charm configured with a minimum refresh interval above the maximum.
+    act: access the status properties
+    assert: a CharmConfigInvalidError is raised.
+    """
+    charm = MagicMock(
+        config={
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_max_refresh_interval": 60,
+            "metadata_min_refresh_interval": 300,
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        }
+    )
+    with pytest.raises(CharmConfigInvalidError, match="metadata_min_refresh_interval"):
+        CharmState.from_charm(charm)
+
+
+def test_charm_state_memoized():
+    """
+    arrange: set up a charm configured with a fingerprint and an empty memo.
+    act: get the state three times, changing the configuration before the last time.
+    assert: the configuration is only validated when it changes, the memoized one being used
+        otherwise, and the fingerprint is normalized.
+    """
+    config = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "fingerprint": "1C:73:51 F2",
+        "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+    }
+    charm = MagicMock(config=config)
+    memo = {}
+
+    state = CharmState.from_charm(charm, memo=memo)
+
+    assert state.fingerprint == "1c7351f2"
+    digest = memo["digest"]
+
+    with patch.object(charm_state.SamlIntegratorConfig, "__init__") as init_mock:
+        memoized_state = CharmState.from_charm(charm, memo=memo)
+    init_mock.assert_not_called()
+    assert memoized_state.fingerprint == "1c7351f2"
+    assert memoized_state.metadata_urls == ("https://login.staging.ubuntu.com/saml/metadata",)
+    assert memo["digest"] == digest
+
+    config["entity_id"] = "https://idp.federation.test"
+    assert CharmState.from_charm(charm, memo=memo).entity_id == "https://idp.federation.test"
+    assert memo["digest"] != digest
+
+
+def test_config_digest_schema_version(monkeypatch):
+    """
+    arrange: compute the digest of a configuration.
+    act: change the configuration schema version.
+    assert: the digest of the same configuration changes, so it's validated again.
+    """
+    config = {"entity_id": "https://login.staging.ubuntu.com"}
+    digest = charm_state.config_digest(config)
+
+    version = charm_state.CONFIG_SCHEMA_VERSION
+    monkeypatch.setattr(charm_state, "CONFIG_SCHEMA_VERSION", version + 1)
+
+    assert charm_state.config_digest(config) != digest
+
+
+def test_charm_state_invalid_memo():
+    """
+    arrange: set up a configured charm and a memo for its configuration holding invalid data.
+    act: get the state.
+    assert: the configuration is validated again and memoized.
+    """
+    config = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+    }
+    memo = {"digest": charm_state.config_digest(config), "config": "{invalid"}
+
+    state = CharmState.from_charm(MagicMock(config=config), memo=memo)
+
+    assert state.entity_id == "https://login.staging.ubuntu.com"
+    assert charm_state.SamlIntegratorConfig.from_validated(memo["config"]).entity_id == (
+        "https://login.staging.ubuntu.com"
+    )
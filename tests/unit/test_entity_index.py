@@ -0,0 +1,268 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Entity index unit tests."""
+# pylint: disable=pointless-statement
+import base64
+import hashlib
+import urllib.error
+from email.message import Message
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from lxml import etree  # nosec
+
+import saml
+from charm_state import CharmConfigInvalidError
+from metadata_cache import EntityIndex, MetadataCache
+from saml import SamlIntegrator
+from tests.unit.helpers import get_charm_state_mock, get_urlopen_result_mock
+
+
+def test_build_entity_index():
+    """
+    arrange: load an aggregate and a single entity metadata.
+    act: build the entity index of both.
+    assert: each entity of the aggregate is located and the single entity has no index.
+    """
+    aggregate = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    single = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+
+    root, root_name, entities = saml.build_entity_index(aggregate)
+
+    assert saml.build_entity_index(single) is None
+    root_offset, root_length = root
+    assert aggregate[root_offset:][:root_length].startswith(b"<md:EntitiesDescriptor ")
+    assert root_name == "md:EntitiesDescriptor"
+    assert list(entities) == [
+        "https://idp1.federation.test",
+        "https://login.staging.ubuntu.com",
+        "https://idp3.federation.test",
+    ]
+    offset, length = entities["https://idp3.federation.test"]
+    fragment = aggregate[offset:][:length]
+    assert fragment.startswith(b"<md:EntityDescriptor ")
+    assert fragment.endswith(b"</md:EntityDescriptor>")
+
+
+COMMENTED_ENTITY = b"""<!-- <md:EntityDescriptor entityID="https://login.staging.ubuntu.com">
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+        <md:KeyDescriptor use="signing"><ds:KeyInfo><ds:X509Data>
+            <ds:X509Certificate>EVIL</ds:X509Certificate>
+        </ds:X509Data></ds:KeyInfo></md:KeyDescriptor>
+    </md:IDPSSODescriptor>
+</md:EntityDescriptor> -->"""
+
+
+def test_build_entity_index_skips_comments():
+    """
+    arrange: insert a commented out copy of an entity before the entities of an aggregate.
+    act: build the entity index and parse the entity using it.
+    assert: the commented out copy is ignored and the real entity is parsed.
+    """
+    aggregate = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    position = aggregate.index(b"<md:EntityDescriptor ")
+    aggregate = aggregate[:position] + COMMENTED_ENTITY + aggregate[position:]
+
+    root, root_name, entities = saml.build_entity_index(aggregate)
+
+    index = EntityIndex(
+        digest="abc",
+        root=root,
+        root_name=root_name,
+        signing_certificate=None,
+        signed=False,
+        entities=entities,
+    )
+    entity = saml.parse_indexed_entity(aggregate, index, "https://login.staging.ubuntu.com")
+    certificates, _ = saml._extract_entity(entity)  # pylint: disable=protected-access
+    assert certificates == ["cert1_content", "cert2_content"]
+
+
+def test_entity_index_not_matching_document():
+    """
+    arrange: add an attribute holding a closing bracket to an entity of an aggregate, so that
+        its entity ID can't be located without parsing it.
+    act: build the entity index of the verified document.
+    assert: the aggregate is not indexed.
+    """
+    aggregate = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    aggregate = aggregate.replace(
+        b'<md:EntityDescriptor entityID="https://idp3',
+        b'<md:EntityDescriptor ID="a>b" entityID="https://idp3',
+    )
+    document = saml.MetadataDocument(etree.fromstring(aggregate), fingerprint=None, digest="abc")
+
+    assert (
+        saml.SamlIntegrator._build_index(aggregate, document)  # pylint: disable=protected-access
+        is None
+    )
+
+
+def test_parse_indexed_entity():
+    """
+    arrange: index an aggregate.
+    act: parse indexed entities, including missing and wrongly located ones.
+    assert: only the entities found at their indexed location are returned.
+    """
+    aggregate = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    root, root_name, entities = saml.build_entity_index(aggregate)
+    index = EntityIndex(
+        digest="abc",
+        root=root,
+        root_name=root_name,
+        signing_certificate=None,
+        signed=False,
+        entities=entities,
+    )
+    entity = saml.parse_indexed_entity(aggregate, index, "https://idp3.federation.test")
+    assert entity.get("entityID") == "https://idp3.federation.test"
+    assert saml.parse_indexed_entity(aggregate, index, "https://missing.federation.test") is None
+
+    index.entities["https://idp3.federation.test"] = entities["https://idp1.federation.test"]
+    assert saml.parse_indexed_entity(aggregate, index, "https://idp3.federation.test") is None
+    index.entities["https://idp3.federation.test"] = (0, 10)
+    assert saml.parse_indexed_entity(aggregate, index, "https://idp3.federation.test") is None
+
+
+def test_entity_index_nested_aggregate():
+    """
+    arrange: load an aggregate with entities inside a nested aggregate.
+    act: build the entity index of the verified document.
+    assert: the aggregate is not indexed, as its nested entities can't be parsed on their own.
+    """
+    aggregate = Path("tests/unit/files/metadata_nested_aggregate.xml").read_bytes()
+    document = saml.MetadataDocument(etree.fromstring(aggregate), fingerprint=None, digest="abc")
+
+    assert (
+        saml.SamlIntegrator._build_index(aggregate, document)  # pylint: disable=protected-access
+        is None
+    )
+
+
+@patch("urllib.request.urlopen")
+def test_saml_switches_entity_using_the_index(urlopen_mock, tmp_path):
+    """
+    arrange: extract an entity from an aggregate with a cache.
+    act: extract a different entity while the server answers not modified.
+    assert: the entity is extracted from the cached document without parsing it whole.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata, {"ETag": '"v1"'})
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    metadata_url = "https://federation.test/metadata"
+    cache = MetadataCache(tmp_path)
+    expected = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://idp3.federation.test", fingerprint="", metadata_url=metadata_url
+        )
+    )
+    expected_endpoints = expected.endpoints
+    first = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com", fingerprint="", metadata_url=metadata_url
+        ),
+        cache=cache,
+    )
+    assert first.certificates == ["cert1_content", "cert2_content"]
+    urlopen_mock.side_effect = urllib.error.HTTPError(
+        metadata_url, 304, "Not Modified", Message(), None
+    )
+
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://idp3.federation.test", fingerprint="", metadata_url=metadata_url
+        ),
+        cache=cache,
+    )
+    with patch.object(saml, "MetadataDocument") as document_mock:
+        assert saml_integrator.endpoints == expected_endpoints
+        document_mock.assert_not_called()
+    assert urlopen_mock.call_args.args[0].get_header("If-none-match") == '"v1"'
+    assert saml_integrator.snapshot.etag == '"v1"'
+    assert saml_integrator.snapshot.entity_id == "https://idp3.federation.test"
+
+
+@patch("urllib.request.urlopen")
+def test_saml_index_requires_verified_signature(urlopen_mock, tmp_path):
+    """
+    arrange: cache an index of a signed aggregate whose signature was never verified.
+    act: extract an entity.
+    assert: the whole document is parsed instead of using the index.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    digest = hashlib.sha256(metadata).hexdigest()
+    root, root_name, entities = saml.build_entity_index(metadata)
+    cache = MetadataCache(tmp_path)
+    cache.save_document(
+        digest,
+        metadata,
+        EntityIndex(
+            digest=digest,
+            root=root,
+            root_name=root_name,
+            signing_certificate="idp1_cert_content",
+            signed=True,
+            entities=entities,
+        ),
+    )
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://idp3.federation.test",
+            fingerprint="",
+            metadata_url="https://federation.test/metadata",
+        ),
+        cache=cache,
+    )
+
+    assert saml_integrator.endpoints
+    assert saml_integrator._document is not None  # pylint: disable=protected-access
+    assert cache.verdicts.misses == 0
+
+
+@patch("urllib.request.urlopen")
+def test_saml_index_requires_matching_fingerprint(urlopen_mock, tmp_path):
+    """
+    arrange: cache the index of an aggregate signed by a different certificate.
+    act: extract an entity with a fingerprint configured.
+    assert: the whole document is parsed and verified.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    metadata_url = "https://federation.test/metadata"
+    digest = hashlib.sha256(metadata).hexdigest()
+    root, root_name, entities = saml.build_entity_index(metadata)
+    cache = MetadataCache(tmp_path)
+    cache.save_document(
+        digest,
+        metadata,
+        EntityIndex(
+            digest=digest,
+            root=root,
+            root_name=root_name,
+            signing_certificate=base64.b64encode(b"other").decode("ascii"),
+            signed=False,
+            entities=entities,
+        ),
+    )
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://idp3.federation.test",
+            fingerprint="00:11",
+            metadata_url=metadata_url,
+        ),
+        cache=cache,
+    )
+    with patch.object(
+        saml, "MetadataDocument", side_effect=CharmConfigInvalidError("mismatch")
+    ) as document_mock:
+        with pytest.raises(CharmConfigInvalidError):
+            saml_integrator.certificates
+        document_mock.assert_called_once()
@@ -178,3 +178,93 @@ def test_requirer_charm_emits_event(is_leader):
     assert retrieved_relation_data.metadata_url == relation_data["metadata_url"]
     assert retrieved_relation_data.certificates == tuple(relation_data["x509certs"].split(","))
     assert retrieved_relation_data.endpoints == (slo_endpoint, sso_endpoint)
+
+
+@pytest.mark.parametrize("is_leader", [True, False])
+def test_requirer_charm_requests_entity_id(is_leader):
+    """
+    arrange: set up a requirer charm with a relation.
+    act: request an entity ID.
+    assert: the entity ID is written to the application databag only by the leader.
+    """
+    harness = Harness(SamlRequirerCharm, meta=REQUIRER_METADATA)
+    harness.begin()
+    harness.set_leader(is_leader)
+    harness.charm.saml.request_entity_id("https://idp1.federation.test")
+    relation_id = harness.add_relation("saml", "saml-provider")
+
+    harness.charm.saml.request_entity_id("https://idp1.federation.test")
+
+    relation_data = harness.get_relation_data(relation_id, harness.model.app)
+    if is_leader:
+        assert relation_data == {"entity_id": "https://idp1.federation.test"}
+    else:
+        assert relation_data == {}
+
+
+def test_provider_charm_gets_requested_entity_id():
+    """
+    arrange: set up a provider charm with relations with and without a requested entity ID.
+    act: get the requested entity IDs.
+    assert: the entity ID requested by each requirer is returned.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.begin()
+    requested_relation_id = harness.add_relation(
+        "saml", "indico", app_data={"entity_id": "https://idp1.federation.test"}
+    )
+    relation_id = harness.add_relation("saml", "discourse")
+
+    requested_relation = harness.model.get_relation("saml", requested_relation_id)
+    relation = harness.model.get_relation("saml", relation_id)
+    assert (
+        harness.charm.saml.get_requested_entity_id(requested_relation)
+        == "https://idp1.federation.test"
+    )
+    assert harness.charm.saml.get_requested_entity_id(relation) is None
+
+
+def test_provider_charm_reconciles_relation_data():
+    """
+    arrange: set up a provider charm with a relation holding the data of two endpoints.
+    act: update the relation data with the same data, then without one of the endpoints.
+    assert: only the changed keys are written and the keys of the removed endpoint are deleted.
+    """
+    harness = Harness(SamlProviderCharm, meta=PROVIDER_METADATA)
+    harness.set_leader(True)
+    harness.begin()
+    relation_id = harness.add_relation("saml", "indico")
+    relation = harness.model.get_relation("saml", relation_id)
+    sso_endpoint = saml.SamlEndpoint(
+        name="SingleSignOnService",
+        url="https://login.staging.ubuntu.com/saml/",
+        binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+    )
+    slo_endpoint = saml.SamlEndpoint(
+        name="SingleLogoutService",
+        url="https://login.staging.ubuntu.com/+logout",
+        binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST",
+    )
+    saml_data = saml.SamlRelationData(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+        certificates=["cert1"],
+        endpoints=[sso_endpoint, slo_endpoint],
+    )
+    assert harness.charm.saml.update_relation_data(relation, saml_data) == 7
+
+    assert harness.charm.saml.update_relation_data(relation, saml_data) == 0
+
+    updated_saml_data = saml_data.copy(
+        update={"certificates": ["cert2"], "endpoints": [sso_endpoint]}
+    )
+    assert harness.charm.saml.update_relation_data(relation, updated_saml_data) == 3
+    assert harness.get_relation_data(relation_id, harness.model.app) == {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        "x509certs": "cert2",
+        "single_sign_on_service_redirect_url": "https://login.staging.ubuntu.com/saml/",
+        "single_sign_on_service_redirect_binding": (
+            "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"
+        ),
+    }
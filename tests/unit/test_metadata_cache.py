@@ -0,0 +1,409 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""MetadataCache unit tests."""
+
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from charms.saml_integrator.v0 import saml
+
+from metadata_cache import (
+    DOCUMENTS_DIRNAME,
+    EXTRACTED_DIRNAME,
+    MAX_EXTRACTED_ENTRIES,
+    MAX_VERIFIED_SIGNATURES,
+    SNAPSHOT_FILENAME,
+    VERDICTS_FILENAME,
+    EntityIndex,
+    ExtractedSamlData,
+    MetadataCache,
+    MetadataSnapshot,
+    SharedSnapshot,
+    SignatureVerdicts,
+)
+
+
+def _snapshot() -> MetadataSnapshot:
+    """Build a snapshot for testing.
+
+    Returns:
+        A MetadataSnapshot instance.
+    """
+    return MetadataSnapshot(
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=None,
+        etag='"v1"',
+        last_modified=None,
+        certificates=["cert1_content"],
+        endpoints=[
+            saml.SamlEndpoint(
+                name="SingleSignOnService",
+                url="https://login.staging.ubuntu.com/saml/",
+                binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect",
+            )
+        ],
+    )
+
+
+def test_snapshot_round_trip(tmp_path):
+    """
+    arrange: set up a cache in an empty directory.
+    act: save a snapshot and load it back.
+    assert: the loaded snapshot is equal to the saved one and no temporary files are left.
+    """
+    cache = MetadataCache(tmp_path / "cache")
+    assert cache.load_snapshot() is None
+
+    cache.save_snapshot(_snapshot())
+
+    assert cache.load_snapshot() == _snapshot()
+    assert [path.name for path in (tmp_path / "cache").iterdir()] == [SNAPSHOT_FILENAME]
+
+
+def test_corrupted_snapshot_is_ignored(tmp_path):
+    """
+    arrange: write an invalid snapshot file.
+    act: load the snapshot.
+    assert: no snapshot is returned.
+    """
+    (tmp_path / SNAPSHOT_FILENAME).write_text("{invalid", encoding="utf-8")
+
+    assert MetadataCache(tmp_path).load_snapshot() is None
+
+
+def test_snapshot_matches_configuration():
+    """
+    arrange: build a snapshot.
+    act: check it against several configurations.
+    assert: it only matches the configuration it was extracted for.
+    """
+    snapshot = _snapshot()
+
+    assert snapshot.matches(snapshot.metadata_url, snapshot.entity_id, "")
+    assert not snapshot.matches(snapshot.metadata_url, "https://other.example.com", None)
+    assert not snapshot.matches("https://other.example.com/metadata", snapshot.entity_id, None)
+    assert not snapshot.matches(snapshot.metadata_url, snapshot.entity_id, "00:11")
+    streamed = snapshot.copy(update={"streamed": True})
+    assert streamed.matches(snapshot.metadata_url, snapshot.entity_id, None, streaming=True)
+    assert not streamed.matches(snapshot.metadata_url, snapshot.entity_id, None)
+
+
+def _extracted(digest: str) -> ExtractedSamlData:
+    """Build extracted data for testing.
+
+    Args:
+        digest: the metadata digest.
+
+    Returns:
+        An ExtractedSamlData instance.
+    """
+    return ExtractedSamlData(
+        digest=digest,
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=None,
+        certificates=["cert1_content"],
+        endpoints=[],
+    )
+
+
+def test_extracted_data_round_trip(tmp_path):
+    """
+    arrange: set up a cache and save extracted data.
+    act: load it back for several configurations.
+    assert: it is only returned for the configuration it was extracted for.
+    """
+    cache = MetadataCache(tmp_path)
+    cache.save_extracted(_extracted("abc"))
+
+    assert cache.load_extracted("abc", "https://login.staging.ubuntu.com", "") == _extracted("abc")
+    assert cache.load_extracted("abc", "https://other.example.com", None) is None
+    assert cache.load_extracted("abc", "https://login.staging.ubuntu.com", "00:11") is None
+    assert cache.load_extracted("def", "https://login.staging.ubuntu.com", None) is None
+
+
+def test_streamed_extracted_data_only_reused_when_streaming(tmp_path):
+    """
+    arrange: set up a cache and save data extracted while streaming.
+    act: load it back with and without streaming.
+    assert: it is only returned when streaming, as the signature wasn't verified.
+    """
+    cache = MetadataCache(tmp_path)
+    streamed = _extracted("abc").copy(update={"streamed": True})
+    cache.save_extracted(streamed)
+
+    assert cache.load_extracted("abc", streamed.entity_id, None, streaming=True) == streamed
+    assert cache.load_extracted("abc", streamed.entity_id, None) is None
+
+
+def test_extracted_data_per_entity(tmp_path):
+    """
+    arrange: set up a cache.
+    act: save the data extracted for two entities of the same metadata.
+    assert: the data of both entities is kept.
+    """
+    cache = MetadataCache(tmp_path)
+    other = _extracted("abc").copy(update={"entity_id": "https://other.example.com"})
+
+    cache.save_extracted(_extracted("abc"))
+    cache.save_extracted(other)
+
+    assert cache.load_extracted("abc", "https://login.staging.ubuntu.com", None) == _extracted(
+        "abc"
+    )
+    assert cache.load_extracted("abc", "https://other.example.com", None) == other
+
+
+def test_corrupted_extracted_data_is_ignored(tmp_path):
+    """
+    arrange: write an invalid extracted data file.
+    act: load the extracted data.
+    assert: no data is returned.
+    """
+    cache = MetadataCache(tmp_path)
+    cache.save_extracted(_extracted("abc"))
+    for path in (tmp_path / EXTRACTED_DIRNAME).iterdir():
+        path.write_text("{invalid", encoding="utf-8")
+
+    assert cache.load_extracted("abc", "https://login.staging.ubuntu.com", None) is None
+
+
+def test_extracted_data_least_recently_used_is_evicted(tmp_path):
+    """
+    arrange: fill the cache with extracted data, using the oldest entry.
+    act: save one more entry.
+    assert: the least recently used entry is evicted and the cache size stays bounded.
+    """
+    cache = MetadataCache(tmp_path)
+    for index in range(MAX_EXTRACTED_ENTRIES):
+        cache.save_extracted(_extracted(str(index)))
+        for path in (tmp_path / EXTRACTED_DIRNAME).glob(f"{index}-*.json"):
+            os.utime(path, (index, index))
+    assert cache.load_extracted("0", "https://login.staging.ubuntu.com", None)
+
+    cache.save_extracted(_extracted("new"))
+
+    entries = {path.stem.split("-")[0] for path in (tmp_path / EXTRACTED_DIRNAME).iterdir()}
+    assert len(entries) == MAX_EXTRACTED_ENTRIES
+    assert "0" in entries
+    assert "1" not in entries
+    assert "new" in entries
+
+
+def test_extracted_data_same_document_is_not_evicted(tmp_path):
+    """
+    arrange: save the data extracted for an older document.
+    act: save the data extracted for more entities than the cache size from a new document.
+    assert: the data of all the entities is kept and only the older document's data is evicted.
+    """
+    cache = MetadataCache(tmp_path)
+    cache.save_extracted(_extracted("old"))
+    entity_ids = [f"https://sp{index}.example.com" for index in range(MAX_EXTRACTED_ENTRIES + 8)]
+
+    for entity_id in entity_ids:
+        cache.save_extracted(_extracted("abc").copy(update={"entity_id": entity_id}))
+
+    for entity_id in entity_ids:
+        assert cache.load_extracted("abc", entity_id, None)
+    assert cache.load_extracted("old", "https://login.staging.ubuntu.com", None) is None
+
+
+def test_signature_verdicts(tmp_path):
+    """
+    arrange: set up a cache and record a signature verification.
+    act: check the verification for the same and for different parameters.
+    assert: only the same parameters are reported as verified and hits and misses are counted.
+    """
+    cache = MetadataCache(tmp_path)
+    assert not cache.is_signature_verified("abc", "cert", "00:11")
+    cache.record_signature_verified("abc", "cert", "00:11")
+
+    assert cache.is_signature_verified("abc", "cert", "00:11")
+    assert not cache.is_signature_verified("def", "cert", "00:11")
+    assert not cache.is_signature_verified("abc", "cert2", "00:11")
+    assert not cache.is_signature_verified("abc", "cert", None)
+    assert cache.verdicts.hits == 1
+    assert cache.verdicts.misses == 4
+
+
+def test_signature_verdicts_are_bounded(tmp_path):
+    """
+    arrange: set up a cache.
+    act: record more signature verifications than the cache can hold.
+    assert: the oldest verdicts are discarded.
+    """
+    cache = MetadataCache(tmp_path)
+    for index in range(MAX_VERIFIED_SIGNATURES + 1):
+        cache.record_signature_verified(str(index), "cert", None)
+
+    assert len(cache.verdicts.verified) == MAX_VERIFIED_SIGNATURES
+    assert not cache.is_signature_verified("0", "cert", None)
+    assert cache.is_signature_verified(str(MAX_VERIFIED_SIGNATURES), "cert", None)
+
+
+def test_corrupted_signature_verdicts_are_ignored(tmp_path):
+    """
+    arrange: write an invalid signature verdicts file.
+    act: load the verdicts.
+    assert: empty verdicts are returned.
+    """
+    (tmp_path / VERDICTS_FILENAME).write_text("{invalid", encoding="utf-8")
+
+    assert MetadataCache(tmp_path).verdicts == SignatureVerdicts()
+
+
+def test_document_and_index_round_trip(tmp_path):
+    """
+    arrange: set up a cache with a document.
+    act: save a different document with its index.
+    assert: only the most recent document and its index are kept.
+    """
+    cache = MetadataCache(tmp_path)
+    cache.save_document("abc", b"<old/>", None)
+    index = EntityIndex(
+        digest="def",
+        root=(0, 10),
+        root_name="md:EntitiesDescriptor",
+        signing_certificate=None,
+        signed=False,
+        entities={"https://login.staging.ubuntu.com": (10, 20)},
+    )
+
+    cache.save_document("def", b"<new/>", index)
+
+    assert not cache.has_document("abc")
+    assert cache.load_document("abc") is None
+    assert cache.load_index("abc") is None
+    assert cache.has_document("def")
+    assert cache.load_document("def") == b"<new/>"
+    assert cache.load_index("def") == index
+
+
+def test_corrupted_index_is_ignored(tmp_path):
+    """
+    arrange: write an invalid index and an index for a different digest.
+    act: load the indexes.
+    assert: no index is returned.
+    """
+    (tmp_path / DOCUMENTS_DIRNAME).mkdir()
+    (tmp_path / DOCUMENTS_DIRNAME / "abc.index.json").write_text("{invalid", encoding="utf-8")
+    (tmp_path / DOCUMENTS_DIRNAME / "def.index.json").write_text(
+        EntityIndex(
+            digest="abc",
+            root=(0, 10),
+            root_name="EntitiesDescriptor",
+            signing_certificate=None,
+            signed=False,
+            entities={},
+        ).json(),
+        encoding="utf-8",
+    )
+
+    assert MetadataCache(tmp_path).load_index("abc") is None
+    assert MetadataCache(tmp_path).load_index("def") is None
+
+
+def test_signature_verdict_miss_not_counted(tmp_path):
+    """
+    arrange: set up an empty cache.
+    act: check a verification without counting misses.
+    assert: the verification is not reported as verified nor counted.
+    """
+    cache = MetadataCache(tmp_path)
+
+    assert not cache.is_signature_verified("abc", "cert", None, count_miss=False)
+    assert cache.verdicts == SignatureVerdicts()
+
+
+FETCHED_AT = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize(
+    "fetched_at, cache_duration, valid_until, expected",
+    [
+        pytest.param(None, None, None, datetime.min.replace(tzinfo=timezone.utc), id="never"),
+        pytest.param(FETCHED_AT, None, None, FETCHED_AT + timedelta(hours=1), id="default"),
+        pytest.param(
+            FETCHED_AT, timedelta(hours=6), None, FETCHED_AT + timedelta(hours=6), id="cached"
+        ),
+        pytest.param(
+            FETCHED_AT, timedelta(seconds=1), None, FETCHED_AT + timedelta(minutes=5), id="floor"
+        ),
+        pytest.param(
+            FETCHED_AT, timedelta(days=7), None, FETCHED_AT + timedelta(days=1), id="ceiling"
+        ),
+        pytest.param(
+            FETCHED_AT,
+            timedelta(hours=6),
+            FETCHED_AT + timedelta(hours=3),
+            FETCHED_AT + timedelta(hours=2),
+            id="near expiration",
+        ),
+        pytest.param(
+            FETCHED_AT,
+            timedelta(hours=6),
+            FETCHED_AT,
+            FETCHED_AT + timedelta(minutes=5),
+            id="expired",
+        ),
+    ],
+)
+def test_snapshot_next_refresh(fetched_at, cache_duration, valid_until, expected):
+    """
+    arrange: build a snapshot fetched at a given time with the given cache hints.
+    act: get its next refresh with a 1 hour default, a 5 minutes floor and a 1 day ceiling.
+    assert: the expected time is returned.
+    """
+    snapshot = _snapshot().copy(
+        update={
+            "fetched_at": fetched_at,
+            "cache_duration": cache_duration,
+            "valid_until": valid_until,
+        }
+    )
+
+    assert (
+        snapshot.next_refresh(timedelta(hours=1), timedelta(minutes=5), timedelta(days=1))
+        == expected
+    )
+
+
+def test_extracted_data_is_expired():
+    """
+    arrange: build extracted data with and without a validUntil.
+    act: check if it's expired.
+    assert: it's only expired once its validUntil has passed.
+    """
+    valid_until = datetime(2024, 6, 1, tzinfo=timezone.utc)
+    extracted = _extracted("abc").copy(update={"valid_until": valid_until})
+
+    assert not _extracted("abc").is_expired()
+    assert not extracted.is_expired(valid_until - timedelta(seconds=1))
+    assert extracted.is_expired(valid_until)
+    assert extracted.is_expired()
+
+
+def test_restore_shared_snapshot(tmp_path):
+    """
+    arrange: set up a cache holding a snapshot and share a more recent one with another entity.
+    act: restore the shared snapshot, then an older one.
+    assert: only the more recent snapshot and the data extracted from it are persisted.
+    """
+    cache = MetadataCache(tmp_path)
+    cache.save_snapshot(_snapshot().copy(update={"digest": "abc", "fetched_at": FETCHED_AT}))
+    snapshot = _snapshot().copy(
+        update={"digest": "def", "fetched_at": FETCHED_AT + timedelta(minutes=5)}
+    )
+    idp1 = _extracted("def").copy(update={"entity_id": "https://idp1.federation.test"})
+    stale = _extracted("abc").copy(update={"entity_id": "https://idp2.federation.test"})
+
+    assert cache.restore_shared(SharedSnapshot(snapshot=snapshot, extracted=[idp1, stale]))
+    assert not cache.restore_shared(
+        SharedSnapshot(snapshot=snapshot.copy(update={"digest": "abc", "fetched_at": FETCHED_AT}))
+    )
+
+    assert cache.load_snapshot() == snapshot
+    assert cache.load_extracted("def", "https://idp1.federation.test", fingerprint=None) == idp1
+    assert not cache.load_extracted("abc", "https://idp2.federation.test", fingerprint=None)
@@ -0,0 +1,507 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Metadata download unit tests."""
+# pylint: disable=pointless-statement
+import gzip
+import hashlib
+import time
+import urllib.error
+import zlib
+from email.message import Message
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+import metadata_fetcher
+import saml
+from charm_state import CharmConfigInvalidError
+from metadata_cache import SNAPSHOT_FILENAME, MetadataCache, MetadataSnapshot
+from saml import SamlIntegrator
+from tests.unit.helpers import get_charm_state_mock, get_urlopen_result_mock
+
+
+def _raw_deflate(data: bytes) -> bytes:
+    """Compress data with deflate without the zlib header.
+
+    Args:
+        data: data to compress.
+
+    Returns:
+        The compressed data.
+    """
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize(
+    "content_encoding, encoder",
+    [
+        pytest.param("gzip", gzip.compress, id="gzip"),
+        pytest.param("deflate", zlib.compress, id="deflate"),
+        pytest.param("deflate", _raw_deflate, id="raw deflate"),
+    ],
+)
+def test_saml_compressed_transfer(metadata_server, content_encoding, encoder):
+    """
+    arrange: serve the metadata from a local server, with and without compression.
+    act: extract an entity.
+    assert: compression is negotiated, fewer bytes are transferred and the extracted data is
+        identical.
+    """
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata_url=metadata_server.url,
+    )
+    expected = SamlIntegrator(charm_state=charm_state).snapshot
+    uncompressed_bytes = metadata_server.bytes_sent
+    metadata_server.content_encoding = content_encoding
+    metadata_server.encoder = encoder
+
+    snapshot = SamlIntegrator(charm_state=charm_state).snapshot
+
+    assert uncompressed_bytes == len(metadata_server.metadata)
+    assert metadata_server.bytes_sent - uncompressed_bytes < uncompressed_bytes / 2
+    assert all(
+        request["Accept-Encoding"] == "gzip, deflate" for request in metadata_server.requests
+    )
+    assert snapshot.dict(exclude={"fetched_at"}) == expected.dict(exclude={"fetched_at"})
+    assert snapshot.certificates == ["cert1_content", "cert2_content"]
+
+
+@pytest.mark.parametrize(
+    "content_encoding, encoder",
+    [
+        pytest.param("gzip", lambda data: gzip.compress(data)[:-20], id="truncated"),
+        pytest.param("gzip", lambda data: data, id="not compressed"),
+        pytest.param("br", lambda data: data, id="unsupported"),
+    ],
+)
+def test_saml_invalid_compressed_transfer(metadata_server, content_encoding, encoder):
+    """
+    arrange: serve invalid compressed metadata from a local server.
+    act: access the metadata properties.
+    assert: a CharmConfigInvalidError exception is raised.
+    """
+    metadata_server.content_encoding = content_encoding
+    metadata_server.encoder = encoder
+    metadata_server.negotiate = False
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=metadata_server.url,
+        )
+    )
+
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates
+
+
+def test_saml_mirrors_slow_mirror_hedged(metadata_server_factory, monkeypatch):
+    """
+    arrange: serve the metadata from a slow mirror followed by a fast one.
+    act: extract an entity.
+    assert: the next mirror is requested after the hedging delay and its response is used.
+    """
+    monkeypatch.setattr(metadata_fetcher, "MIRROR_HEDGE_DELAY", 0.05)
+    slow_server = metadata_server_factory()
+    slow_server.delay = 5
+    fast_server = metadata_server_factory()
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=slow_server.url,
+            metadata_urls=(slow_server.url, fast_server.url),
+        )
+    )
+
+    start = time.monotonic()
+    assert saml_integrator.certificates == ["cert1_content", "cert2_content"]
+
+    assert time.monotonic() - start < slow_server.delay
+    assert len(slow_server.requests) == 1
+    assert len(fast_server.requests) == 1
+
+
+def test_saml_mirrors_invalid_mirror_skipped(metadata_server_factory, monkeypatch):
+    """
+    arrange: serve invalid metadata from the first mirror and valid one from the next ones.
+    act: extract an entity.
+    assert: the next mirror is requested right away and the last one is never requested.
+    """
+    monkeypatch.setattr(metadata_fetcher, "MIRROR_HEDGE_DELAY", 60)
+    invalid_server = metadata_server_factory()
+    invalid_server.metadata = b"invalid"
+    valid_server = metadata_server_factory()
+    unused_server = metadata_server_factory()
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=invalid_server.url,
+            metadata_urls=(invalid_server.url, valid_server.url, unused_server.url),
+        )
+    )
+
+    with patch.object(saml, "MetadataDocument", wraps=saml.MetadataDocument) as document_mock:
+        assert saml_integrator.certificates == ["cert1_content", "cert2_content"]
+        document_mock.assert_called_once()
+
+    assert len(invalid_server.requests) == 1
+    assert len(valid_server.requests) == 1
+    assert not unused_server.requests
+
+
+@pytest.mark.parametrize("metadata_streaming", [False, True])
+def test_saml_mirrors_all_failing(metadata_server_factory, metadata_streaming, monkeypatch):
+    """
+    arrange: serve invalid metadata from a mirror and make the other one unreachable.
+    act: access the metadata properties.
+    assert: a CharmConfigInvalidError exception is raised.
+    """
+    monkeypatch.setattr(metadata_fetcher, "MIRROR_HEDGE_DELAY", 60)
+    invalid_server = metadata_server_factory()
+    invalid_server.metadata = b"invalid"
+    unreachable_server = metadata_server_factory()
+    unreachable_server.shutdown()
+    unreachable_server.server_close()
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=unreachable_server.url,
+            metadata_urls=(unreachable_server.url, invalid_server.url),
+            metadata_streaming=metadata_streaming,
+        )
+    )
+
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates
+
+
+@patch("urllib.request.urlopen")
+def test_saml_mirrors_not_modified(urlopen_mock, tmp_path):
+    """
+    arrange: persist a snapshot and mock mirrors answering not modified.
+    act: access the metadata properties.
+    assert: the persisted snapshot is used.
+    """
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    urlopen_mock.side_effect = urllib.error.HTTPError(
+        metadata_url, 304, "Not Modified", Message(), None
+    )
+    cache = MetadataCache(tmp_path)
+    snapshot = MetadataSnapshot(
+        metadata_url=metadata_url,
+        digest="abc",
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=None,
+        etag='"v2"',
+        last_modified="Wed, 21 Oct 2015 07:28:00 GMT",
+        certificates=["cert2_content"],
+        endpoints=[],
+    )
+    cache.save_snapshot(snapshot)
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=metadata_url,
+            metadata_urls=(metadata_url, "https://mirror.example.com/metadata"),
+        ),
+        cache=cache,
+    )
+
+    assert saml_integrator.snapshot.dict(exclude={"fetched_at"}) == snapshot.dict(
+        exclude={"fetched_at"}
+    )
+    assert saml_integrator.snapshot.fetched_at
+    assert urlopen_mock.call_count == 1
+
+
+@patch("urllib.request.urlopen")
+def test_saml_mirrors_cached_extraction_accepted(urlopen_mock, tmp_path):
+    """
+    arrange: extract an entity from mirrored metadata with a cache.
+    act: extract it again after the snapshot is lost.
+    assert: the response is accepted without parsing the metadata.
+    """
+    metadata_url = "https://federation.test/metadata"
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata_url=metadata_url,
+        metadata_urls=(metadata_url, "https://mirror.example.com/metadata"),
+    )
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    cache = MetadataCache(tmp_path)
+    expected = SamlIntegrator(charm_state=charm_state, cache=cache).certificates
+    (tmp_path / SNAPSHOT_FILENAME).unlink()
+
+    with patch.object(saml, "MetadataDocument") as document_mock:
+        assert SamlIntegrator(charm_state=charm_state, cache=cache).certificates == expected
+        document_mock.assert_not_called()
+
+
+@patch("urllib.request.urlopen")
+def test_saml_mirrors_cached_extraction_forced(urlopen_mock, tmp_path):
+    """
+    arrange: extract an entity from mirrored metadata with a cache.
+    act: extract it again, forcing the refresh.
+    assert: the response is checked without looking up the cached extractions.
+    """
+    metadata_url = "https://federation.test/metadata"
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata_url=metadata_url,
+        metadata_urls=(metadata_url, "https://mirror.example.com/metadata"),
+    )
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    cache = MetadataCache(tmp_path)
+    expected = SamlIntegrator(charm_state=charm_state, cache=cache).certificates
+
+    with patch.object(cache, "load_extracted") as load_extracted_mock:
+        saml_integrator = SamlIntegrator(charm_state=charm_state, cache=cache, force=True)
+        assert saml_integrator.certificates == expected
+        load_extracted_mock.assert_not_called()
+
+
+def test_saml_slow_drip_deadline(metadata_server, monkeypatch):
+    """
+    arrange: serve the metadata slowly enough to never trigger a socket timeout.
+    act: access the metadata properties.
+    assert: a CharmConfigInvalidError exception is raised once the deadline is exceeded.
+    """
+    monkeypatch.setattr(metadata_fetcher, "FETCH_DEADLINE", 0.5)
+    metadata_server.chunk_delay = 0.05
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=metadata_server.url,
+        )
+    )
+
+    start = time.monotonic()
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates
+    assert time.monotonic() - start < 2
+
+
+@pytest.mark.parametrize(
+    "failures, failure_status, expected",
+    [
+        pytest.param(2, 503, (3, True), id="transient errors recovered"),
+        pytest.param(3, 429, (3, False), id="transient errors exhausted"),
+        pytest.param(1, 404, (1, False), id="permanent error"),
+    ],
+)
+def test_saml_fetch_retries(metadata_server, monkeypatch, failures, failure_status, expected):
+    """
+    arrange: serve errors for the first requests.
+    act: access the metadata properties.
+    assert: only the transient errors are retried, up to the maximum number of attempts.
+    """
+    monkeypatch.setattr(metadata_fetcher, "FETCH_RETRY_BACKOFF", 0.01)
+    metadata_server.failures = failures
+    metadata_server.failure_status = failure_status
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=metadata_server.url,
+        )
+    )
+
+    expected_requests, succeeds = expected
+    if succeeds:
+        assert saml_integrator.certificates == ["cert1_content", "cert2_content"]
+    else:
+        with pytest.raises(CharmConfigInvalidError):
+            saml_integrator.certificates
+    assert len(metadata_server.requests) == expected_requests
+
+
+def test_saml_fetch_retries_stop_at_deadline(metadata_server, monkeypatch):
+    """
+    arrange: serve a transient error with a backoff longer than the deadline.
+    act: access the metadata properties.
+    assert: the request is not retried.
+    """
+    monkeypatch.setattr(metadata_fetcher, "FETCH_DEADLINE", 0.5)
+    monkeypatch.setattr(metadata_fetcher, "FETCH_RETRY_BACKOFF", 60)
+    monkeypatch.setattr(metadata_fetcher.random, "uniform", lambda low, high: high)
+    metadata_server.failures = 1
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=metadata_server.url,
+        )
+    )
+
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates
+    assert len(metadata_server.requests) == 1
+
+
+def test_saml_mirrors_deadline(metadata_server_factory, monkeypatch):
+    """
+    arrange: serve the metadata from mirrors slower than the deadline.
+    act: access the metadata properties.
+    assert: a CharmConfigInvalidError exception is raised once the deadline is exceeded.
+    """
+    monkeypatch.setattr(metadata_fetcher, "FETCH_DEADLINE", 0.3)
+    monkeypatch.setattr(metadata_fetcher, "MIRROR_HEDGE_DELAY", 0.05)
+    servers = [metadata_server_factory(), metadata_server_factory()]
+    for server in servers:
+        server.delay = 5
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=servers[0].url,
+            metadata_urls=tuple(server.url for server in servers),
+        )
+    )
+
+    start = time.monotonic()
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates
+    assert time.monotonic() - start < 2
+    assert saml_integrator._fetcher.remaining() <= 0  # pylint: disable=protected-access
+
+
+def test_fetcher_deadline_exceeded(metadata_server, monkeypatch):
+    """
+    arrange: set up a fetcher whose deadline has been exceeded.
+    act: fetch the metadata.
+    assert: a CharmConfigInvalidError exception is raised without sending any request.
+    """
+    monkeypatch.setattr(metadata_fetcher, "FETCH_DEADLINE", 0)
+    fetcher = metadata_fetcher.MetadataFetcher([metadata_server.url])
+
+    with pytest.raises(CharmConfigInvalidError, match="Deadline"):
+        fetcher.fetch()
+    assert not metadata_server.requests
+
+
+def test_call_with_deadline():
+    """
+    arrange: define a function raising an exception and a slow one.
+    act: call them with a deadline.
+    assert: the exception is propagated and the slow function is abandoned.
+    """
+
+    def fail() -> None:
+        """Fail.
+
+        Raises:
+            KeyError: always.
+        """
+        raise KeyError("error")
+
+    with pytest.raises(KeyError):
+        metadata_fetcher.call_with_deadline(fail, 1)
+    with pytest.raises(TimeoutError):
+        metadata_fetcher.call_with_deadline(lambda: time.sleep(5), 0.05)
+    assert metadata_fetcher.call_with_deadline(lambda: "result", 1) == "result"
+
+
+@pytest.mark.parametrize(
+    "content_encoding, encoder",
+    [
+        pytest.param(None, lambda data: data, id="identity"),
+        pytest.param("gzip", gzip.compress, id="gzip"),
+    ],
+)
+def test_fetcher_max_size(metadata_server, content_encoding, encoder):
+    """
+    arrange: serve the metadata from a local server, with and without compression.
+    act: fetch it with a maximum size just below and at its size.
+    assert: it's only rejected when it exceeds the maximum size and its digest is computed.
+    """
+    metadata_server.content_encoding = content_encoding
+    metadata_server.encoder = encoder
+    size = len(metadata_server.metadata)
+
+    with pytest.raises(CharmConfigInvalidError, match="maximum size"):
+        metadata_fetcher.MetadataFetcher([metadata_server.url], max_size=size - 1).fetch()
+    metadata = metadata_fetcher.MetadataFetcher([metadata_server.url], max_size=size).fetch()
+
+    assert metadata.content == metadata_server.metadata
+    assert metadata.digest == hashlib.sha256(metadata_server.metadata).hexdigest()
+
+
+def test_fetcher_max_size_decompression_bomb(metadata_server):
+    """
+    arrange: serve a small gzip body expanding to a large document.
+    act: fetch it.
+    assert: the decompression stops as soon as the maximum size is exceeded.
+    """
+    metadata_server.metadata = b"<a>" + b" " * 50 * 1024 * 1024 + b"</a>"
+    metadata_server.content_encoding = "gzip"
+    metadata_server.encoder = gzip.compress
+    chunks = []
+    decode_chunks = metadata_fetcher._decode_chunks  # pylint: disable=protected-access
+
+    def record(*args):
+        """Record the decoded chunks.
+
+        Args:
+            args: _decode_chunks arguments.
+
+        Yields:
+            The decoded chunks.
+        """
+        for chunk in decode_chunks(*args):
+            chunks.append(len(chunk))
+            yield chunk
+
+    with patch.object(metadata_fetcher, "_decode_chunks", record):
+        with pytest.raises(CharmConfigInvalidError, match="maximum size"):
+            metadata_fetcher.MetadataFetcher([metadata_server.url], max_size=1024).fetch()
+    assert sum(chunks) == 1025
+
+
+def test_fetcher_max_size_content_length(metadata_server):
+    """
+    arrange: serve the metadata from a local server.
+    act: fetch it with a maximum size below its announced length.
+    assert: it's rejected without reading the body.
+    """
+    with patch.object(metadata_fetcher, "_decode_chunks") as decode_chunks_mock:
+        with pytest.raises(CharmConfigInvalidError, match="maximum size"):
+            metadata_fetcher.MetadataFetcher([metadata_server.url], max_size=10).fetch()
+    decode_chunks_mock.assert_not_called()
+
+
+def test_saml_metadata_parsed_from_bytes(metadata_server):
+    """
+    arrange: serve the metadata encoded as UTF-16 with an XML declaration.
+    act: extract an entity.
+    assert: the metadata is parsed and the extracted data is the same as for UTF-8.
+    """
+    metadata_server.metadata = (
+        '<?xml version="1.0" encoding="UTF-16"?>\n' + metadata_server.metadata.decode("utf-8")
+    ).encode("utf-16")
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url=metadata_server.url,
+        )
+    )
+
+    assert saml_integrator.certificates == ["cert1_content", "cert2_content"]
@@ -0,0 +1,155 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Metadata validUntil and cacheDuration unit tests."""
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+import saml
+from metadata_cache import MetadataCache
+from saml import SamlIntegrator
+from tests.unit.helpers import get_charm_state_mock, get_urlopen_result_mock
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        pytest.param("PT6H", timedelta(hours=6), id="hours"),
+        pytest.param(
+            "P1Y2M1W3DT4H5M6.5S",
+            timedelta(days=365 + 60 + 7 + 3, hours=4, minutes=5, seconds=6.5),
+            id="all parts",
+        ),
+        pytest.param(" PT0S ", timedelta(0), id="zero"),
+        pytest.param("P", None, id="no parts"),
+        pytest.param("P1DT", None, id="no time parts"),
+        pytest.param("-PT1H", None, id="negative"),
+        pytest.param("6h", None, id="invalid"),
+    ],
+)
+def test_parse_duration(value, expected):
+    """
+    arrange: define an xs:duration.
+    act: parse it.
+    assert: the expected duration is returned, or None if it's invalid.
+    """
+    assert saml.parse_duration(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        pytest.param(
+            "2024-06-01T10:00:00Z", datetime(2024, 6, 1, 10, tzinfo=timezone.utc), id="UTC"
+        ),
+        pytest.param(
+            "2024-06-01T12:00:00.1234+02:00",
+            datetime(2024, 6, 1, 10, 0, 0, 123400, tzinfo=timezone.utc),
+            id="offset",
+        ),
+        pytest.param(
+            "2024-06-01T10:00:00", datetime(2024, 6, 1, 10, tzinfo=timezone.utc), id="naive"
+        ),
+        pytest.param("June 2024", None, id="invalid"),
+    ],
+)
+def test_parse_date_time(value, expected):
+    """
+    arrange: define an xs:dateTime.
+    act: parse it.
+    assert: the expected date and time is returned, or None if it's invalid.
+    """
+    assert saml.parse_date_time(value) == expected
+
+
+@pytest.mark.parametrize("metadata_streaming", [False, True])
+@patch("urllib.request.urlopen")
+def test_saml_extracts_validity(urlopen_mock, metadata_streaming):
+    """
+    arrange: mock an aggregate declaring validUntil and cacheDuration on the root and an entity.
+    act: extract that entity and another one.
+    assert: the most restrictive values applying to each entity are extracted.
+    """
+    metadata = (
+        Path("tests/unit/files/metadata_aggregate.xml")
+        .read_bytes()
+        .replace(
+            b'Name="https://federation.test/metadata"',
+            b'Name="https://federation.test/metadata" validUntil="2030-01-01T00:00:00Z"'
+            b' cacheDuration="PT6H"',
+        )
+        .replace(
+            b'entityID="https://idp1.federation.test"',
+            b'entityID="https://idp1.federation.test" validUntil="2029-01-01T00:00:00Z"'
+            b' cacheDuration="P1D"',
+        )
+    )
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            metadata_streaming=metadata_streaming,
+            metadata_url="https://federation.test/metadata",
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+        )
+    )
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+
+    entities = saml_integrator.entities(
+        ["https://login.staging.ubuntu.com", "https://idp1.federation.test"]
+    )
+
+    assert entities["https://login.staging.ubuntu.com"].valid_until == datetime(
+        2030, 1, 1, tzinfo=timezone.utc
+    )
+    assert entities["https://login.staging.ubuntu.com"].cache_duration == timedelta(hours=6)
+    assert entities["https://idp1.federation.test"].valid_until == datetime(
+        2029, 1, 1, tzinfo=timezone.utc
+    )
+    assert entities["https://idp1.federation.test"].cache_duration == timedelta(hours=6)
+
+
+@pytest.mark.parametrize("mode", ["document", "streaming", "index"])
+@patch("urllib.request.urlopen")
+def test_saml_extracts_nested_validity(urlopen_mock, mode, tmp_path):
+    """
+    arrange: mock an aggregate declaring validUntil on the root and cacheDuration on a nested
+        aggregate.
+    act: extract an entity of the nested aggregate together with a later one, parsing the whole
+        document, streaming it or after extracting another entity with a cache.
+    assert: the values of all the ancestors of the entity are extracted in every mode.
+    """
+    metadata_url = "https://federation.test/metadata"
+    metadata = Path("tests/unit/files/metadata_nested_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    cache = MetadataCache(tmp_path) if mode == "index" else None
+    if cache:
+        assert SamlIntegrator(
+            charm_state=get_charm_state_mock(
+                metadata_url=metadata_url, entity_id="https://idp1.federation.test", fingerprint=""
+            ),
+            cache=cache,
+        ).snapshot.is_expired()
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            metadata_streaming=mode == "streaming",
+            metadata_url=metadata_url,
+            entity_id="https://idp1.federation.test",
+            fingerprint="",
+        ),
+        cache=cache,
+    )
+
+    entity = saml_integrator.entities(
+        ["https://idp2.federation.test", "https://idp4.federation.test"]
+    )["https://idp2.federation.test"]
+
+    assert entity.valid_until == datetime(2020, 1, 1, tzinfo=timezone.utc)
+    assert entity.cache_duration == timedelta(hours=1)
+    assert entity.is_expired()
@@ -0,0 +1,84 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Metrics unit tests."""
+
+from pathlib import Path
+
+from metrics import (
+    CACHE_REQUESTS,
+    DOWNLOADED_BYTES,
+    FETCH_DURATION,
+    LAST_REFRESH,
+    METRICS_TEXTFILE_NAME,
+    PARSE_DURATION,
+    MetricsRecorder,
+)
+
+
+def scrape(state_dir: Path) -> dict[str, float]:
+    """Read the rendered metrics as a scraper would.
+
+    Args:
+        state_dir: directory where the metrics are persisted.
+
+    Returns:
+        The sample values, by sample name and labels.
+    """
+    samples = {}
+    for line in (state_dir / METRICS_TEXTFILE_NAME).read_text(encoding="utf-8").splitlines():
+        if line and not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+    return samples
+
+
+def test_metrics_merged_across_processes(tmp_path):
+    """
+    arrange: record metrics in two recorders, standing in for two hooks.
+    act: flush both of them to the same state directory.
+    assert: counters and histograms are added up, and gauges hold the last value.
+    """
+    first = MetricsRecorder()
+    first.inc(DOWNLOADED_BYTES, 100)
+    first.inc(CACHE_REQUESTS, cache="extracted", result="hit")
+    first.observe(FETCH_DURATION, 0.2)
+    first.set(LAST_REFRESH, 1000)
+    second = MetricsRecorder()
+    second.inc(DOWNLOADED_BYTES, 50)
+    with second.time(PARSE_DURATION, mode="document"):
+        pass
+    second.observe(FETCH_DURATION, 45)
+    second.set(LAST_REFRESH, 2000.5)
+
+    first.flush(tmp_path)
+    second.flush(tmp_path)
+    second.flush(tmp_path)
+
+    samples = scrape(tmp_path)
+    assert samples[DOWNLOADED_BYTES] == 150
+    assert samples[f'{CACHE_REQUESTS}{{cache="extracted",result="hit"}}'] == 1
+    assert samples[f'{FETCH_DURATION}_bucket{{le="0.25"}}'] == 1
+    assert samples[f'{FETCH_DURATION}_bucket{{le="60"}}'] == 2
+    assert samples[f'{FETCH_DURATION}_bucket{{le="+Inf"}}'] == 2
+    assert samples[f"{FETCH_DURATION}_count"] == 2
+    assert samples[f"{FETCH_DURATION}_sum"] == 45.2
+    assert samples[f'{PARSE_DURATION}_count{{mode="document"}}'] == 1
+    assert samples[LAST_REFRESH] == 2000.5
+
+
+def test_metrics_flush_failure(tmp_path):
+    """
+    arrange: record a metric and make the state directory unwritable.
+    act: flush the metrics.
+    assert: the failure is ignored and the metrics are discarded.
+    """
+    recorder = MetricsRecorder()
+    recorder.inc(DOWNLOADED_BYTES, 100)
+    state_dir = tmp_path / "state"
+    state_dir.write_text("not a directory", encoding="utf-8")
+
+    recorder.flush(state_dir)
+
+    recorder.flush(tmp_path)
+    assert not (tmp_path / METRICS_TEXTFILE_NAME).exists()
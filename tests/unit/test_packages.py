@@ -0,0 +1,94 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Packages installation unit tests."""
+
+import subprocess  # nosec
+from unittest.mock import MagicMock, patch
+
+import pytest
+from charms.operator_libs_linux.v0 import apt
+
+import packages
+
+
+def dpkg_query_result(stdout: str) -> MagicMock:
+    """Get a mock for the result of a dpkg-query call.
+
+    Args:
+        stdout: the output of dpkg-query.
+
+    Returns:
+        The mock for the completed process.
+    """
+    result = MagicMock()
+    result.stdout = stdout
+    return result
+
+
+@patch.object(packages.subprocess, "run")
+def test_install_packages_already_installed(run_mock):
+    """
+    arrange: list all the required packages as installed, one of them for several architectures.
+    act: install the required packages.
+    assert: the packages are queried once and apt isn't run.
+    """
+    run_mock.return_value = dpkg_query_result(
+        "libssl-dev\tii \nlibxml2\tii \nlibxml2\tun \nlibxslt1-dev\tii \n"
+    )
+
+    packages.install_packages()
+
+    run_mock.assert_called_once()
+    assert run_mock.call_args.args[0][0] == "dpkg-query"
+    assert run_mock.call_args.args[0][-3:] == list(packages.REQUIRED_PACKAGES)
+
+
+@patch.object(packages.subprocess, "run")
+def test_install_packages_missing(run_mock):
+    """
+    arrange: list a required package as removed and another one as unknown.
+    act: install the required packages.
+    assert: the apt cache is updated and the missing packages are installed in one transaction.
+    """
+    run_mock.return_value = dpkg_query_result("libssl-dev\tii \nlibxml2\trc \n")
+
+    packages.install_packages()
+
+    commands = [call.args[0] for call in run_mock.call_args_list]
+    assert commands[1] == ["apt-get", "update"]
+    assert commands[2][0] == "apt-get"
+    assert commands[2][-3:] == ["install", "libxml2", "libxslt1-dev"]
+    assert run_mock.call_args.kwargs["env"]["DEBIAN_FRONTEND"] == "noninteractive"
+    assert len(commands) == 3
+
+
+@patch.object(packages.subprocess, "run")
+def test_install_packages_without_dpkg_query(run_mock):
+    """
+    arrange: make dpkg-query unavailable.
+    act: install the required packages.
+    assert: all the packages are installed.
+    """
+    run_mock.side_effect = [FileNotFoundError("dpkg-query"), MagicMock(), MagicMock()]
+
+    packages.install_packages()
+
+    assert run_mock.call_args.args[0][-4:] == ["install", *packages.REQUIRED_PACKAGES]
+
+
+@patch.object(packages.subprocess, "run")
+def test_install_packages_failure(run_mock):
+    """
+    arrange: list no package as installed and make apt-get install fail.
+    act: install the required packages.
+    assert: a package error is raised.
+    """
+    run_mock.side_effect = [
+        dpkg_query_result(""),
+        MagicMock(),
+        subprocess.CalledProcessError(100, "apt-get", stderr=b"E: Unable to locate package"),
+    ]
+
+    with pytest.raises(apt.PackageError):
+        packages.install_packages()
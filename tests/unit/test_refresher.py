@@ -0,0 +1,174 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""MetadataRefresher unit tests."""
+
+import subprocess  # nosec
+from pathlib import Path
+from unittest.mock import call, patch
+
+import pytest
+
+import refresher
+from metadata_cache import MetadataCache
+from tests.unit.helpers import get_urlopen_result_mock
+
+
+@patch.object(refresher.subprocess, "run")
+def test_refresher_install_and_remove(run_mock, systemd_dir, tmp_path):
+    """
+    arrange: set up a refresher.
+    act: install it twice and remove it twice.
+    assert: the unit files are only written and the timer only enabled or disabled once.
+    """
+    metadata_refresher = refresher.MetadataRefresher(tmp_path / "state", Path("/charm"))
+    service_path = systemd_dir / f"{refresher.SERVICE_NAME}.service"
+    timer_path = systemd_dir / f"{refresher.SERVICE_NAME}.timer"
+
+    metadata_refresher.install()
+    metadata_refresher.install()
+
+    assert f"/charm/src/refresher.py {tmp_path / 'state'}" in service_path.read_text()
+    assert f"OnUnitInactiveSec={refresher.REFRESH_INTERVAL}" in timer_path.read_text()
+    assert run_mock.call_args_list == [
+        call(["systemctl", "daemon-reload"], check=True),
+        call(["systemctl", "enable", "--now", f"{refresher.SERVICE_NAME}.timer"], check=True),
+    ]
+    run_mock.reset_mock()
+
+    metadata_refresher.remove()
+    metadata_refresher.remove()
+
+    assert not service_path.exists()
+    assert not timer_path.exists()
+    assert run_mock.call_args_list == [
+        call(["systemctl", "disable", "--now", f"{refresher.SERVICE_NAME}.timer"], check=True),
+        call(["systemctl", "daemon-reload"], check=True),
+    ]
+
+
+@patch("urllib.request.urlopen")
+def test_refresh(urlopen_mock, tmp_path):
+    """
+    arrange: configure a refresher for an aggregate and several entities.
+    act: run the refresher twice.
+    assert: the snapshot and the data of all the entities are persisted, and the metadata is
+        not fetched again before the minimum refresh interval.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    metadata_refresher = refresher.MetadataRefresher(tmp_path, Path("/charm"))
+    metadata_refresher.configure(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://federation.test/metadata",
+        },
+        ["https://idp1.federation.test"],
+    )
+
+    assert refresher.main([str(tmp_path)]) == 0
+    assert refresher.main([str(tmp_path)]) == 0
+
+    assert urlopen_mock.call_count == 1
+    cache = MetadataCache(tmp_path)
+    snapshot = cache.load_snapshot()
+    assert snapshot
+    assert snapshot.certificates == ["cert1_content", "cert2_content"]
+    idp1 = cache.load_extracted(
+        str(snapshot.digest), "https://idp1.federation.test", fingerprint=None
+    )
+    assert idp1
+    assert idp1.certificates == ["idp1_cert_content"]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        pytest.param(None, id="missing"),
+        pytest.param("{invalid", id="invalid json"),
+        pytest.param('{"config": {"entity_id": ""}, "entity_ids": []}', id="invalid config"),
+        pytest.param(
+            '{"config": {"entity_id": "https://login.staging.ubuntu.com",'
+            ' "metadata_url": "https://federation.test/metadata"}}',
+            id="missing entity IDs",
+        ),
+    ],
+)
+def test_refresh_invalid_configuration(content, tmp_path):
+    """
+    arrange: write an invalid refresher configuration.
+    act: run the refresher.
+    assert: the refresher fails.
+    """
+    if content is not None:
+        (tmp_path / refresher.REFRESHER_CONFIG_FILENAME).write_text(content, encoding="utf-8")
+
+    assert refresher.main([str(tmp_path)]) == 1
+
+
+@patch.object(refresher.subprocess, "run")
+def test_refresh_dispatch_failure(run_mock, tmp_path):
+    """
+    arrange: leave the refresher unconfigured and make juju-exec fail.
+    act: run the refresher to dispatch the metadata ready event.
+    assert: the refresher fails after trying to dispatch the event anyway.
+    """
+    run_mock.side_effect = subprocess.CalledProcessError(1, "juju-exec")
+
+    assert refresher.main([str(tmp_path), "--dispatch", "saml-integrator/0"]) == 1
+
+    run_mock.assert_called_once()
+
+
+@patch.object(refresher.subprocess, "run")
+def test_refresh_dispatch_juju_run(run_mock, tmp_path):
+    """
+    arrange: leave the refresher unconfigured and make juju-exec missing, as before Juju 3.
+    act: run the refresher to dispatch the metadata ready event.
+    assert: the event is dispatched with juju-run instead.
+    """
+    run_mock.side_effect = [FileNotFoundError("juju-exec"), None]
+
+    refresher.main(
+        [str(tmp_path), "--dispatch", "saml-integrator/0", "--charm-dir", str(tmp_path)]
+    )
+
+    run_mock.assert_called_with(
+        [
+            "juju-run",
+            "saml-integrator/0",
+            "SAML_INTEGRATOR_REFRESH_STATUS=1 "
+            f"JUJU_DISPATCH_PATH=hooks/metadata_ready {tmp_path}/dispatch",
+        ],
+        check=True,
+    )
+
+
+@patch.object(refresher.subprocess, "run")
+@patch("urllib.request.urlopen")
+def test_refresh_if_due(urlopen_mock, run_mock, tmp_path):
+    """
+    arrange: configure a refresher and persist a fresh snapshot.
+    act: run the refresher to dispatch the metadata ready event, only fetching if due.
+    assert: the metadata is not fetched again, the event being dispatched anyway.
+    """
+    urlopen_result_mock = get_urlopen_result_mock(
+        200, Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    )
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    refresher.MetadataRefresher(tmp_path, Path("/charm")).configure(
+        {
+            "entity_id": "https://login.staging.ubuntu.com",
+            "metadata_url": "https://login.staging.ubuntu.com/saml/metadata",
+        },
+        [],
+    )
+    assert refresher.main([str(tmp_path)]) == 0
+
+    assert refresher.main([str(tmp_path), "--dispatch", "saml-integrator/0", "--if-due"]) == 0
+
+    assert urlopen_mock.call_count == 1
+    run_mock.assert_called_once()
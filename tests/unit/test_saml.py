@@ -3,29 +3,21 @@
 
 """SAML Integrator unit tests."""
 # pylint: disable=pointless-statement
-import urllib
-from unittest.mock import MagicMock, patch
+import time
+import urllib.error
+import urllib.request
+from email.message import Message
+from pathlib import Path
+from unittest.mock import patch
 
 import pytest
 
+import saml
 from charm_state import CharmConfigInvalidError
+from metadata_cache import MetadataCache, MetadataSnapshot
 from saml import SamlIntegrator
-
-
-def get_urlopen_result_mock(code: int, result: bytes) -> MagicMock:
-    """Get a MagicMock for the urlopen response.
-
-    Args:
-        code: response code.
-        result: response content.
-
-    Returns:
-        Mock for the response.
-    """
-    urlopen_result_mock = MagicMock()
-    urlopen_result_mock.getcode.return_value = code
-    urlopen_result_mock.read.return_value = result
-    return urlopen_result_mock
+from tests.unit.helpers import get_charm_state_mock, get_urlopen_result_mock
+from tracing import TRACER
 
 
 @patch("urllib.request.urlopen")
@@ -39,7 +31,7 @@ def test_saml_with_invalid_metadata(urlopen_mock):
     urlopen_result_mock = get_urlopen_result_mock(200, b"invalid")
     urlopen_result_mock.__enter__.return_value = urlopen_result_mock
     urlopen_mock.return_value = urlopen_result_mock
-    charm_state = MagicMock(
+    charm_state = get_charm_state_mock(
         entity_id="https://login.staging.ubuntu.com",
         metadata_url="https://login.staging.ubuntu.com/saml/metadata",
     )
@@ -58,7 +50,7 @@ def test_saml_with_invalid_url(_):
     assert: a CharmConfigInvalidError exception is raised when attempting to access the
         properties read from the metadata.
     """
-    charm_state = MagicMock(
+    charm_state = get_charm_state_mock(
         entity_id="https://login.staging.ubuntu.com",
         metadata_url="https://login.staging.ubuntu.com/saml/metadata",
     )
@@ -83,7 +75,7 @@ def test_saml_with_valid_signed_metadata(urlopen_mock):
 
         entity_id = "https://login.staging.ubuntu.com"
         metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
-        charm_state = MagicMock(
+        charm_state = get_charm_state_mock(
             entity_id=entity_id,
             fingerprint=(
                 "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
@@ -151,7 +143,7 @@ def test_saml_with_valid_tampered_signed_metadata(urlopen_mock):
 
         entity_id = "https://login.staging.ubuntu.com"
         metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
-        charm_state = MagicMock(
+        charm_state = get_charm_state_mock(
             entity_id=entity_id,
             fingerprint=(
                 "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
@@ -178,7 +170,7 @@ def test_saml_with_valid_signed_metadata_not_matching_fingerprint(urlopen_mock):
 
         entity_id = "https://login.staging.ubuntu.com"
         metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
-        charm_state = MagicMock(
+        charm_state = get_charm_state_mock(
             entity_id=entity_id,
             fingerprint="invalid_fingerprint",
             metadata_url=metadata_url,
@@ -202,7 +194,7 @@ def test_saml_with_valid_unsigned_metadata(urlopen_mock):
 
         entity_id = "https://login.staging.ubuntu.com"
         metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
-        charm_state = MagicMock(
+        charm_state = get_charm_state_mock(
             entity_id=entity_id,
             fingerprint="",
             metadata_url=metadata_url,
@@ -235,7 +227,7 @@ def test_saml_with_metadata_with_default_namespaces(urlopen_mock):
 
         entity_id = "https://saml.canonical.test/metadata"
         metadata_url = "https://saml.canonical.test/metadata"
-        charm_state = MagicMock(
+        charm_state = get_charm_state_mock(
             entity_id=entity_id,
             fingerprint="",
             metadata_url=metadata_url,
@@ -251,3 +243,645 @@ def test_saml_with_metadata_with_default_namespaces(urlopen_mock):
         assert endpoints[1].binding == "urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
         assert endpoints[1].url == "https://saml.canonical.test/sso"
         assert endpoints[1].response_url is None
+
+
+@patch("urllib.request.urlopen")
+def test_saml_fetches_metadata_once(urlopen_mock):
+    """
+    arrange: mock the metadata contents so that they are valid and signed.
+    act: access all the metadata properties.
+    assert: the metadata is fetched only once and all properties read from the same document.
+    """
+    with open("tests/unit/files/metadata_signed.xml", "rb") as metadata:
+        urlopen_result_mock = get_urlopen_result_mock(200, metadata.read())
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+        ),
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+
+    saml_integrator.signing_certificate
+    saml_integrator.signature
+    saml_integrator.tree
+    saml_integrator.certificates
+    saml_integrator.endpoints
+
+    assert urlopen_mock.call_count == 1
+    assert saml_integrator.tree is saml_integrator.document.tree
+    assert saml_integrator.signature is not None
+    assert saml_integrator.nsmap["md"] == "urn:oasis:names:tc:SAML:2.0:metadata"
+
+
+@patch("urllib.request.urlopen")
+def test_saml_revalidates_metadata_conditionally(urlopen_mock, tmp_path):
+    """
+    arrange: fetch the metadata once with a cache, the server returning validators.
+    act: access the metadata properties from a new instance while the server answers
+        not modified.
+    assert: the validators are sent and the previous SAML data is reused without parsing.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(
+        200, metadata, {"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    )
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+    )
+    cache = MetadataCache(tmp_path)
+    first = SamlIntegrator(charm_state=charm_state, cache=cache)
+    certificates = first.certificates
+    endpoints = first.endpoints
+    urlopen_mock.reset_mock()
+    urlopen_mock.side_effect = urllib.error.HTTPError(
+        charm_state.metadata_url, 304, "Not Modified", {}, None
+    )
+
+    second = SamlIntegrator(charm_state=charm_state, cache=cache)
+    with patch.object(saml, "MetadataDocument") as document_mock:
+        assert second.certificates == certificates
+        assert second.endpoints == endpoints
+        document_mock.assert_not_called()
+    request = urlopen_mock.call_args.args[0]
+    assert request.get_header("If-none-match") == '"v1"'
+    assert request.get_header("If-modified-since") == "Wed, 21 Oct 2015 07:28:00 GMT"
+
+
+@patch("urllib.request.urlopen")
+def test_saml_does_not_revalidate_for_a_different_metadata_url(urlopen_mock, tmp_path):
+    """
+    arrange: persist a snapshot extracted from a different metadata URL.
+    act: access the metadata properties.
+    assert: the metadata is fetched unconditionally and the snapshot replaced.
+    """
+    metadata = Path("tests/unit/files/metadata_unsigned.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata, {"ETag": '"v2"'})
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    cache = MetadataCache(tmp_path)
+    cache.save_snapshot(
+        MetadataSnapshot(
+            metadata_url="https://other.example.com/metadata",
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint=None,
+            etag='"v1"',
+            last_modified=None,
+            certificates=[],
+            endpoints=[],
+        )
+    )
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com", fingerprint="", metadata_url=metadata_url
+    )
+
+    saml_integrator = SamlIntegrator(charm_state=charm_state, cache=cache)
+
+    assert saml_integrator.certificates == ["cert1_content"]
+    assert not urlopen_mock.call_args.args[0].has_header("If-none-match")
+    assert cache.load_snapshot().etag == '"v2"'
+
+
+@patch.object(
+    urllib.request,
+    "urlopen",
+    side_effect=urllib.error.HTTPError(
+        "https://example.com", 304, "Not Modified", Message(), None
+    ),
+)
+def test_saml_not_modified_without_snapshot(_):
+    """
+    arrange: mock the HTTP request so that the server answers not modified.
+    act: access the metadata properties without a previous snapshot.
+    assert: a CharmConfigInvalidError exception is raised.
+    """
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+    )
+    saml_integrator = SamlIntegrator(charm_state=charm_state)
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates
+
+
+@patch("urllib.request.urlopen")
+def test_saml_reuses_data_extracted_from_same_contents(urlopen_mock, tmp_path):
+    """
+    arrange: extract the SAML data once with a cache, the server not returning validators.
+    act: access the metadata properties from a new instance, the server returning the same
+        contents.
+    assert: the metadata is downloaded again but not parsed nor verified.
+    """
+    with open("tests/unit/files/metadata_signed.xml", "rb") as metadata:
+        urlopen_result_mock = get_urlopen_result_mock(200, metadata.read())
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+        ),
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+    )
+    cache = MetadataCache(tmp_path)
+    certificates = SamlIntegrator(charm_state=charm_state, cache=cache).certificates
+
+    saml_integrator = SamlIntegrator(charm_state=charm_state, cache=cache)
+    with patch.object(saml, "MetadataDocument") as document_mock:
+        assert saml_integrator.certificates == certificates
+        document_mock.assert_not_called()
+    assert urlopen_mock.call_count == 2
+    assert saml_integrator.snapshot.digest == saml_integrator.document.digest
+
+
+@patch("urllib.request.urlopen")
+def test_saml_reuses_signature_verdict(urlopen_mock, tmp_path):
+    """
+    arrange: extract the SAML data from signed metadata once with a cache.
+    act: extract the data for a different entity ID from the same contents.
+    assert: the document is parsed again but its signature is not verified again.
+    """
+    with open("tests/unit/files/metadata_signed.xml", "rb") as metadata:
+        urlopen_result_mock = get_urlopen_result_mock(200, metadata.read())
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    fingerprint = (
+        "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+        ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+    )
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    cache = MetadataCache(tmp_path)
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=fingerprint,
+        metadata_url=metadata_url,
+    )
+    assert SamlIntegrator(charm_state=charm_state, cache=cache).certificates
+    charm_state = get_charm_state_mock(
+        entity_id="https://other.staging.ubuntu.com",
+        fingerprint=fingerprint,
+        metadata_url=metadata_url,
+    )
+
+    with patch("signxml.XMLVerifier") as verifier_mock:
+        assert not SamlIntegrator(charm_state=charm_state, cache=cache).certificates
+        verifier_mock.assert_not_called()
+    assert cache.verdicts.hits == 1
+    assert cache.verdicts.misses == 1
+
+
+@patch("urllib.request.urlopen")
+def test_saml_does_not_record_invalid_signature_verdict(urlopen_mock, tmp_path):
+    """
+    arrange: mock the metadata contents so that the signature is invalid.
+    act: access the metadata properties twice with a cache.
+    assert: the signature is verified and rejected every time.
+    """
+    with open("tests/unit/files/metadata_signed_tampered.xml", "rb") as metadata:
+        urlopen_result_mock = get_urlopen_result_mock(200, metadata.read())
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=(
+            "1c:73:51:f2:23:55:f8:3d:25:7e:65:56:dd:f1:a9:17:fe:d4:af"
+            ":dc:70:d2:a8:11:b3:2f:d2:ea:c4:6d:91:e7"
+        ),
+        metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+    )
+    cache = MetadataCache(tmp_path)
+
+    for _ in range(2):
+        saml_integrator = SamlIntegrator(charm_state=charm_state, cache=cache)
+        with pytest.raises(CharmConfigInvalidError):
+            saml_integrator.certificates
+
+    assert cache.verdicts.hits == 0
+    assert cache.verdicts.misses == 2
+    assert not cache.verdicts.verified
+
+
+@pytest.mark.parametrize(
+    "filename, entity_id",
+    [
+        ("metadata_unsigned.xml", "https://login.staging.ubuntu.com"),
+        ("metadata_default_namespaces.xml", "https://saml.canonical.test/metadata"),
+        ("metadata_aggregate.xml", "https://login.staging.ubuntu.com"),
+        ("metadata_aggregate.xml", "https://idp3.federation.test"),
+        ("metadata_aggregate.xml", "https://missing.federation.test"),
+        ("metadata_nested_aggregate.xml", "https://idp2.federation.test"),
+    ],
+)
+@patch("urllib.request.urlopen")
+def test_saml_streaming_extracts_same_data(urlopen_mock, filename, entity_id, tmp_path):
+    """
+    arrange: mock the metadata contents.
+    act: access the metadata properties with and without streaming.
+    assert: the same certificates and endpoints are extracted and no document is built when
+        streaming.
+    """
+    metadata = Path(f"tests/unit/files/{filename}").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    metadata_url = "https://federation.test/metadata"
+    expected = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id=entity_id, fingerprint="", metadata_url=metadata_url
+        )
+    )
+
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id=entity_id,
+            fingerprint="",
+            metadata_url=metadata_url,
+            metadata_streaming=True,
+        ),
+        cache=MetadataCache(tmp_path),
+    )
+
+    expected_certificates = expected.certificates
+    expected_endpoints = expected.endpoints
+    with patch.object(saml, "MetadataDocument") as document_mock:
+        assert saml_integrator.certificates == expected_certificates
+        assert saml_integrator.endpoints == expected_endpoints
+        document_mock.assert_not_called()
+
+
+@patch("urllib.request.urlopen")
+def test_saml_streaming_with_invalid_metadata(urlopen_mock):
+    """
+    arrange: mock the metadata contents so that they are invalid.
+    act: access the metadata properties while streaming.
+    assert: a CharmConfigInvalidError exception is raised.
+    """
+    urlopen_result_mock = get_urlopen_result_mock(200, b"<md:EntityDescriptor")
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url="https://login.staging.ubuntu.com/saml/metadata",
+            metadata_streaming=True,
+        ),
+        cache=None,
+    )
+    with pytest.raises(CharmConfigInvalidError):
+        saml_integrator.certificates
+
+
+@pytest.mark.parametrize("not_modified", [False, True], ids=["modified", "not-modified"])
+@patch("urllib.request.urlopen")
+def test_saml_streamed_extraction_not_trusted(urlopen_mock, not_modified, tmp_path):
+    """
+    arrange: extract the SAML data of tampered signed metadata while streaming, with a cache.
+    act: disable streaming and access the metadata properties again, the metadata being
+        modified or not.
+    assert: the cached data is not reused and the invalid signature is reported.
+    """
+    metadata_url = "https://login.staging.ubuntu.com/saml/metadata"
+    metadata = Path("tests/unit/files/metadata_signed_tampered.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    cache = MetadataCache(tmp_path)
+    config = {
+        "entity_id": "https://login.staging.ubuntu.com",
+        "fingerprint": "",
+        "metadata_url": metadata_url,
+    }
+    streamed = SamlIntegrator(
+        charm_state=get_charm_state_mock(**config, metadata_streaming=True), cache=cache
+    )
+    assert streamed.certificates
+    if not_modified:
+        urlopen_mock.side_effect = [
+            urllib.error.HTTPError(metadata_url, 304, "Not Modified", Message(), None),
+            urlopen_result_mock,
+        ]
+
+    saml_integrator = SamlIntegrator(charm_state=get_charm_state_mock(**config), cache=cache)
+
+    assert saml_integrator.cached_entities([config["entity_id"]]) is None
+    with pytest.raises(CharmConfigInvalidError, match="invalid signature"):
+        saml_integrator.entities([config["entity_id"]])
+
+
+def test_stream_entity_discards_other_entities():
+    """
+    arrange: load an aggregate with several entities.
+    act: stream the last entity.
+    assert: the entities read before it have been discarded.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+
+    entity = saml.stream_entity(metadata, "https://idp3.federation.test")
+
+    assert entity.get("entityID") == "https://idp3.federation.test"
+    assert len(entity.getparent()) == 1
+
+
+@patch("urllib.request.urlopen")
+def test_saml_not_modified_without_cached_document(urlopen_mock, tmp_path):
+    """
+    arrange: persist a snapshot for a different entity without caching its document.
+    act: access the metadata properties while the server answers not modified to
+        conditional requests.
+    assert: the metadata is fetched again unconditionally.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    metadata_url = "https://federation.test/metadata"
+    urlopen_mock.side_effect = [
+        urllib.error.HTTPError(metadata_url, 304, "Not Modified", Message(), None),
+        urlopen_result_mock,
+    ]
+    cache = MetadataCache(tmp_path)
+    cache.save_snapshot(
+        MetadataSnapshot(
+            metadata_url=metadata_url,
+            digest="abc",
+            entity_id="https://idp1.federation.test",
+            fingerprint=None,
+            etag='"v1"',
+            last_modified=None,
+            certificates=[],
+            endpoints=[],
+        )
+    )
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://idp3.federation.test", fingerprint="", metadata_url=metadata_url
+        ),
+        cache=cache,
+    )
+
+    assert saml_integrator.endpoints
+    assert urlopen_mock.call_count == 2
+    assert not urlopen_mock.call_args.args[0].has_header("If-none-match")
+
+
+@pytest.mark.parametrize("mode", ["document", "streaming", "index"])
+@patch("urllib.request.urlopen")
+def test_saml_extraction_traced(urlopen_mock, mode, tmp_path):
+    """
+    arrange: mock the aggregate metadata and slow down the extraction of each entity.
+    act: extract an entity parsing the whole document, streaming it or using the index.
+    assert: the time spent extracting the SAML data is recorded in the extract span.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata_url="https://federation.test/metadata",
+        metadata_streaming=mode == "streaming",
+    )
+    cache = MetadataCache(tmp_path) if mode == "index" else None
+    if cache:
+        assert SamlIntegrator(charm_state=charm_state, cache=cache).certificates
+    saml_integrator = SamlIntegrator(charm_state=charm_state, cache=cache)
+    extract_entity = saml._extract_entity  # pylint: disable=protected-access
+
+    def _slow_extract_entity(entity):
+        """Extract the SAML data of an entity slowly."""
+        time.sleep(0.01)
+        return extract_entity(entity)
+
+    with patch.object(saml, "_extract_entity", side_effect=_slow_extract_entity) as extract_mock:
+        with TRACER.span("test") as span:
+            saml_integrator.entities(["https://idp1.federation.test"])
+        durations = span.durations()
+
+    assert extract_mock.call_count
+    assert durations["SamlIntegrator.extract"] >= 0.01 * extract_mock.call_count
+
+
+@pytest.mark.parametrize("metadata_streaming", [False, True])
+@patch("urllib.request.urlopen")
+def test_saml_entities_single_pass(urlopen_mock, metadata_streaming, tmp_path):
+    """
+    arrange: mock the aggregate metadata.
+    act: extract several entities, including a missing one.
+    assert: the metadata is fetched and parsed once and each entity gets its own data.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata)
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+            metadata_url="https://federation.test/metadata",
+            metadata_streaming=metadata_streaming,
+        ),
+        cache=MetadataCache(tmp_path),
+    )
+    entity_ids = [
+        "https://idp3.federation.test",
+        "https://login.staging.ubuntu.com",
+        "https://idp1.federation.test",
+        "https://missing.federation.test",
+        "https://idp3.federation.test",
+    ]
+
+    with patch.object(saml, "MetadataDocument", wraps=saml.MetadataDocument) as document_mock:
+        entities = saml_integrator.entities(entity_ids)
+        assert document_mock.call_count == (0 if metadata_streaming else 1)
+
+    assert urlopen_mock.call_count == 1
+    assert list(entities) == entity_ids[:4]
+    assert entities["https://login.staging.ubuntu.com"].certificates == [
+        "cert1_content",
+        "cert2_content",
+    ]
+    assert entities["https://idp1.federation.test"].certificates == ["idp1_cert_content"]
+    assert [
+        str(endpoint.url) for endpoint in entities["https://idp3.federation.test"].endpoints
+    ] == ["https://idp3.federation.test/sso"]
+    assert entities["https://missing.federation.test"].endpoints == []
+    assert saml_integrator.entities(["https://idp1.federation.test"]) == {
+        "https://idp1.federation.test": entities["https://idp1.federation.test"]
+    }
+
+
+@pytest.mark.parametrize("document_cached", [False, True])
+@patch("urllib.request.urlopen")
+def test_saml_entities_not_modified(urlopen_mock, document_cached, tmp_path):
+    """
+    arrange: extract an entity from an aggregate with a cache.
+    act: extract other entities while the server answers not modified.
+    assert: the data already extracted is reused and the cached document, if any, is used to
+        extract the new entities.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+    urlopen_result_mock = get_urlopen_result_mock(200, metadata, {"ETag": '"v1"'})
+    urlopen_result_mock.__enter__.return_value = urlopen_result_mock
+    urlopen_mock.return_value = urlopen_result_mock
+    charm_state = get_charm_state_mock(
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint="",
+        metadata_url="https://federation.test/metadata",
+    )
+    cache = MetadataCache(tmp_path)
+    assert SamlIntegrator(charm_state=charm_state, cache=cache).entities(
+        ["https://login.staging.ubuntu.com", "https://idp1.federation.test"]
+    )
+    if not document_cached:
+        for path in (tmp_path / "documents").iterdir():
+            path.unlink()
+    not_modified = urllib.error.HTTPError(
+        "https://federation.test/metadata", 304, "Not Modified", Message(), None
+    )
+    urlopen_mock.side_effect = [not_modified, urlopen_result_mock]
+
+    entities = SamlIntegrator(charm_state=charm_state, cache=cache).entities(
+        ["https://idp1.federation.test", "https://idp3.federation.test"]
+    )
+
+    assert entities["https://idp1.federation.test"].certificates == ["idp1_cert_content"]
+    assert entities["https://idp3.federation.test"].endpoints
+    assert urlopen_mock.call_count == (2 if document_cached else 3)
+
+
+def test_stream_entities():
+    """
+    arrange: load an aggregate metadata.
+    act: stream several entities, including a missing one.
+    assert: only the requested entities are kept in the tree.
+    """
+    metadata = Path("tests/unit/files/metadata_aggregate.xml").read_bytes()
+
+    entities = saml.stream_entities(
+        metadata,
+        {
+            "https://idp1.federation.test",
+            "https://idp3.federation.test",
+            "https://missing.federation.test",
+        },
+    )
+
+    assert set(entities) == {"https://idp1.federation.test", "https://idp3.federation.test"}
+    root = entities["https://idp1.federation.test"].getparent()
+    assert [element.get("entityID") for element in root] == [
+        "https://idp1.federation.test",
+        "https://idp3.federation.test",
+    ]
+
+
+def test_stream_entities_nested_aggregate():
+    """
+    arrange: load an aggregate with an entity inside a nested aggregate.
+    act: stream the nested entity and a missing one, reading the entities after it.
+    assert: the nested entity is kept together with its ancestors.
+    """
+    metadata = Path("tests/unit/files/metadata_nested_aggregate.xml").read_bytes()
+
+    entities = saml.stream_entities(
+        metadata, {"https://idp2.federation.test", "https://missing.federation.test"}
+    )
+
+    entity = entities["https://idp2.federation.test"]
+    assert [ancestor.get("Name") for ancestor in entity.iterancestors()] == [
+        "https://nested.federation.test/metadata",
+        "https://federation.test/metadata",
+    ]
+    # The entities read after the nested aggregate are cleared, not removed yet
+    assert list(entity.getroottree().getroot())[0] is entity.getparent()
+    certificates, _ = saml._extract_entity(entity)  # pylint: disable=protected-access
+    assert certificates == ["idp2_cert_content"]
+
+
+def test_extract_entity_single_walk():
+    """
+    arrange: build an entity whose ID contains quotes and with a certificate in its signature.
+    act: find the entity and extract its data.
+    assert: only the KeyDescriptor certificates are extracted, sorted, and the endpoints keep
+        the document order.
+    """
+    entity_id = """https://idp.federation.test/?a='1'&b="2\""""
+    metadata = f"""<md:EntitiesDescriptor xmlns:md="{saml.NAMESPACES['md']}"
+        xmlns:ds="{saml.NAMESPACES['ds']}">
+        <md:EntityDescriptor entityID="{entity_id.replace('&', '&amp;').replace('"', '&quot;')}">
+            <ds:Signature><ds:KeyInfo><ds:X509Data>
+                <ds:X509Certificate>signature_cert</ds:X509Certificate>
+            </ds:X509Data></ds:KeyInfo></ds:Signature>
+            <md:IDPSSODescriptor>
+                <md:KeyDescriptor use="signing"><ds:KeyInfo><ds:X509Data>
+                    <ds:X509Certificate>cert2</ds:X509Certificate>
+                </ds:X509Data></ds:KeyInfo></md:KeyDescriptor>
+                <md:KeyDescriptor><ds:KeyInfo><ds:X509Data>
+                    <ds:X509Certificate>cert1</ds:X509Certificate>
+                </ds:X509Data></ds:KeyInfo></md:KeyDescriptor>
+                <md:SingleLogoutService Binding="binding1" Location="https://slo"
+                    ResponseLocation="https://slo/response"/>
+                <md:SingleSignOnService Binding="binding2" Location="https://sso"/>
+            </md:IDPSSODescriptor>
+        </md:EntityDescriptor>
+    </md:EntitiesDescriptor>""".encode()
+
+    entity = saml.stream_entities(metadata, {entity_id})[entity_id]
+    certificates, endpoints = saml._extract_entity(entity)  # pylint: disable=protected-access
+
+    assert certificates == ["cert1", "cert2"]
+    assert [(endpoint.name, endpoint.url, endpoint.response_url) for endpoint in endpoints] == [
+        ("SingleLogoutService", "https://slo", "https://slo/response"),
+        ("SingleSignOnService", "https://sso", None),
+    ]
+
+
+@pytest.mark.parametrize("digest", ["abc", None])
+def test_saml_cached_entities_missing(digest, tmp_path):
+    """
+    arrange: persist a snapshot for the configured entity only.
+    act: get the cached data of the configured entity and of another one.
+    assert: only the configured entity is returned, without fetching the metadata.
+    """
+    cache = MetadataCache(tmp_path)
+    snapshot = MetadataSnapshot(
+        metadata_url="https://federation.test/metadata",
+        digest=digest,
+        entity_id="https://login.staging.ubuntu.com",
+        fingerprint=None,
+        etag=None,
+        last_modified=None,
+        certificates=["cert1_content"],
+        endpoints=[],
+    )
+    saml_integrator = SamlIntegrator(
+        charm_state=get_charm_state_mock(
+            metadata_url="https://federation.test/metadata",
+            entity_id="https://login.staging.ubuntu.com",
+            fingerprint="",
+        ),
+        cache=cache,
+    )
+    cache.save_snapshot(snapshot)
+
+    with patch("urllib.request.urlopen") as urlopen_mock:
+        assert saml_integrator.cached_entities(["https://login.staging.ubuntu.com"]) == {
+            "https://login.staging.ubuntu.com": snapshot
+        }
+        assert (
+            saml_integrator.cached_entities(
+                ["https://login.staging.ubuntu.com", "https://idp1.federation.test"]
+            )
+            is None
+        )
+        urlopen_mock.assert_not_called()
@@ -0,0 +1,156 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Tracing unit tests."""
+
+import json
+from pathlib import Path
+
+import pytest
+
+import metadata_fetcher
+import tracing
+
+
+def read_spans(path: Path) -> list[list[dict]]:
+    """Read the exported traces as a collector would.
+
+    Args:
+        path: the traces file.
+
+    Returns:
+        The spans of each trace, in the order they ended.
+    """
+    return [
+        json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        for line in path.read_text(encoding="utf-8").splitlines()
+    ]
+
+
+def test_nested_spans_exported(tmp_path):
+    """
+    arrange: set up a tracer exporting to a file.
+    act: record a root span with a traced child and a failed child.
+    assert: a single trace is exported with the spans nested in the root span, and the failed
+        span is marked as such.
+    """
+    tracer = tracing.Tracer()
+    tracer.path = tmp_path / "state" / tracing.TRACES_FILENAME
+
+    @tracer.traced
+    def traced() -> str:
+        """Return a result.
+
+        Returns:
+            The result.
+        """
+        return "result"
+
+    with tracer.span("root", size=3, ratio=0.5, forced=True, url="https://example.com"):
+        assert traced() == "result"
+        with pytest.raises(ValueError), tracer.span("failed"):
+            raise ValueError("invalid")
+
+    (spans,) = read_spans(tracer.path)
+    by_name = {span["name"]: span for span in spans}
+    root = by_name.pop("root")
+    assert root["parentSpanId"] == ""
+    assert root["attributes"] == [
+        {"key": "size", "value": {"intValue": "3"}},
+        {"key": "ratio", "value": {"doubleValue": 0.5}},
+        {"key": "forced", "value": {"boolValue": True}},
+        {"key": "url", "value": {"stringValue": "https://example.com"}},
+    ]
+    assert set(by_name) == {"test_nested_spans_exported.<locals>.traced", "failed"}
+    assert all(span["parentSpanId"] == root["spanId"] for span in by_name.values())
+    assert all(span["traceId"] == root["traceId"] for span in by_name.values())
+    assert by_name["failed"]["status"] == {
+        "code": tracing.STATUS_CODE_ERROR,
+        "message": "ValueError: invalid",
+    }
+    assert root["status"] == {"code": tracing.STATUS_CODE_OK}
+
+
+def test_threaded_span_nested(tmp_path):
+    """
+    arrange: set up a tracer exporting to a file.
+    act: record a span in a function run in a thread while a span is current.
+    assert: the span recorded in the thread is nested in the current one.
+    """
+    tracer = tracing.Tracer()
+    tracer.path = tmp_path / tracing.TRACES_FILENAME
+
+    def threaded() -> None:
+        """Record a span."""
+        with tracer.span("threaded"):
+            pass
+
+    with tracer.span("root"):
+        metadata_fetcher.call_with_deadline(threaded, 1)
+
+    ((threaded_span, root),) = read_spans(tracer.path)
+    assert threaded_span["name"] == "threaded"
+    assert threaded_span["parentSpanId"] == root["spanId"]
+
+
+def test_traces_rotated(tmp_path, monkeypatch):
+    """
+    arrange: set up a tracer exporting to a file limited to a single trace.
+    act: record more traces than the backups kept.
+    assert: the oldest traces are discarded, the others being kept in the backups.
+    """
+    monkeypatch.setattr(tracing, "TRACES_MAX_SIZE", 500)
+    tracer = tracing.Tracer()
+    tracer.path = tmp_path / tracing.TRACES_FILENAME
+
+    for index in range(tracing.TRACES_BACKUP_COUNT + 3):
+        with tracer.span(f"trace{index}"):
+            pass
+
+    last = tracing.TRACES_BACKUP_COUNT + 2
+    assert read_spans(tracer.path)[0][0]["name"] == f"trace{last}"
+    for backup in range(1, tracing.TRACES_BACKUP_COUNT + 1):
+        (spans,) = read_spans(tmp_path / f"{tracing.TRACES_FILENAME}.{backup}")
+        assert spans[0]["name"] == f"trace{last - backup}"
+    assert not (tmp_path / f"{tracing.TRACES_FILENAME}.{tracing.TRACES_BACKUP_COUNT + 1}").exists()
+
+
+def test_traces_export_failure(tmp_path):
+    """
+    arrange: set up a tracer exporting to a file in an unwritable directory.
+    act: record a trace.
+    assert: the failure is ignored.
+    """
+    tracer = tracing.Tracer()
+    (tmp_path / "state").write_text("not a directory", encoding="utf-8")
+    tracer.path = tmp_path / "state" / tracing.TRACES_FILENAME
+
+    with tracer.span("root"):
+        pass
+
+    assert (tmp_path / "state").read_text(encoding="utf-8") == "not a directory"
+
+
+def test_span_durations():
+    """
+    arrange: set up a tracer.
+    act: record spans nested in a span, spans outside of it and a span still open.
+    assert: only the time spent in the ended spans nested in the span is reported, by name.
+    """
+    tracer = tracing.Tracer()
+
+    with tracer.span("root") as root:
+        with tracer.span("sibling"):
+            pass
+        with tracer.span("measured") as measured:
+            for _ in range(2):
+                with tracer.span("phase"), tracer.span("step"):
+                    pass
+            with tracer.span("open"):
+                with tracer.span("unfinished"):
+                    durations = measured.durations()
+        root_durations = root.durations()
+
+    assert set(durations) == {"phase", "step"}
+    assert durations["phase"] > durations["step"] > 0
+    assert set(root_durations) == {"sibling", "measured", "phase", "step", "open", "unfinished"}